@@ -0,0 +1,194 @@
+"""
+Asynchronous version of the chat pipeline (shared by the two apps).
+
+The openai calls use the async client (acreate) and the retrieval (query embedding +
+faiss search) runs in a thread pool, so one process can serve many conversations
+that are waiting on the openai api.
+
+The retrieval on the raw query starts at the same time as the reformulation : when
+the reformulation is done, its retrieval is merged with the speculative one (or
+replaces it). If the reformulation is too slow, the speculative results are used
+directly.
+"""
+
+import time
+import asyncio
+
+import openai
+
+from query_cache import normalize_query
+from metrics import NULL_TRACE
+from retrieval_utils import query_by_embedding
+from streaming import TextThrottle
+
+
+def merge_documents(*document_lists):
+    """
+    Merge lists of retrieved documents : one document per id (best score), best first.
+    """
+    best = {}
+    for documents in document_lists:
+        for document in documents:
+            if document.id not in best or document.score > best[document.id].score:
+                best[document.id] = document
+
+    return sorted(best.values(), key=lambda document: document.score, reverse=True)
+
+
+def retrieve_documents(
+    query, retriever, max_k=100, trace=NULL_TRACE, filters=None, query_emb=None
+):
+    """
+    Same as retriever.retrieve, in two steps for the metrics.
+    filters={"code": [...]} restricts the search to some codes.
+    query_emb is the embedding of the query when it is already computed (ex by the
+    semantic level of the query cache).
+    """
+    if hasattr(retriever, "bm25"):
+        # hybrid retrieval (see bm25.py), the scores are the fused ones
+        return retriever.retrieve(
+            query, top_k=max_k, trace=trace, filters=filters, query_emb=query_emb
+        )
+
+    if query_emb is None:
+        with trace.stage("embedding"):
+            query_emb = retriever.embed_queries([query])[0]
+    with trace.stage("search"):
+        return query_by_embedding(
+            retriever.document_store,
+            query_emb,
+            max_k,
+            retriever.scale_score,
+            filters,
+        )
+
+
+async def reformulate_async(prompt, model="text-davinci-002"):
+    response = await openai.Completion.acreate(
+        model=model,
+        prompt=prompt,
+        temperature=0,
+        max_tokens=128,
+        stop=["\n---\n", "<|im_end|>"],
+    )
+    return response["choices"][0]["text"]
+
+
+async def retrieve_overlapped(
+    query,
+    reformulation_prompt,
+    retriever,
+    executor=None,
+    max_k=100,
+    mode="merge",
+    reformulation_timeout=None,
+    trace=NULL_TRACE,
+    filters=None,
+    query_emb=None,
+    reformulation=None,
+):
+    """
+    Reformulate the query and retrieve the documents, the retrieval on the raw query
+    runs during the reformulation.
+
+    params:
+        query: str (raw user query)
+        reformulation_prompt: str
+        retriever: retriever with a retrieve(query, top_k) method
+        executor: thread pool for the retrieval (None for the default one)
+        max_k: int (number of documents retrieved per query)
+        mode: "merge" (raw + reformulated documents) or "switch" (reformulated only)
+        reformulation_timeout: float (seconds, after that the raw query results are
+            used), None to always wait for the reformulation
+        trace: metrics.RequestTrace
+        filters: dict ({"code": [...]}), None to search all the codes
+        query_emb: np.array (embedding of the raw query if it is already computed)
+        reformulation: asyncio.Future of reformulate_async if it is already started
+
+    return:
+        reformulated_query: str (the raw query if the reformulation timed out)
+        documents: list of Document (best first)
+    """
+    loop = asyncio.get_running_loop()
+
+    if hasattr(retriever, "is_reference") and retriever.is_reference(query):
+        # exact article reference : no reformulation (see bm25.py)
+        if reformulation is not None:
+            reformulation.cancel()
+        return query, await loop.run_in_executor(
+            executor, retrieve_documents, query, retriever, max_k, trace, filters
+        )
+
+    speculative = loop.run_in_executor(
+        executor, retrieve_documents, query, retriever, max_k, trace, filters, query_emb
+    )
+    if reformulation is None:
+        reformulation = asyncio.ensure_future(reformulate_async(reformulation_prompt))
+
+    start = time.perf_counter()
+    try:
+        reformulated_query = await asyncio.wait_for(
+            reformulation, reformulation_timeout
+        )
+    except asyncio.TimeoutError:
+        trace.add("reformulation", time.perf_counter() - start)
+        return query, await speculative
+    trace.add("reformulation", time.perf_counter() - start)
+
+    if normalize_query(reformulated_query) == normalize_query(query):
+        return reformulated_query, await speculative
+
+    documents = await loop.run_in_executor(
+        executor,
+        retrieve_documents,
+        reformulated_query,
+        retriever,
+        max_k,
+        trace,
+        filters,
+    )
+
+    if mode == "merge":
+        documents = merge_documents(documents, await speculative)
+    else:
+        speculative.cancel()
+
+    return reformulated_query, documents
+
+
+async def stream_completion_async(
+    prompt, model="text-davinci-002", max_tokens=1024, trace=NULL_TRACE
+):
+    """
+    Stream the tokens of a completion.
+    """
+    response = await openai.Completion.acreate(
+        model=model,
+        prompt=prompt,
+        temperature=0,  # deterministic
+        stream=True,
+        max_tokens=max_tokens,
+    )
+
+    async for chunk in response:
+        if (
+            chunk_message := chunk["choices"][0].get("text")
+        ) and chunk_message != "<|im_end|>":
+            trace.token_received()
+            yield chunk_message
+
+
+async def stream_text_async(chunks, interval=0.05, max_chars=200):
+    """
+    Async version of streaming.stream_text (same TextThrottle).
+    """
+    throttle = TextThrottle(interval, max_chars)
+
+    async for chunk in chunks:
+        text = throttle.add(chunk)
+        if text is not None:
+            yield text
+
+    text = throttle.flush()
+    if text is not None:
+        yield text
@@ -0,0 +1,181 @@
+"""
+Memory and recall of the compressed search modes of the serving store (see
+serving_store.py, --compression) against the exact search on the float32 vectors.
+
+For each mode (and each number of rescored candidates for int8 / binary), the
+benchmark reports :
+- index_mb : size of the index kept in memory, and the ratio to the float32 index
+- rescore_mb : size of the float16 vectors on disk (memory mapped, only the pages of
+  the candidates are read)
+- recall@k : mean fraction of the exact top k found in the top k of the mode
+- p50 / p99 latency of one query (first pass + rescoring)
+- within_tolerance : recall@k >= 1 - tolerance
+
+usage:
+    python benchmark_compression.py --embeddings ../corpus/embeddings/openai.npy \
+        --queries benchmark_data/openai_queries_v1.npz --output compression.json
+
+Without --queries, the queries are corpus vectors with some gaussian noise.
+"""
+
+import os
+import sys
+import time
+import json
+import argparse
+
+import numpy as np
+
+import faiss
+
+from serving_store import (
+    COMPRESSIONS,
+    RESCORED_COMPRESSIONS,
+    RESCORE_K,
+    compress_index,
+    binary_codes,
+    rescore,
+)
+
+# the query helpers of the faiss index benchmark (legacy/scripts)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "scripts"))
+from benchmark_faiss_index import make_queries
+
+
+def load_queries(path):
+    """
+    Query embeddings of a .npy file or of a .npz file recorded by
+    benchmark_retrieval.py --record.
+    """
+    if path.endswith(".npz"):
+        return np.load(path)["embeddings"]
+    return np.load(path)
+
+
+def index_size(index):
+    if isinstance(index, faiss.IndexBinary):
+        return faiss.serialize_index_binary(index).nbytes
+    return faiss.serialize_index(index).nbytes
+
+
+def benchmark_mode(
+    embeddings, queries, ground_truth, compression, rescore_k, k, metric
+):
+    """
+    Build the index of a compression mode and search the queries one at a time, as
+    MmapDocumentStore.search does.
+    """
+    center = embeddings.mean(axis=0) if compression == "binary" else None
+    index = compress_index(embeddings, metric, compression, center)
+    vectors = None
+    if compression in RESCORED_COMPRESSIONS:
+        vectors = embeddings.astype(np.float16)
+
+    ids = np.empty((len(queries), k), dtype=np.int64)
+    durations = []
+    for i in range(len(queries)):
+        query = queries[i : i + 1]
+        start = time.perf_counter()
+        if vectors is None:
+            _, ids[i] = index.search(query, k)
+        else:
+            first_pass = binary_codes(query, center) if center is not None else query
+            _, candidates = index.search(first_pass, max(k, rescore_k))
+            _, ids[i] = rescore(vectors, query, candidates, k, metric)
+        durations.append(time.perf_counter() - start)
+
+    recall = float(
+        np.mean([len(set(ids[i]) & set(ground_truth[i])) / k for i in range(len(ids))])
+    )
+    durations = np.asarray(durations) * 1000
+
+    return {
+        "compression": compression,
+        "rescore_k": rescore_k if vectors is not None else None,
+        "index_mb": index_size(index) / 1e6,
+        "rescore_mb": vectors.nbytes / 1e6 if vectors is not None else 0.0,
+        f"recall@{k}": recall,
+        "p50_ms": float(np.percentile(durations, 50)),
+        "p99_ms": float(np.percentile(durations, 99)),
+    }
+
+
+def run_benchmark(
+    embeddings,
+    queries,
+    compressions=COMPRESSIONS,
+    rescore_ks=(RESCORE_K,),
+    k=10,
+    metric=faiss.METRIC_INNER_PRODUCT,
+    tolerance=0.02,
+):
+    """
+    Benchmark all the modes, the ground truth is the exact search on the float32
+    vectors.
+    """
+    exact = compress_index(embeddings, metric, "none")
+    _, ground_truth = exact.search(queries, k)
+    exact_size = index_size(exact)
+
+    results = []
+    for compression in compressions:
+        for rescore_k in rescore_ks if compression in RESCORED_COMPRESSIONS else [0]:
+            result = benchmark_mode(
+                embeddings, queries, ground_truth, compression, rescore_k, k, metric
+            )
+            result["compression_ratio"] = exact_size / 1e6 / result["index_mb"]
+            result["within_tolerance"] = result[f"recall@{k}"] >= 1 - tolerance
+            print(
+                f"{compression:<8} rescore_k {result['rescore_k'] or '-':<5} "
+                f"index {result['index_mb']:8.1f} MB ({result['compression_ratio']:4.1f}x) "
+                f"rescore {result['rescore_mb']:8.1f} MB  "
+                f"recall@{k} {result[f'recall@{k}']:.3f} "
+                f"{'ok' if result['within_tolerance'] else 'BELOW TOLERANCE'}  "
+                f"p50 {result['p50_ms']:.2f} ms p99 {result['p99_ms']:.2f} ms"
+            )
+            results.append(result)
+
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--embeddings", required=True, help="npy of the corpus")
+    parser.add_argument("--queries", default=None, help="npy / npz of query embeddings")
+    parser.add_argument("--nb-queries", type=int, default=1000)
+    parser.add_argument("--compression", action="append", default=None)
+    parser.add_argument(
+        "--rescore-k", type=int, action="append", default=None, help="int8 / binary"
+    )
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--metric", default="ip", choices=["ip", "l2"])
+    parser.add_argument(
+        "--tolerance", type=float, default=0.02, help="maximum loss of recall@k"
+    )
+    parser.add_argument("--output", default=None, help="json file for the results")
+    args = parser.parse_args()
+
+    embeddings = np.ascontiguousarray(np.load(args.embeddings), dtype=np.float32)
+    if args.queries is not None:
+        queries = load_queries(args.queries)
+    else:
+        queries = make_queries(embeddings, args.nb_queries)
+    queries = np.ascontiguousarray(queries, dtype=np.float32)
+
+    results = run_benchmark(
+        embeddings,
+        queries,
+        args.compression or COMPRESSIONS,
+        args.rescore_k or [RESCORE_K],
+        args.k,
+        faiss.METRIC_L2 if args.metric == "l2" else faiss.METRIC_INNER_PRODUCT,
+        args.tolerance,
+    )
+
+    if args.output is not None:
+        with open(args.output, "w") as handle:
+            json.dump(
+                {"tolerance": args.tolerance, "k": args.k, "results": results},
+                handle,
+                indent=2,
+            )
@@ -0,0 +1,355 @@
+"""
+Retrieval quality and latency benchmark of the two document stores on a fixed set of
+legal questions (benchmark_data/legal_questions_v1.jsonl).
+
+Each line of the question file has a question and its gold articles :
+    {"qid": ..., "question": ..., "gold": [{"id": "code civil:1240", "snippet": ...}]}
+the ids of the documents are not the same in the two stores, so a retrieved document
+is the gold article when its "code" and "article" meta (see scripts/corpus.py) are the
+ones of the gold id (compared with bm25.normalize_text, "code_civil" / "L. 1234-5"
+match "code civil:L1234-5"). The snippet is only there for the reader of the file.
+
+For each store, the benchmark reports :
+- recall@k and MRR on the max_k retrieved documents
+- the recall of the passages given to the model (select_passages with the threshold
+  of the app, 0.555 / 0.49)
+- the recall and the number of tokens of the passages after the context packing
+  (context_packing.pack_passages with --context-budget)
+- p50 / p95 / p99 latency of the embedding, the faiss search and the post processing
+and writes everything in a json file that can be diffed across runs.
+
+The openai store does not call the api : the query embeddings are recorded once
+(--record) in a .npz file and replayed by RecordedQueryEncoder. The file is not
+committed (it needs an api key), so --record is a required first step before
+benchmarking the openai store, and again after a change of the question file.
+
+usage:
+    # once, with an openai api key
+    python benchmark_retrieval.py --record
+    python benchmark_retrieval.py --output results.json
+"""
+
+import os
+import json
+import time
+import hashlib
+import argparse
+
+import numpy as np
+
+from bm25 import normalize_text
+from retrieval_utils import select_passages
+from context_packing import pack_passages
+from metrics import count_tokens
+
+QUESTIONS_PATH = "benchmark_data/legal_questions_v1.jsonl"
+
+RECALL_KS = [1, 3, 5, 10, 50, 100]
+
+SENTENCE_TRANSFORMER_MODEL = "sentence-transformers/multi-qa-mpnet-base-dot-v1"
+OPENAI_MODEL = "text-embedding-ada-002"
+
+
+def load_questions(path):
+    """
+    Load the question file.
+
+    return:
+        questions: list of dict (one per line)
+        version: str (name of the file and sha256 of its content)
+    """
+    with open(path, "rb") as handle:
+        content = handle.read()
+
+    questions = [
+        json.loads(line)
+        for line in content.decode("utf-8").splitlines()
+        if line.strip()
+    ]
+    version = f"{os.path.basename(path)}@{hashlib.sha256(content).hexdigest()[:12]}"
+
+    return questions, version
+
+
+def article_key(code, number):
+    """
+    Normalized (code, article number) of a gold id or of the meta of a document.
+    """
+    code = " ".join(normalize_text(code).replace("_", " ").split())
+    return code, "".join(normalize_text(number).split())
+
+
+def gold_ranks(documents, gold):
+    """
+    Rank (0 based) of each gold article in the retrieved documents, None if missing.
+    """
+    keys = [article_key(*g["id"].rsplit(":", 1)) for g in gold]
+    ranks = [None] * len(gold)
+
+    for rank, document in enumerate(documents):
+        meta = document["meta"] if isinstance(document, dict) else document.meta
+        if "code" not in meta or "article" not in meta:
+            raise ValueError(
+                "the documents have no code / article meta, build the store from the "
+                "corpus (see scripts/corpus.py)"
+            )
+        key = article_key(meta["code"], meta["article"])
+        for i, gold_key in enumerate(keys):
+            if ranks[i] is None and key == gold_key:
+                ranks[i] = rank
+
+    return ranks
+
+
+def recall_at_k(ranks, k):
+    return sum(rank is not None and rank < k for rank in ranks) / len(ranks)
+
+
+def reciprocal_rank(ranks):
+    found = [rank for rank in ranks if rank is not None]
+    return 1 / (min(found) + 1) if found else 0.0
+
+
+def percentiles(times):
+    """
+    p50 / p95 / p99 in milliseconds.
+    """
+    times = np.asarray(times) * 1000
+    return {
+        "p50": float(np.percentile(times, 50)),
+        "p95": float(np.percentile(times, 95)),
+        "p99": float(np.percentile(times, 99)),
+    }
+
+
+class RecordedQueryEncoder:
+    """
+    Stand-in of the openai embedding api : replays the query embeddings recorded
+    by record_query_embeddings.
+    """
+
+    def __init__(self, path):
+        recorded = np.load(path)
+        self.embeddings = dict(
+            zip(recorded["queries"].tolist(), recorded["embeddings"])
+        )
+
+    def embed_queries(self, queries):
+        missing = [query for query in queries if query not in self.embeddings]
+        if missing:
+            raise KeyError(
+                f"{len(missing)} queries are not recorded, run with --record"
+            )
+        return np.stack([self.embeddings[query] for query in queries])
+
+
+def record_query_embeddings(queries, path, model=OPENAI_MODEL):
+    """
+    Embed the queries with the openai api and save them for RecordedQueryEncoder.
+    """
+    import openai
+
+    response = openai.Embedding.create(input=queries, model=model)
+    embeddings = np.array(
+        [
+            item["embedding"]
+            for item in sorted(response["data"], key=lambda item: item["index"])
+        ],
+        dtype=np.float32,
+    )
+    np.savez(path, queries=np.array(queries), embeddings=embeddings)
+
+
+def load_document_store(index_path, config_path):
+    """
+    A FAISSDocumentStore, or the memory mapped store if index_path is a serving store
+    folder (see serving_store.py).
+    """
+    if os.path.isdir(index_path):
+        from serving_store import MmapDocumentStore
+
+        return MmapDocumentStore(index_path)
+
+    from haystack.document_stores import FAISSDocumentStore
+
+    return FAISSDocumentStore.load(index_path=index_path, config_path=config_path)
+
+
+def benchmark_store(
+    questions,
+    encoder,
+    document_store,
+    max_k=100,
+    threshold=0.49,
+    repeat=3,
+    context_budget=2000,
+):
+    """
+    Run the questions on one store.
+
+    params:
+        questions: list of dict (see load_questions)
+        encoder: object with an embed_queries(list of str) -> np.array method
+        document_store: document store with query_by_embedding
+        max_k: int (number of documents retrieved per question)
+        threshold: float (threshold of the app, for the selected passages)
+        repeat: int (each question is timed repeat times)
+        context_budget: int (token budget of pack_passages)
+
+    return:
+        result: dict (metrics, latencies and per question ranks)
+    """
+    times = {"embed": [], "search": [], "postprocess": [], "total": []}
+    per_question = []
+
+    for question in questions:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            query_emb = encoder.embed_queries([question["question"]])[0]
+            embedded = time.perf_counter()
+            documents = document_store.query_by_embedding(query_emb, top_k=max_k)
+            searched = time.perf_counter()
+            passages = select_passages(documents, 3, 10, threshold)
+            end = time.perf_counter()
+
+            times["embed"].append(embedded - start)
+            times["search"].append(searched - embedded)
+            times["postprocess"].append(end - searched)
+            times["total"].append(end - start)
+
+        ranks = gold_ranks(documents, question["gold"])
+        passage_ranks = gold_ranks(passages, question["gold"])
+        packed = pack_passages(passages, context_budget)
+        packed_ranks = gold_ranks(packed, question["gold"])
+        per_question.append(
+            {
+                "qid": question["qid"],
+                "ranks": ranks,
+                "passages_recall": recall_at_k(passage_ranks, len(passages)),
+                "nb_passages": len(passages),
+                "passages_tokens": sum(count_tokens(p["content"]) for p in passages),
+                "packed_recall": recall_at_k(packed_ranks, len(packed)),
+                "packed_tokens": sum(count_tokens(p["content"]) for p in packed),
+            }
+        )
+
+    all_ranks = [q["ranks"] for q in per_question]
+    metrics = {
+        f"recall@{k}": float(np.mean([recall_at_k(r, k) for r in all_ranks]))
+        for k in RECALL_KS
+        if k <= max_k
+    }
+    metrics["mrr"] = float(np.mean([reciprocal_rank(r) for r in all_ranks]))
+    metrics["passages_recall"] = float(
+        np.mean([q["passages_recall"] for q in per_question])
+    )
+    for key in ["packed_recall", "passages_tokens", "packed_tokens"]:
+        metrics[key] = float(np.mean([q[key] for q in per_question]))
+    metrics["no_passage_rate"] = float(
+        np.mean([q["nb_passages"] == 0 for q in per_question])
+    )
+
+    return {
+        "threshold": threshold,
+        "max_k": max_k,
+        "metrics": metrics,
+        "latency_ms": {
+            stage: percentiles(stage_times) for stage, stage_times in times.items()
+        },
+        "questions": per_question,
+    }
+
+
+def print_result(name, result):
+    print(f"== {name} (threshold {result['threshold']})")
+    print(
+        "  "
+        + "  ".join(
+            f"{metric} {value:.3f}" for metric, value in result["metrics"].items()
+        )
+    )
+    for stage, stats in result["latency_ms"].items():
+        print(
+            f"  {stage:<12} p50 {stats['p50']:8.2f} ms  p95 {stats['p95']:8.2f} ms  p99 {stats['p99']:8.2f} ms"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--questions", default=QUESTIONS_PATH)
+    parser.add_argument("--stores", default="sentence_transformer,openai")
+    parser.add_argument(
+        "--st-index", default="faiss_db_sentence_transformer/faiss_index.index"
+    )
+    parser.add_argument(
+        "--st-config", default="faiss_db_sentence_transformer/faiss_config.json"
+    )
+    parser.add_argument("--st-threshold", type=float, default=0.555)
+    parser.add_argument("--openai-index", default="faiss_db_openai/faiss_index.index")
+    parser.add_argument("--openai-config", default="faiss_db_openai/faiss_config.json")
+    parser.add_argument("--openai-threshold", type=float, default=0.49)
+    parser.add_argument(
+        "--openai-embeddings", default="benchmark_data/openai_queries_v1.npz"
+    )
+    parser.add_argument(
+        "--record",
+        action="store_true",
+        help="record the openai query embeddings and exit",
+    )
+    parser.add_argument("--max-k", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--context-budget", type=int, default=2000)
+    parser.add_argument("--output", default="benchmark_retrieval.json")
+    args = parser.parse_args()
+
+    questions, version = load_questions(args.questions)
+
+    if args.record:
+        record_query_embeddings(
+            [q["question"] for q in questions], args.openai_embeddings
+        )
+        print(f"recorded {len(questions)} query embeddings in {args.openai_embeddings}")
+        raise SystemExit(0)
+
+    if "openai" in args.stores.split(",") and not os.path.exists(
+        args.openai_embeddings
+    ):
+        raise SystemExit(
+            f"{args.openai_embeddings} does not exist, record the openai query "
+            "embeddings first with --record (or use --stores sentence_transformer)"
+        )
+
+    results = {"questions": version, "stores": {}}
+
+    for name in args.stores.split(","):
+        if name == "sentence_transformer":
+            from haystack.nodes import EmbeddingRetriever
+
+            document_store = load_document_store(args.st_index, args.st_config)
+            encoder = EmbeddingRetriever(
+                document_store=document_store,
+                embedding_model=SENTENCE_TRANSFORMER_MODEL,
+                model_format="sentence_transformers",
+                progress_bar=False,
+            )
+            threshold = args.st_threshold
+        elif name == "openai":
+            document_store = load_document_store(args.openai_index, args.openai_config)
+            encoder = RecordedQueryEncoder(args.openai_embeddings)
+            threshold = args.openai_threshold
+        else:
+            raise ValueError(f"unknown store {name}")
+
+        results["stores"][name] = benchmark_store(
+            questions,
+            encoder,
+            document_store,
+            args.max_k,
+            threshold,
+            args.repeat,
+            args.context_budget,
+        )
+        print_result(name, results["stores"][name])
+
+    with open(args.output, "w") as handle:
+        json.dump(results, handle, indent=2, sort_keys=True, ensure_ascii=False)
@@ -0,0 +1,75 @@
+"""
+Throughput of retrieval_utils.retrieve_batch (queries / second) for a few batch
+sizes, on the faiss index of one of the apps. The passages of each query are the ones
+of retrieve_with_summaries (see test_retrieval_utils.py).
+
+usage (from the folder of the app, as test_retriever.py):
+    python ../benchmark_retrieve_batch.py --batch-sizes 1,16,64,256
+    python ../benchmark_retrieve_batch.py --model openai
+"""
+
+import time
+import argparse
+
+from retrieval_utils import retrieve_batch
+
+
+def load_retriever(model, index_path, config_path):
+    from haystack.document_stores import FAISSDocumentStore
+    from haystack.nodes import EmbeddingRetriever
+
+    document_store = FAISSDocumentStore.load(
+        index_path=index_path, config_path=config_path
+    )
+
+    if model == "openai":
+        import openai
+
+        with open("../key.key", "r") as f:
+            openai.api_key = f.read()
+
+        return EmbeddingRetriever(
+            document_store=document_store,
+            embedding_model="text-embedding-ada-002",
+            model_format="openai",
+            progress_bar=False,
+            api_key=openai.api_key,
+        )
+
+    return EmbeddingRetriever(
+        document_store=document_store,
+        embedding_model="sentence-transformers/multi-qa-mpnet-base-dot-v1",
+        model_format="sentence_transformers",
+        progress_bar=False,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--model",
+        default="sentence_transformers",
+        choices=["sentence_transformers", "openai"],
+    )
+    parser.add_argument("--index", default="faiss_index.index")
+    parser.add_argument("--config", default="faiss_config.json")
+    parser.add_argument("--batch-sizes", default="1,16,64,256")
+    parser.add_argument("--nb-queries", type=int, default=256)
+    parser.add_argument("--top-k", type=int, default=100)
+    args = parser.parse_args()
+
+    retriever = load_retriever(args.model, args.index, args.config)
+
+    queries = [
+        ["Syndicaliste et entreprises", "Durée du préavis de licenciement"][i % 2]
+        for i in range(args.nb_queries)
+    ]
+
+    for batch_size in [int(size) for size in args.batch_sizes.split(",")]:
+        start = time.perf_counter()
+        passages = retrieve_batch(
+            queries, retriever, top_k=args.top_k, batch_size=batch_size
+        )
+        elapsed = time.perf_counter() - start
+        print(f"batch size {batch_size}: {len(queries) / elapsed:.1f} queries / s")
+    print(passages[0])
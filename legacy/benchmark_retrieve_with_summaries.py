@@ -0,0 +1,100 @@
+"""
+Microbenchmark of the post processing of retrieve_with_summaries : the previous
+pandas version (DataFrame + filter_sources + to_dict) against the numpy version of
+retrieval_utils.select_passages, on 100 retrieved documents per query.
+
+usage:
+    python benchmark_retrieve_with_summaries.py --nb-queries 2000
+"""
+
+import time
+import argparse
+from dataclasses import dataclass, field
+
+import numpy as np
+import pandas as pd
+
+from retrieval_utils import select_passages
+
+
+@dataclass
+class FakeDocument:
+    """
+    Same attributes as the haystack Document used by the post processing.
+    """
+
+    content: str
+    score: float
+    meta: dict = field(default_factory=dict)
+
+
+def filter_sources_pandas(df, k_summary=3, k_total=10):
+    passages_summaries = df.head(k_summary)
+    passages_fullreports = df.head(k_total - len(passages_summaries))
+    return pd.concat(
+        [passages_summaries, passages_fullreports], axis=0, ignore_index=True
+    )
+
+
+def select_passages_pandas(docs, k_summary=3, k_total=10, threshold=0.49):
+    """
+    Previous implementation of retrieve_with_summaries (after retriever.retrieve).
+    """
+    docs = [
+        {**x.meta, "score": x.score, "content": x.content}
+        for x in docs
+        if x.score > threshold
+    ]
+    if len(docs) == 0:
+        return []
+    res = pd.DataFrame(docs)
+    passages_df = filter_sources_pandas(res, k_summary, k_total)
+    contents = passages_df["content"].tolist()
+    meta = passages_df.drop(columns=["content"]).to_dict(orient="records")
+    passages = []
+    for i in range(len(contents)):
+        passages.append({"content": contents[i], "meta": meta[i]})
+    return passages
+
+
+def make_results(nb_queries, max_k=100, seed=0):
+    """
+    Retrieved documents (sorted by decreasing score) for nb_queries queries.
+    """
+    rng = np.random.default_rng(seed)
+    results = []
+    for _ in range(nb_queries):
+        scores = np.sort(rng.uniform(0.4, 0.7, size=max_k))[::-1]
+        results.append(
+            [
+                FakeDocument(content=f"article {i} " * 50, score=float(score))
+                for i, score in enumerate(scores)
+            ]
+        )
+    return results
+
+
+def time_per_query(function, results, threshold):
+    start = time.perf_counter()
+    outputs = [function(docs, 3, 10, threshold) for docs in results]
+    return (time.perf_counter() - start) / len(results), outputs
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--nb-queries", type=int, default=2000)
+    parser.add_argument("--threshold", type=float, default=0.555)
+    args = parser.parse_args()
+
+    results = make_results(args.nb_queries)
+
+    before, outputs_before = time_per_query(
+        select_passages_pandas, results, args.threshold
+    )
+    after, outputs_after = time_per_query(select_passages, results, args.threshold)
+
+    assert outputs_before == outputs_after, "the outputs are different"
+
+    print(f"pandas : {before * 1e6:.1f} us / query")
+    print(f"numpy  : {after * 1e6:.1f} us / query")
+    print(f"speedup: {before / after:.1f}x")
@@ -0,0 +1,129 @@
+"""
+Startup time of a gradio app, with and without LAZY_STARTUP (see startup.py).
+
+The app is started in a subprocess, the benchmark polls the gradio port and the
+readiness probe and reports :
+- bound : time until the gradio port accepts connections
+- ready : time until /ready answers 200 (index and model loaded, warm-up query done)
+- serving : time until both (the app answers the queries)
+- the duration of each startup phase reported by /startup
+then the app is stopped.
+
+usage (from the folder of the app):
+    python ../benchmark_startup.py --app app.py --runs 3
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import subprocess
+import urllib.error
+import urllib.request
+
+import numpy as np
+
+
+def port_open(port, host="127.0.0.1"):
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.settimeout(0.2)
+        return sock.connect_ex((host, port)) == 0
+
+
+def get_json(url):
+    try:
+        with urllib.request.urlopen(url, timeout=1) as response:
+            return response.status, json.loads(response.read())
+    except urllib.error.HTTPError as error:
+        return error.code, json.loads(error.read())
+    except (urllib.error.URLError, ConnectionError, socket.timeout):
+        return None, None
+
+
+def run_once(app, lazy, server_port=7860, probe_port=7861, timeout=600):
+    """
+    Start the app once and measure its startup.
+
+    return:
+        result: dict (bound, ready, serving and the phases of the app, in seconds)
+    """
+    env = {
+        **os.environ,
+        "LAZY_STARTUP": "1" if lazy else "0",
+        "READINESS_PORT": str(probe_port),
+    }
+    start = time.time()
+    process = subprocess.Popen([sys.executable, app], env=env)
+
+    result = {"bound": None, "ready": None}
+    try:
+        while time.time() - start < timeout:
+            if process.poll() is not None:
+                raise RuntimeError(f"the app exited with code {process.returncode}")
+
+            now = time.time() - start
+            if result["bound"] is None and port_open(server_port):
+                result["bound"] = now
+
+            if result["ready"] is None:
+                code, status = get_json(f"http://127.0.0.1:{probe_port}/ready")
+                if code == 200:
+                    result["ready"] = now
+                    result["phases"] = {
+                        name: phase["duration"]
+                        for name, phase in status["phases"].items()
+                        if name != "ready"
+                    }
+
+            # without LAZY_STARTUP the app is ready before the server is bound
+            if result["bound"] is not None and result["ready"] is not None:
+                result["serving"] = max(result["bound"], result["ready"])
+                return result
+
+            time.sleep(0.05)
+
+        raise TimeoutError("the app did not start")
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def summary(results):
+    keys = ["bound", "ready", "serving"] + list(results[0]["phases"])
+    values = {
+        key: [
+            result[key] if key in result else result["phases"].get(key, 0)
+            for result in results
+        ]
+        for key in keys
+    }
+    return {key: float(np.median(value)) for key, value in values.items()}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--app", default="app.py")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--server-port", type=int, default=7860)
+    parser.add_argument("--probe-port", type=int, default=7861)
+    parser.add_argument("--output", default=None)
+    args = parser.parse_args()
+
+    report = {}
+    for lazy in [False, True]:
+        results = [
+            run_once(args.app, lazy, args.server_port, args.probe_port)
+            for _ in range(args.runs)
+        ]
+        name = "lazy" if lazy else "eager"
+        report[name] = summary(results)
+
+        print(f"== {name} (median of {args.runs} runs)")
+        for key, value in report[name].items():
+            print(f"  {key:<16} {value:7.2f} s")
+
+    if args.output is not None:
+        with open(args.output, "w") as handle:
+            json.dump(report, handle, indent=2)
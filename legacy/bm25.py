@@ -0,0 +1,437 @@
+"""
+Local BM25 index of the articles and hybrid (BM25 + dense) retrieval, shared by the
+two apps.
+
+The dense retrievers handle badly the exact references ("article L1234-5") and the
+terms of art ("usufruit"). The BM25 index is built from the same articles of the
+corpus (scripts/corpus.py) as the faiss stores :
+    python bm25.py --corpus ../corpus/ --output bm25_index/
+and the apps use it with BM25_INDEX=bm25_index/.
+
+Layout of the index folder (everything is memory mapped at load time) :
+- vocab.json : term -> term id
+- offsets.npy : int64, the postings of the term t are [offsets[t], offsets[t + 1])
+- doc_ids.npy : int32, article of each posting
+- weights.npy : float32, bm25 weight of each posting (idf and length normalization
+  are precomputed, a query only sums the weights of its terms)
+- texts / ids / refs / codes columns (see serving_store.StringColumn) : the content
+  of the articles, their id (sha256 of the content, the fusion key of the dense and
+  the BM25 results), their reference and their code (empty when unknown)
+- config.json : k1, b, number of articles
+
+HybridRetriever fuses the dense and the BM25 results by reciprocal rank fusion. A
+query that is only an article reference skips the embedding and the faiss search.
+Both searches can be restricted to some codes (filters={"code": [...]}), the BM25
+scores of the other codes are masked before the top k.
+"""
+
+import os
+import re
+import json
+import hashlib
+import argparse
+import unicodedata
+from collections import Counter
+
+import numpy as np
+
+from serving_store import StringColumn, write_string_column
+from metrics import NULL_TRACE
+from retrieval_utils import query_by_embedding
+
+STOPWORDS = set("""
+    a au aux avec ce ces dans de des du elle en et eux il je la le les leur lui ma
+    mais me meme mes moi mon ne nos notre nous on ou par pas pour qu que qui sa se
+    ses son sur ta te tes toi ton tu un une vos votre vous c d j l m n s t y est
+    sont ete etre avoir a ont sera peut doit cette cet dont
+    """.split())
+
+# "L. 1234-5", "l1234-5", "R.123" -> "l1234-5", "r123"
+REFERENCE_PREFIX_REGEX = re.compile(r"\b([lrd])\s*\.?\s*(?=\d)")
+TOKEN_REGEX = re.compile(r"[lrd]?\d+(?:-\d+)*|[a-z]+")
+# a bare number ("2023") is not a reference : "article" / "art." or a l, r, d letter
+REFERENCE_QUERY_REGEX = re.compile(
+    r"^(?=art|[lrd]\d)(?:art(?:icle)?s?\s*)?([lrd]?\d+(?:-\d+)*)$"
+)
+
+
+def normalize_text(text):
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return REFERENCE_PREFIX_REGEX.sub(r"\1", text)
+
+
+def tokenize(text):
+    return [
+        token
+        for token in TOKEN_REGEX.findall(normalize_text(text))
+        if token not in STOPWORDS and len(token) > 1
+    ]
+
+
+def reference_of_query(query):
+    """
+    The article reference if the query is only a reference ("article L1234-5"),
+    else None.
+    """
+    text = " ".join(normalize_text(query).replace(".", " ").split())
+    match = REFERENCE_QUERY_REGEX.match(text)
+    return match.group(1) if match else None
+
+
+def article_id(article):
+    return hashlib.sha256(article.encode("utf-8")).hexdigest()
+
+
+def build_bm25_index(articles, path, references=None, codes=None, k1=1.2, b=0.75):
+    """
+    Build the BM25 index of the articles in the path folder.
+
+    params:
+        articles: list of str
+        path: str (output folder)
+        references: list of str (reference of each article), None if unknown
+        codes: list of str (code of each article), None if unknown
+        k1: float
+        b: float
+    """
+    os.makedirs(path, exist_ok=True)
+
+    vocab = {}
+    postings = []  # term id -> list of (doc id, tf)
+    doc_lengths = np.zeros(len(articles), dtype=np.float32)
+
+    for doc_id, article in enumerate(articles):
+        counts = Counter(tokenize(article))
+        doc_lengths[doc_id] = sum(counts.values())
+        for term, tf in counts.items():
+            if term not in vocab:
+                vocab[term] = len(vocab)
+                postings.append([])
+            postings[vocab[term]].append((doc_id, tf))
+
+    nb_docs = len(articles)
+    avg_length = float(doc_lengths.mean()) if nb_docs else 0.0
+
+    offsets = np.zeros(len(postings) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(term_postings) for term_postings in postings])
+    doc_ids = np.empty(offsets[-1], dtype=np.int32)
+    weights = np.empty(offsets[-1], dtype=np.float32)
+
+    for term_id, term_postings in enumerate(postings):
+        start, end = offsets[term_id], offsets[term_id + 1]
+        ids = np.array([doc_id for doc_id, _ in term_postings], dtype=np.int32)
+        tfs = np.array([tf for _, tf in term_postings], dtype=np.float32)
+
+        idf = np.log(1 + (nb_docs - len(ids) + 0.5) / (len(ids) + 0.5))
+        norm = k1 * (1 - b + b * doc_lengths[ids] / avg_length)
+        doc_ids[start:end] = ids
+        weights[start:end] = idf * tfs * (k1 + 1) / (tfs + norm)
+
+    np.save(os.path.join(path, "offsets.npy"), offsets)
+    np.save(os.path.join(path, "doc_ids.npy"), doc_ids)
+    np.save(os.path.join(path, "weights.npy"), weights)
+
+    with open(os.path.join(path, "vocab.json"), "w") as handle:
+        json.dump(vocab, handle, ensure_ascii=False)
+
+    write_string_column(path, "texts", articles)
+    write_string_column(path, "ids", [article_id(article) for article in articles])
+    write_string_column(
+        path,
+        "refs",
+        [normalize_text(ref) for ref in references] if references else [""] * nb_docs,
+    )
+    write_string_column(path, "codes", codes if codes else [""] * nb_docs)
+
+    with open(os.path.join(path, "config.json"), "w") as handle:
+        json.dump({"k1": k1, "b": b, "nb_docs": nb_docs}, handle)
+
+
+class BM25Index:
+    """
+    BM25 index written by build_bm25_index.
+    """
+
+    def __init__(self, path):
+        with open(os.path.join(path, "vocab.json"), "r") as handle:
+            self.vocab = json.load(handle)
+        with open(os.path.join(path, "config.json"), "r") as handle:
+            self.config = json.load(handle)
+
+        self.offsets = np.load(os.path.join(path, "offsets.npy"), mmap_mode="r")
+        self.doc_ids = np.load(os.path.join(path, "doc_ids.npy"), mmap_mode="r")
+        self.weights = np.load(os.path.join(path, "weights.npy"), mmap_mode="r")
+
+        self.texts = StringColumn(path, "texts")
+        self.ids = StringColumn(path, "ids")
+        self.refs = StringColumn(path, "refs")
+
+        # code id of each article, for the filtered searches
+        self.codes = None
+        self.code_ids = np.zeros(len(self), dtype=np.int16)
+        self.code_names = {}
+        if os.path.exists(os.path.join(path, "codes_offsets.npy")):
+            self.codes = StringColumn(path, "codes")
+            for doc_id in range(len(self.codes)):
+                code = self.codes[doc_id]
+                if code:
+                    self.code_ids[doc_id] = self.code_names.setdefault(
+                        code, len(self.code_names) + 1
+                    )
+
+        # reference -> articles, for the exact reference queries
+        self.reference_docs = {}
+        for doc_id in range(len(self.refs)):
+            ref = self.refs[doc_id]
+            if ref:
+                self.reference_docs.setdefault(ref, []).append(doc_id)
+
+    def __len__(self):
+        return self.config["nb_docs"]
+
+    def code_mask(self, codes):
+        """
+        Mask of the articles of codes (None for all the codes).
+        """
+        if codes is None:
+            return None
+        code_ids = [self.code_names[code] for code in codes if code in self.code_names]
+        return np.isin(self.code_ids, code_ids)
+
+    def search(self, query, top_k=100, codes=None):
+        """
+        params:
+            codes: list of str (search only the articles of these codes), None for all
+
+        return:
+            doc_ids: np.array of int (best first)
+            scores: np.array of float
+        """
+        term_ids = [
+            self.vocab[term] for term in set(tokenize(query)) if term in self.vocab
+        ]
+        if not term_ids:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+
+        scores = np.zeros(len(self), dtype=np.float32)
+        for term_id in term_ids:
+            start, end = self.offsets[term_id], self.offsets[term_id + 1]
+            # the articles of a posting list are unique
+            scores[self.doc_ids[start:end]] += self.weights[start:end]
+
+        mask = self.code_mask(codes)
+        if mask is not None:
+            scores[~mask] = 0
+
+        candidates = np.flatnonzero(scores)
+        if len(candidates) > top_k:
+            candidates = candidates[
+                np.argpartition(-scores[candidates], top_k - 1)[:top_k]
+            ]
+        candidates = candidates[np.argsort(-scores[candidates], kind="stable")]
+
+        return candidates, scores[candidates]
+
+    def search_reference(self, reference, top_k=100, codes=None):
+        """
+        Articles with this reference first, then the BM25 results of the reference.
+        """
+        exact = self.reference_docs.get(reference, [])
+        mask = self.code_mask(codes)
+        if mask is not None:
+            exact = [doc_id for doc_id in exact if mask[doc_id]]
+        doc_ids, scores = self.search(reference, top_k, codes)
+        max_score = float(scores[0]) if len(scores) else 1.0
+
+        ranked = list(exact) + [doc_id for doc_id in doc_ids if doc_id not in exact]
+        ranked_scores = [max_score + 1.0] * len(exact) + [
+            float(score)
+            for doc_id, score in zip(doc_ids, scores)
+            if doc_id not in exact
+        ]
+        return np.array(ranked[:top_k]), np.array(ranked_scores[:top_k])
+
+
+def reciprocal_rank_fusion(rankings, k=60):
+    """
+    params:
+        rankings: list of list of keys (best first)
+        k: int
+
+    return:
+        fused: list of (key, score), best first
+    """
+    scores = {}
+    for ranking in rankings:
+        for rank, key in enumerate(ranking):
+            scores[key] = scores.get(key, 0.0) + 1 / (k + rank + 1)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+
+class HybridRetriever:
+    """
+    Dense retriever + BM25 index, fused by reciprocal rank fusion.
+
+    The score of the returned documents is the fused score divided by the best
+    possible one (first in both rankings), so the dense threshold of the app does not
+    apply to it : the dense results are filtered with threshold before the fusion.
+
+    params:
+        retriever: dense retriever (EmbeddingRetriever, OnnxRetriever, RetrievalPool)
+        bm25: BM25Index
+        threshold: float (minimum dense score)
+        dense_k: int (number of dense candidates)
+        bm25_k: int (number of BM25 candidates)
+        rrf_k: int
+    """
+
+    def __init__(
+        self, retriever, bm25, threshold=0.49, dense_k=50, bm25_k=50, rrf_k=60
+    ):
+        self.retriever = retriever
+        self.bm25 = bm25
+        self.threshold = threshold
+        self.dense_k = dense_k
+        self.bm25_k = bm25_k
+        self.rrf_k = rrf_k
+
+        self.document_store = retriever.document_store
+        self.scale_score = retriever.scale_score
+
+    def embed_queries(self, queries):
+        return self.retriever.embed_queries(queries)
+
+    def is_reference(self, query):
+        return reference_of_query(query) is not None
+
+    def embed_query(self, query):
+        """
+        Embedding of the query for the semantic cache, None for an exact reference
+        (its retrieval does not need it).
+        """
+        if self.is_reference(query):
+            return None
+        return self.retriever.embed_queries([query])[0]
+
+    def bm25_document(self, doc_id, bm25_score):
+        from haystack.schema import Document
+
+        return Document(
+            content=self.bm25.texts[doc_id],
+            id=self.bm25.ids[doc_id],
+            meta={
+                "bm25_score": bm25_score,
+                # row of the article in the bm25 index (see passage_keys)
+                "bm25_row": doc_id,
+                "reference": self.bm25.refs[doc_id],
+                "code": self.bm25.codes[doc_id] if self.bm25.codes is not None else "",
+            },
+            score=None,
+        )
+
+    def retrieve(
+        self, query, top_k=100, trace=NULL_TRACE, filters=None, query_emb=None
+    ):
+        """
+        params:
+            filters: dict ({"code": [...]}, see retrieval_utils.code_filters)
+            query_emb: np.array (embedding of the query if it is already computed)
+
+        return:
+            documents: list of Document (best first, score in [0, 1])
+        """
+        codes = filters["code"] if filters else None
+
+        reference = reference_of_query(query)
+        if reference is not None:
+            # exact reference : no embedding call, no faiss search
+            with trace.stage("bm25"):
+                doc_ids, bm25_scores = self.bm25.search_reference(
+                    reference, top_k, codes
+                )
+            dense_documents = []
+        else:
+            with trace.stage("bm25"):
+                doc_ids, bm25_scores = self.bm25.search(query, self.bm25_k, codes)
+
+            if query_emb is None:
+                with trace.stage("embedding"):
+                    query_emb = self.embed_queries([query])[0]
+            with trace.stage("search"):
+                dense_documents = [
+                    document
+                    for document in query_by_embedding(
+                        self.document_store,
+                        query_emb,
+                        self.dense_k,
+                        self.scale_score,
+                        filters,
+                    )
+                    if document.score > self.threshold
+                ]
+
+        documents = {}
+        dense_ranking = []
+        for document in dense_documents:
+            key = article_id(document.content)
+            document.meta = {**document.meta, "dense_score": document.score}
+            documents[key] = document
+            dense_ranking.append(key)
+
+        bm25_ranking = []
+        for doc_id, bm25_score in zip(doc_ids, bm25_scores):
+            key = self.bm25.ids[int(doc_id)]
+            if key in documents:
+                documents[key].meta["bm25_score"] = float(bm25_score)
+            else:
+                documents[key] = self.bm25_document(int(doc_id), float(bm25_score))
+            bm25_ranking.append(key)
+
+        best_score = 2 / (self.rrf_k + 1)
+        fused = []
+        for key, score in reciprocal_rank_fusion(
+            [dense_ranking, bm25_ranking], self.rrf_k
+        )[:top_k]:
+            document = documents[key]
+            document.score = score / best_score
+            fused.append(document)
+
+        return fused
+
+
+def read_articles(path, max_length=1500):
+    """
+    Read the articles embedded by the embedding scripts from the corpus folder (the
+    non empty articles shorter than max_length), their reference and their code. The
+    columns of the corpus have the layout of StringColumn, the articles are decoded
+    one by one.
+
+    return:
+        articles: list of str
+        references: list of str
+        codes: list of str
+    """
+    texts = StringColumn(path, "texts")
+    numbers = StringColumn(path, "numbers")
+    lengths = np.load(os.path.join(path, "lengths.npy"), mmap_mode="r")
+    code_ids = np.load(os.path.join(path, "code_ids.npy"), mmap_mode="r")
+    with open(os.path.join(path, "codes.json"), "r") as handle:
+        code_names = json.load(handle)
+
+    rows = np.flatnonzero((lengths > 0) & (lengths < max_length))
+    return (
+        [texts[row] for row in rows],
+        [numbers[row] for row in rows],
+        [code_names[code_ids[row]] for row in rows],
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--corpus", default="../corpus/")
+    parser.add_argument("--output", default="bm25_index/")
+    args = parser.parse_args()
+
+    articles, references, codes = read_articles(args.corpus)
+    build_bm25_index(articles, args.output, references=references, codes=codes)
@@ -0,0 +1,3 @@
+# test_retriever.py and faiss_db_openai/test_retriever_openai.py are manual scripts
+# (they load the indexes of the apps when imported), pytest does not collect them
+collect_ignore = ["test_retriever.py", "faiss_db_openai/test_retriever_openai.py"]
@@ -0,0 +1,128 @@
+"""
+Packing of the retrieved passages and of the history in the prompt (shared by the two
+apps), with a token budget.
+
+select_passages returns up to 10 passages (the 3 best ones twice) and the history of
+the conversation keeps growing, so the prompt can exceed the context of the model
+and we pay for useless tokens. Before the prompt is built :
+- the duplicated passages are removed
+- the passages are ordered by MMR (relevance, minus the similarity with the passages
+  already selected, so that near duplicate articles are not all kept)
+- the passages are packed greedily in that order while they fit in the budget
+- the oldest turns of the history are dropped to fit in the history budget
+(the conversation shown in the app is not truncated, only the prompt)
+"""
+
+import re
+
+from metrics import count_tokens
+
+WORD_REGEX = re.compile(r"\w+")
+
+
+def dedup_passages(passages):
+    """
+    Remove the passages with the same content (the first one, best score, is kept).
+    """
+    seen = set()
+    unique = []
+    for passage in passages:
+        key = " ".join(passage["content"].split())
+        if key not in seen:
+            seen.add(key)
+            unique.append(passage)
+    return unique
+
+
+def word_set(text):
+    return set(WORD_REGEX.findall(text.lower()))
+
+
+def jaccard(a, b):
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+def mmr_order(passages, diversity=0.3):
+    """
+    Order the passages by maximal marginal relevance :
+    (1 - diversity) * score - diversity * max similarity with the selected passages
+    (jaccard similarity of the words, the retriever does not return the embeddings).
+    """
+    words = [word_set(passage["content"]) for passage in passages]
+    scores = [passage["meta"].get("score", 0.0) for passage in passages]
+
+    remaining = list(range(len(passages)))
+    max_similarity = [0.0] * len(passages)
+    order = []
+
+    while remaining:
+        best = max(
+            remaining,
+            key=lambda i: (1 - diversity) * scores[i] - diversity * max_similarity[i],
+        )
+        remaining.remove(best)
+        order.append(best)
+
+        for i in remaining:
+            max_similarity[i] = max(max_similarity[i], jaccard(words[i], words[best]))
+
+    return [passages[i] for i in order]
+
+
+def pack_passages(passages, budget=2000, diversity=0.3):
+    """
+    Select the passages given to the model.
+
+    params:
+        passages: list of {"content": str, "meta": dict} (select_passages output)
+        budget: int (maximum number of tokens of the passages)
+        diversity: float (0 orders by score only)
+
+    return:
+        passages: list of passages (MMR order), their tokens fit in the budget
+    """
+    packed = []
+    used = 0
+    for passage in mmr_order(dedup_passages(passages), diversity):
+        nb_tokens = count_tokens(passage["content"])
+        # a passage that does not fit is skipped, a shorter one may still fit
+        if used + nb_tokens <= budget:
+            packed.append(passage)
+            used += nb_tokens
+
+    return packed
+
+
+def truncate_history(messages, budget=1000, keep_last=2):
+    """
+    Drop the oldest turns of the conversation to fit in the budget.
+
+    params:
+        messages: list of {"role", "content"} (system prompt first)
+        budget: int (maximum number of tokens of the kept turns)
+        keep_last: int (number of last messages always kept, the question and the
+            sources)
+
+    return:
+        messages: system prompt + most recent (user, assistant) pairs + last messages
+    """
+    head, turns, last = (
+        messages[:1],
+        messages[1 : len(messages) - keep_last],
+        messages[len(messages) - keep_last :],
+    )
+
+    kept = []
+    used = 0
+    # (user, assistant) pairs, most recent first
+    for start in range(len(turns) - 2, -1, -2):
+        pair = turns[start : start + 2]
+        nb_tokens = sum(count_tokens(str(message["content"])) for message in pair)
+        if used + nb_tokens > budget:
+            break
+        kept = pair + kept
+        used += nb_tokens
+
+    return head + kept + last
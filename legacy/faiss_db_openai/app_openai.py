@@ -1,15 +1,36 @@
+import os
+import sys
+
+# the shared modules (startup, retrieval_utils ...) are in legacy/ and the app is run
+# from its own folder (it opens faiss_index.index and ../key.key), see README.md
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from startup import startup_from_env, WARMUP_QUERY
 import gradio as gr
-from haystack.document_stores import FAISSDocumentStore
-from haystack.nodes import EmbeddingRetriever
 import openai
-import pandas as pd
-import os
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from utils import (
-    make_pairs,
     set_openai_api_key,
     create_user_id,
     to_completion,
 )
+from streaming import stream_text
+from retrieval_utils import (
+    select_passages,
+    embed_query,
+    passage_keys,
+    passages_from_keys,
+    retrieve_with_summaries,
+    code_filters,
+    store_codes,
+    ALL_CODES,
+)
+from query_cache import QueryCache, normalize_query
+from session_store import SessionStore
+from metrics import metrics_from_env
+from context_packing import pack_passages, truncate_history
 import numpy as np
 from datetime import datetime
 
@@ -20,7 +41,9 @@ try:
 except:
     pass
 
-list_codes = []
+# codes of the serving store, the search can be restricted to one of them
+# (see serving_store.py)
+list_codes = store_codes(os.environ.get("SERVING_STORE"))
 
 theme = gr.themes.Soft(
     primary_hue="sky",
@@ -76,84 +99,120 @@ set_openai_api_key(key)
 
 openai.api_key = os.environ["api_key"]
 
-retriever = EmbeddingRetriever(
-    document_store=FAISSDocumentStore.load(
-        index_path="faiss_index.index",
-        config_path="faiss_config.json",
-    ),
-    embedding_model="text-embedding-ada-002",
-    model_format="openai",
-    progress_bar=False,
-    api_key=os.environ["api_key"],
-)
+# LAZY_STARTUP=1 binds the server first and loads the retriever in a background
+# thread, with a readiness probe (see startup.py)
+startup = startup_from_env()
 
 
-file_share_name = "loilibregpt"
+def load_retriever():
+    """
+    load the document store and the embedding model, then run a warm-up query
+    """
+    with startup.phase("haystack_import"):
+        from haystack.document_stores import FAISSDocumentStore
+        from haystack.nodes import EmbeddingRetriever
+
+    with startup.phase("document_store"):
+        # SERVING_STORE=path uses the memory mapped store (see serving_store.py)
+        if os.environ.get("SERVING_STORE"):
+            from serving_store import MmapDocumentStore
+
+            document_store = MmapDocumentStore(os.environ["SERVING_STORE"])
+        else:
+            document_store = FAISSDocumentStore.load(
+                index_path="faiss_index.index",
+                config_path="faiss_config.json",
+            )
 
-user_id = create_user_id(10)
+    with startup.phase("model"):
+        retriever = EmbeddingRetriever(
+            document_store=document_store,
+            embedding_model="text-embedding-ada-002",
+            model_format="openai",
+            progress_bar=False,
+            api_key=os.environ["api_key"],
+        )
 
+    with startup.phase("warmup"):
+        retriever.retrieve(WARMUP_QUERY, top_k=10)
 
-def filter_sources(df, k_summary=3, k_total=10, source="code civil"):
-    # assert source in ["ipcc", "ipbes", "all"]
+    # BM25_INDEX=path fuses the dense results with a BM25 index (see bm25.py)
+    if os.environ.get("BM25_INDEX"):
+        from bm25 import BM25Index, HybridRetriever
 
-    # # Filter by source
-    # if source == "Code civil":
-    #     df = df.loc[df["source"] == "codecivil"]
-    # elif source == "ipbes":
-    #     df = df.loc[df["source"] == "IPBES"]
-    # else:
-    #     pass
+        with startup.phase("bm25"):
+            retriever = HybridRetriever(
+                retriever, BM25Index(os.environ["BM25_INDEX"]), threshold=0.49
+            )
 
-    # Separate summaries and full reports
-    df_summaries = df  # .loc[df["report_type"].isin(["SPM", "TS"])]
-    df_full = df  # .loc[~df["report_type"].isin(["SPM", "TS"])]
+    return retriever
 
-    # Find passages from summaries dataset
-    passages_summaries = df_summaries.head(k_summary)
 
-    # Find passages from full reports dataset
-    passages_fullreports = df_full.head(k_total - len(passages_summaries))
+startup.start(load_retriever)
 
-    # Concatenate passages
-    passages = pd.concat(
-        [passages_summaries, passages_fullreports], axis=0, ignore_index=True
+# cache of the reformulation and of the retrieved passages (see query_cache.py)
+query_cache = QueryCache(
+    max_size=int(os.environ.get("QUERY_CACHE_SIZE", 1024)),
+    ttl=float(os.environ.get("QUERY_CACHE_TTL", 24 * 3600)),
+    semantic_threshold=float(os.environ.get("QUERY_CACHE_THRESHOLD", 0.95)),
+    embed=lambda query: embed_query(startup.wait(), query),
+)
+# after an exact miss, the semantic level of the cache (query embedding) is looked up
+# first and the reformulation is only called on a miss. OVERLAP_REFORMULATION=1 starts
+# the reformulation during the lookup instead (in this pool for chat) : a miss is
+# faster, but a semantic hit still pays for its reformulation
+OVERLAP_REFORMULATION = os.environ.get("OVERLAP_REFORMULATION", "0") == "1"
+reformulation_executor = (
+    ThreadPoolExecutor(max_workers=int(os.environ.get("CHAT_CONCURRENCY", 16)))
+    if OVERLAP_REFORMULATION
+    else None
+)
+
+# conversations kept in the process, the gr.State only holds the session id
+# (see session_store.py)
+sessions = SessionStore(
+    max_sessions=int(os.environ.get("SESSION_MAX", 10000)),
+    ttl=float(os.environ.get("SESSION_TTL", 3600)),
+    max_tokens=int(os.environ.get("SESSION_MAX_TOKENS", 4000)),
+    max_bytes=int(float(os.environ.get("SESSION_MAX_MB", 256)) * 1024 * 1024),
+)
+
+# per stage latency histograms on /metrics when CHAT_METRICS=1 (see metrics.py)
+chat_metrics = metrics_from_env()
+
+
+# ASYNC_CHAT=1 serves the async pipeline (many more conversations per process)
+# (chat_async is an async generator, gradio runs them since 3.28, see requirements.txt)
+ASYNC_CHAT = os.environ.get("ASYNC_CHAT", "0") == "1"
+if ASYNC_CHAT:
+    from async_pipeline import (
+        reformulate_async,
+        retrieve_overlapped,
+        stream_completion_async,
+        stream_text_async,
     )
-    return passages
-
-
-def retrieve_with_summaries(
-    query,
-    retriever,
-    k_summary=3,
-    k_total=10,
-    source="ipcc",
-    max_k=100,
-    threshold=0.49,
-    as_dict=True,
-):
-    """
-    compare to retrieve_with_summaries, this function returns a dataframe with the content of the passages
-    """
-    assert max_k > k_total
-    docs = retriever.retrieve(query, top_k=max_k)
-    docs = [
-        {**x.meta, "score": x.score, "content": x.content}
-        for x in docs
-        if x.score > threshold
-    ]
-    if len(docs) == 0:
-        return []
-    res = pd.DataFrame(docs)
-    passages_df = filter_sources(res, k_summary, k_total, source)
-    if as_dict:
-        contents = passages_df["content"].tolist()
-        meta = passages_df.drop(columns=["content"]).to_dict(orient="records")
-        passages = []
-        for i in range(len(contents)):
-            passages.append({"content": contents[i], "meta": meta[i]})
-        return passages
-    else:
-        return passages_df
+
+# after this delay (seconds) the async pipeline answers with the raw query results
+REFORMULATION_TIMEOUT = float(os.environ.get("REFORMULATION_TIMEOUT", 3.0))
+
+# token budgets of the passages and of the history in the prompt, the passages are
+# deduplicated and ordered by MMR (see context_packing.py)
+CONTEXT_BUDGET = int(os.environ.get("CONTEXT_BUDGET", 2000))
+HISTORY_BUDGET = int(os.environ.get("HISTORY_BUDGET", 600))
+MMR_DIVERSITY = float(os.environ.get("MMR_DIVERSITY", 0.3))
+
+file_share_name = "loilibregpt"
+
+user_id = create_user_id(10)
+
+
+def source_title(meta):
+    """code and article number of a passage ("code_civil, article 1240"), "" if unknown"""
+    title = meta.get("code", "")
+    article = meta.get("article") or meta.get("reference")
+    if article:
+        title = f"{title}, article {article}" if title else f"article {article}"
+    return title
 
 
 def make_html_source(source, i):
@@ -162,66 +221,135 @@ def make_html_source(source, i):
     return f"""
 <div class="card">
     <div class="card-content">
-        <h2>Doc {i} - </h2>
+        <h2>Doc {i} - {source_title(meta)}</h2>
         <p>{source['content']}</p>
     </div>
     <div class="card-footer">
-        <span>link to code</span>
+        <span>{meta.get("path", "")}</span>
     </div>
 </div>
 """
 
 
+def format_sources(sources, reformulated_query):
+    """build the sources given to the model and the sources panel
+    Args:
+        sources (list): passages returned by retrieve_with_summaries
+        reformulated_query (str): query used for the retrieval
+    Returns:
+        tuple: sources for the prompt, sources html
+    """
+    docs_string = []
+    docs_html = []
+    for i, d in enumerate(sources, 1):
+        title = source_title(d["meta"])
+        title = f" ({title})" if title else ""
+        docs_string.append(f"📃 Doc {i}{title}: \n{d['content']}")
+        docs_html.append(make_html_source(d, i))
+    docs_string = "\n\n".join(
+        [f"Query used for retrieval:\n{reformulated_query}"] + docs_string
+    )
+    docs_html = "\n\n".join(
+        [f"Query used for retrieval:\n{reformulated_query}"] + docs_html
+    )
+    return docs_string, docs_html
+
+
 def chat(
     user_id: str,
     query: str,
-    history: list = [system_template],
+    session_id: str = None,
+    source: str = ALL_CODES,
     threshold: float = 0.49,
 ) -> tuple:
     """retrieve relevant documents in the document store then query gpt-turbo
     Args:
         query (str): user message.
-        history (list, optional): history of the conversation. Defaults to [system_template].
-        report_type (str, optional): should be "All available" or "IPCC only". Defaults to "All available".
+        session_id (str, optional): id of the conversation in the session store, a new one if None or expired. Defaults to None.
+        source (str, optional): code searched, or ALL_CODES. Defaults to ALL_CODES.
         threshold (float, optional): similarity threshold, don't increase more than 0.568. Defaults to 0.56.
     Yields:
-        tuple: chat gradio format, chat openai format, sources used.
+        tuple: chat gradio format, session id, sources used.
     """
-    reformulated_query = openai.Completion.create(
-        model="text-davinci-002",
-        prompt=get_reformulation_prompt(query),
-        temperature=0,
-        max_tokens=128,
-        stop=["\n---\n", "<|im_end|>"],
-    )
+    # waits for the end of the loading (LAZY_STARTUP=1)
+    retriever = startup.wait()
+
+    session_id = sessions.session(session_id)
+    trace = chat_metrics.start_request()
+    # the results of a filtered search are cached apart
+    namespace = source if code_filters(source) is not None else None
+    cached = query_cache.get_exact(query, namespace)
+    query_embedding = None
+
+    if cached is None:
+        if hasattr(retriever, "is_reference") and retriever.is_reference(query):
+            # exact article reference : no reformulation (see bm25.py)
+            reformulated_query = query
+            cached, query_embedding = query_cache.get_similar(query, namespace)
+        else:
+
+            def reformulate():
+                with trace.stage("reformulation"):
+                    response = openai.Completion.create(
+                        model="text-davinci-002",
+                        prompt=get_reformulation_prompt(query),
+                        temperature=0,
+                        max_tokens=128,
+                        stop=["\n---\n", "<|im_end|>"],
+                    )
+                return response["choices"][0]["text"]
+
+            reformulation = None
+            if OVERLAP_REFORMULATION:
+                reformulation = reformulation_executor.submit(reformulate)
+            cached, query_embedding = query_cache.get_similar(query, namespace)
+            if cached is None:
+                if reformulation is not None:
+                    reformulated_query = reformulation.result()
+                else:
+                    reformulated_query = reformulate()
+
+    if cached is not None:
+        # same (or very similar) query already answered : no reformulation, no retrieval
+        reformulated_query, keys = cached
+        sources = passages_from_keys(retriever, keys)
+    else:
+        sources = retrieve_with_summaries(
+            reformulated_query,
+            retriever,
+            k_total=10,
+            k_summary=3,
+            as_dict=True,
+            source=source,
+            threshold=threshold,
+            trace=trace,
+            # the embedding of the cache is reused if the query is unchanged
+            query_emb=query_embedding
+            if normalize_query(reformulated_query) == normalize_query(query)
+            else None,
+        )
+
+        query_cache.put(
+            query,
+            (reformulated_query, passage_keys(sources)),
+            query_embedding,
+            namespace,
+        )
 
-    reformulated_query = reformulated_query["choices"][0]["text"]
     language = "francais"
 
-    sources = retrieve_with_summaries(
-        reformulated_query,
-        retriever,
-        k_total=10,
-        k_summary=3,
-        as_dict=True,
-        threshold=threshold,
+    # docs = [d for d in retriever.retrieve(query=reformulated_query, top_k=10) if d.score > threshold]
+    # only the new turn comes with the request, the history is in the session store
+    messages = (
+        [system_template]
+        + sessions.messages(session_id)
+        + [{"role": "user", "content": query}]
     )
 
-    # docs = [d for d in retriever.retrieve(query=reformulated_query, top_k=10) if d.score > threshold]
-    messages = history + [{"role": "user", "content": query}]
+    sources = pack_passages(sources, CONTEXT_BUDGET, MMR_DIVERSITY)
 
     if len(sources) > 0:
-        docs_string = []
-        docs_html = []
-        for i, d in enumerate(sources, 1):
-            docs_string.append(f"📃 Doc {i}: \n{d['content']}")
-            docs_html.append(make_html_source(d, i))
-        docs_string = "\n\n".join(
-            [f"Query used for retrieval:\n{reformulated_query}"] + docs_string
-        )
-        docs_html = "\n\n".join(
-            [f"Query used for retrieval:\n{reformulated_query}"] + docs_html
-        )
+        docs_string, docs_html = format_sources(sources, reformulated_query)
         messages.append(
             {
                 "role": "system",
@@ -229,38 +357,175 @@ def chat(
             }
         )
 
+        with trace.stage("prompt"):
+            prompt = to_completion(truncate_history(messages, HISTORY_BUDGET))
+        trace.count_tokens("prompt", prompt)
+
         response = openai.Completion.create(
             model="text-davinci-002",
-            prompt=to_completion(messages),
+            prompt=prompt,
             temperature=0,  # deterministic
             stream=True,
             max_tokens=1024,
         )
 
         complete_response = ""
-        messages.pop()
 
-        messages.append({"role": "assistant", "content": complete_response})
-        timestamp = str(datetime.now().timestamp())
-        file = user_id[0] + timestamp + ".json"
+        # the pairs of the history do not change while the answer is streamed
+        history_pairs = sessions.pairs(session_id)
+
+        # the sources are sent once, then gr.update() leaves the panel unchanged
+        yield history_pairs + [(query, complete_response)], session_id, docs_html
+
+        def tokens():
+            for chunk in response:
+                if (
+                    chunk_message := chunk["choices"][0].get("text")
+                ) and chunk_message != "<|im_end|>":
+                    trace.token_received()
+                    yield chunk_message
+
+        for complete_response in stream_text(tokens()):
+            gradio_format = history_pairs + [(query, complete_response)]
+            yield gradio_format, session_id, gr.update()
 
-        for chunk in response:
-            if (
-                chunk_message := chunk["choices"][0].get("text")
-            ) and chunk_message != "<|im_end|>":
-                complete_response += chunk_message
-                messages[-1]["content"] = complete_response
-                gradio_format = make_pairs([a["content"] for a in messages[1:]])
-                yield gradio_format, messages, docs_html
+        sessions.append(session_id, query, complete_response)
+
+        trace.finish(
+            user_id=user_id[0], cache_hit=cached is not None, nb_sources=len(sources)
+        )
+
+    else:
+        docs_string = "Pas d'élements juridique trouvé dans les codes de loi"
+        complete_response = (
+            "**Pas d'élément trouvé dans les textes de loi. Préciser votre réponse**"
+        )
+        sessions.append(session_id, query, complete_response)
+        gradio_format = sessions.pairs(session_id)
+        trace.finish(user_id=user_id[0], cache_hit=cached is not None, nb_sources=0)
+        yield gradio_format, session_id, docs_string
+
+
+async def chat_async(
+    user_id: str,
+    query: str,
+    session_id: str = None,
+    source: str = ALL_CODES,
+    threshold: float = 0.49,
+):
+    """async version of chat (ASYNC_CHAT=1) : the reformulation and the retrieval on
+    the raw query run at the same time (see async_pipeline.py)
+    Yields:
+        tuple: chat gradio format, session id, sources used.
+    """
+    loop = asyncio.get_running_loop()
+    retriever = await loop.run_in_executor(None, startup.wait)
+
+    session_id = sessions.session(session_id)
+    trace = chat_metrics.start_request()
+    namespace = source if code_filters(source) is not None else None
+    cached = query_cache.get_exact(query, namespace)
+    query_embedding = None
+
+    if cached is None:
+        # the embedding of the semantic level is reused by the retrieval on the raw
+        # query, the reformulation starts after a miss (in retrieve_overlapped) unless
+        # OVERLAP_REFORMULATION=1
+        reformulation = None
+        if OVERLAP_REFORMULATION and not (
+            hasattr(retriever, "is_reference") and retriever.is_reference(query)
+        ):
+            reformulation = asyncio.ensure_future(
+                reformulate_async(get_reformulation_prompt(query))
+            )
+        cached, query_embedding = await loop.run_in_executor(
+            None, query_cache.get_similar, query, namespace
+        )
+        if cached is not None and reformulation is not None:
+            reformulation.cancel()
+
+    if cached is not None:
+        reformulated_query, keys = cached
+        sources = await loop.run_in_executor(
+            None, passages_from_keys, retriever, keys
+        )
+    else:
+        reformulated_query, documents = await retrieve_overlapped(
+            query,
+            get_reformulation_prompt(query),
+            retriever,
+            mode=os.environ.get("SPECULATIVE_MODE", "merge"),
+            reformulation_timeout=REFORMULATION_TIMEOUT,
+            trace=trace,
+            filters=code_filters(source),
+            query_emb=query_embedding,
+            reformulation=reformulation,
+        )
+        sources = select_passages(
+            documents,
+            k_summary=3,
+            k_total=10,
+            # the hybrid retrieval applies the threshold before the fusion
+            threshold=0.0 if hasattr(retriever, "bm25") else threshold,
+        )
+
+        query_cache.put(
+            query,
+            (reformulated_query, passage_keys(sources)),
+            query_embedding,
+            namespace,
+        )
+
+    language = "francais"
+
+    # only the new turn comes with the request, the history is in the session store
+    messages = (
+        [system_template]
+        + sessions.messages(session_id)
+        + [{"role": "user", "content": query}]
+    )
+
+    sources = pack_passages(sources, CONTEXT_BUDGET, MMR_DIVERSITY)
+
+    if len(sources) > 0:
+        docs_string, docs_html = format_sources(sources, reformulated_query)
+        messages.append(
+            {
+                "role": "system",
+                "content": f"{sources_prompt}\n\n{docs_string}\n\nAnswer in {language}:",
+            }
+        )
+        with trace.stage("prompt"):
+            prompt = to_completion(truncate_history(messages, HISTORY_BUDGET))
+        trace.count_tokens("prompt", prompt)
+
+        history_pairs = sessions.pairs(session_id)
+
+        complete_response = ""
+
+        yield history_pairs + [(query, complete_response)], session_id, docs_html
+
+        async for complete_response in stream_text_async(
+            stream_completion_async(prompt, trace=trace)
+        ):
+            gradio_format = history_pairs + [(query, complete_response)]
+            yield gradio_format, session_id, gr.update()
+
+        sessions.append(session_id, query, complete_response)
+
+        trace.finish(
+            user_id=user_id[0], cache_hit=cached is not None, nb_sources=len(sources)
+        )
 
     else:
         docs_string = "Pas d'élements juridique trouvé dans les codes de loi"
         complete_response = (
             "**Pas d'élément trouvé dans les textes de loi. Préciser votre réponse**"
         )
-        messages.append({"role": "assistant", "content": complete_response})
-        gradio_format = make_pairs([a["content"] for a in messages[1:]])
-        yield gradio_format, messages, docs_string
+        sessions.append(session_id, query, complete_response)
+        gradio_format = sessions.pairs(session_id)
+        trace.finish(user_id=user_id[0], cache_hit=cached is not None, nb_sources=0)
+        yield gradio_format, session_id, docs_string
 
 
 def save_feedback(feed: str, user_id):
@@ -279,6 +544,8 @@ def reset_textbox():
     return gr.update(value="")
 
 
+ui_start = time.time()
+
 with gr.Blocks(title="LoiLibre Q&A", css="style.css", theme=theme) as demo:
     user_id_state = gr.State([user_id])
 
@@ -291,7 +558,8 @@ with gr.Blocks(title="LoiLibre Q&A", css="style.css", theme=theme) as demo:
             chatbot = gr.Chatbot(
                 elem_id="chatbot", label="LoiLibreQ&A chatbot", show_label=False
             )
-            state = gr.State([system_template])
+            # id of the conversation in the session store (see session_store.py)
+            state = gr.State(None)
 
             with gr.Row():
                 ask = gr.Textbox(
@@ -300,6 +568,13 @@ with gr.Blocks(title="LoiLibre Q&A", css="style.css", theme=theme) as demo:
                 ).style(container=False)
                 ask_examples_hidden = gr.Textbox(elem_id="hidden-message")
 
+            source_dropdown = gr.Dropdown(
+                [ALL_CODES] + list_codes,
+                value=ALL_CODES,
+                label="Rechercher dans",
+                visible=len(list_codes) > 0,
+            )
+
             examples_questions = gr.Examples(
                 [
                     "Quelles sont les options légales pour une personne qui souhaite divorcer, notamment en matière de garde d'enfants et de pension alimentaire ?",
@@ -323,15 +598,15 @@ with gr.Blocks(title="LoiLibre Q&A", css="style.css", theme=theme) as demo:
         
 
     ask.submit(
-        fn=chat,
-        inputs=[user_id_state, ask, state],
+        fn=chat_async if ASYNC_CHAT else chat,
+        inputs=[user_id_state, ask, state, source_dropdown],
         outputs=[chatbot, state, sources_textbox],
     )
     ask.submit(reset_textbox, [], [ask])
 
     ask_examples_hidden.change(
-        fn=chat,
-        inputs=[user_id_state, ask_examples_hidden, state],
+        fn=chat_async if ASYNC_CHAT else chat,
+        inputs=[user_id_state, ask_examples_hidden, state, source_dropdown],
         outputs=[chatbot, state, sources_textbox],
     )
 
@@ -348,6 +623,14 @@ with gr.Blocks(title="LoiLibre Q&A", css="style.css", theme=theme) as demo:
                 
                 """)
 
-    demo.queue(concurrency_count=16)
+    demo.queue(
+        concurrency_count=int(
+            os.environ.get("CHAT_CONCURRENCY", 256 if ASYNC_CHAT else 16)
+        )
+    )
+
+startup.record("ui", ui_start, time.time())
 
-demo.launch(server_name="0.0.0.0")
+with startup.phase("server"):
+    demo.launch(server_name="0.0.0.0", prevent_thread_lock=True)
+demo.block_thread()
@@ -0,0 +1,202 @@
+"""
+ONNX (int8 quantized) query encoder for the sentence-transformers retriever.
+
+It needs the optional dependencies of requirements-onnx.txt (onnxruntime, onnx for
+the quantization, transformers for the tokenizer):
+    pip install -r ../requirements-onnx.txt
+
+The export is done once, offline (it needs torch):
+    python onnx_encoder.py --output onnx_query_encoder/
+it exports multi-qa-mpnet-base-dot-v1 to ONNX, applies the dynamic int8 quantization
+and checks that the embeddings stay close to the pytorch ones (cosine > 0.99).
+
+At serving time only onnxruntime and the tokenizer are loaded (see OnnxRetriever).
+"""
+
+import os
+import time
+import argparse
+
+import numpy as np
+
+MODEL_NAME = "sentence-transformers/multi-qa-mpnet-base-dot-v1"
+MAX_SEQ_LENGTH = 512
+
+ONNX_FILENAME = "model.onnx"
+ONNX_QUANTIZED_FILENAME = "model_int8.onnx"
+
+# held out queries for the parity check (not the gradio examples)
+PARITY_QUERIES = [
+    "Syndicaliste et entreprises",
+    "Quel est le délai de préavis pour quitter un logement loué vide ?",
+    "Un employeur peut-il licencier un salarié en arrêt maladie ?",
+    "Quelles sont les conditions pour adopter l'enfant de son conjoint ?",
+    "Combien de temps dure la garantie des vices cachés ?",
+    "Quelle est la peine encourue pour un vol avec violence ?",
+    "Qui hérite en l'absence de testament ?",
+    "Quelles sont les obligations du bailleur en matière de travaux ?",
+    "Comment se calcule l'indemnité de licenciement ?",
+    "Le mariage est-il possible entre cousins ?",
+    "Quelles sont les règles de l'usufruit sur un bien immobilier ?",
+    "Article L1234-5 du code du travail",
+]
+
+
+def export_onnx(output_path, model_name=MODEL_NAME):
+    """
+    Export the transformer of the model to ONNX and quantize it in int8.
+    The tokenizer is saved in the same folder.
+    """
+    import torch
+    from transformers import AutoModel, AutoTokenizer
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+
+    os.makedirs(output_path, exist_ok=True)
+
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    model = AutoModel.from_pretrained(model_name)
+    model.eval()
+
+    inputs = tokenizer(["exemple de question"], return_tensors="pt")
+
+    onnx_path = os.path.join(output_path, ONNX_FILENAME)
+    with torch.no_grad():
+        torch.onnx.export(
+            model,
+            (inputs["input_ids"], inputs["attention_mask"]),
+            onnx_path,
+            input_names=["input_ids", "attention_mask"],
+            output_names=["last_hidden_state"],
+            dynamic_axes={
+                "input_ids": {0: "batch", 1: "sequence"},
+                "attention_mask": {0: "batch", 1: "sequence"},
+                "last_hidden_state": {0: "batch", 1: "sequence"},
+            },
+            opset_version=14,
+        )
+
+    quantize_dynamic(
+        onnx_path,
+        os.path.join(output_path, ONNX_QUANTIZED_FILENAME),
+        weight_type=QuantType.QInt8,
+    )
+
+    tokenizer.save_pretrained(output_path)
+
+
+class OnnxQueryEncoder:
+    """
+    Encode the queries with the ONNX model (CLS pooling, as multi-qa-mpnet-base-dot-v1).
+
+    params:
+        path: str (folder of the export)
+        quantized: bool (use the int8 model)
+        num_threads: int (onnxruntime intra op threads, 0 for the default)
+    """
+
+    def __init__(self, path, quantized=True, num_threads=0):
+        import onnxruntime as ort
+        from transformers import AutoTokenizer
+
+        self.tokenizer = AutoTokenizer.from_pretrained(path)
+
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = num_threads
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+
+        filename = ONNX_QUANTIZED_FILENAME if quantized else ONNX_FILENAME
+        self.session = ort.InferenceSession(
+            os.path.join(path, filename),
+            sess_options=options,
+            providers=["CPUExecutionProvider"],
+        )
+
+    def encode(self, queries):
+        """
+        return:
+            embeddings: np.array (nb_queries, 768) float32
+        """
+        inputs = self.tokenizer(
+            queries,
+            padding=True,
+            truncation=True,
+            max_length=MAX_SEQ_LENGTH,
+            return_tensors="np",
+        )
+        last_hidden_state = self.session.run(
+            ["last_hidden_state"],
+            {
+                "input_ids": inputs["input_ids"].astype(np.int64),
+                "attention_mask": inputs["attention_mask"].astype(np.int64),
+            },
+        )[0]
+
+        return last_hidden_state[:, 0].astype(np.float32)
+
+
+class OnnxRetriever:
+    """
+    Same retrieve interface as the haystack EmbeddingRetriever, but the query is
+    embedded with the ONNX encoder (the pytorch model is never loaded).
+    """
+
+    def __init__(self, document_store, encoder, scale_score=True):
+        self.document_store = document_store
+        self.encoder = encoder
+        self.scale_score = scale_score
+
+    def embed_queries(self, queries):
+        return self.encoder.encode(queries)
+
+    def retrieve(self, query, top_k=10):
+        query_emb = self.embed_queries([query])[0]
+        return self.document_store.query_by_embedding(
+            query_emb=query_emb, top_k=top_k, scale_score=self.scale_score
+        )
+
+
+def parity_check(path, queries=PARITY_QUERIES, min_cosine=0.99, quantized=True):
+    """
+    Compare the ONNX embeddings with the pytorch ones on the queries.
+
+    return:
+        cosines: np.array (nb_queries,)
+    """
+    from sentence_transformers import SentenceTransformer
+
+    model = SentenceTransformer(MODEL_NAME)
+    encoder = OnnxQueryEncoder(path, quantized=quantized)
+
+    reference = model.encode(queries, convert_to_numpy=True)
+    embeddings = encoder.encode(queries)
+
+    cosines = np.sum(reference * embeddings, axis=1) / (
+        np.linalg.norm(reference, axis=1) * np.linalg.norm(embeddings, axis=1)
+    )
+    print(f"cosine min {cosines.min():.4f} mean {cosines.mean():.4f}")
+
+    # latency of one query (the serving case)
+    for name, encode in [
+        ("pytorch", lambda q: model.encode([q])),
+        ("onnx", lambda q: encoder.encode([q])),
+    ]:
+        durations = []
+        for query in queries:
+            start = time.perf_counter()
+            encode(query)
+            durations.append(time.perf_counter() - start)
+        print(f"{name} query latency p50 {np.median(durations) * 1000:.1f} ms")
+
+    assert cosines.min() > min_cosine, f"ONNX encoder diverges: min cosine {cosines.min()}"
+
+    return cosines
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output", default="onnx_query_encoder/")
+    parser.add_argument("--min-cosine", type=float, default=0.99)
+    args = parser.parse_args()
+
+    export_onnx(args.output)
+    parity_check(args.output, min_cosine=args.min_cosine)
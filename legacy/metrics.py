@@ -0,0 +1,276 @@
+"""
+Latency instrumentation of the chat path (shared by the two apps).
+
+Each chat request gets a trace which records the duration of the stages :
+- reformulation : openai call that reformulates the query
+- embedding / search : query embedding and faiss search of the retrieval
+- prompt : prompt assembly (to_completion)
+- first_token : time from the start of the request to the first token of the answer
+- streaming : time from the first token to the end of the answer
+- total
+and the number of tokens of the prompt and of the answer.
+
+The durations are aggregated in prometheus histograms, served in the prometheus text
+format on http://127.0.0.1:METRICS_PORT/metrics, and each trace can be written as
+one json line in CHAT_TRACE_LOG.
+
+CHAT_METRICS=1 enables it. When it is disabled, start_request returns NULL_TRACE
+whose methods do nothing, so the chat path only pays a few attribute lookups.
+"""
+
+import os
+import json
+import time
+import bisect
+import logging
+import threading
+from contextlib import contextmanager, nullcontext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+try:
+    import tiktoken
+
+    ENCODING = tiktoken.get_encoding("p50k_base")
+except Exception as error:
+    # the token budgets of context_packing.py are then only estimated
+    logging.getLogger(__name__).warning(
+        "tiktoken is not available (%s), the tokens are estimated as 4 characters "
+        "per token (see requirements.txt)",
+        error,
+    )
+    ENCODING = None
+
+STAGES = [
+    "reformulation",
+    "embedding",
+    "search",
+    "prompt",
+    "first_token",
+    "streaming",
+    "total",
+]
+
+# seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+TOKEN_BUCKETS = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096)
+
+
+def count_tokens(text):
+    """
+    Number of tokens of a text (tiktoken if available, else about 4 characters per token).
+    """
+    if ENCODING is not None:
+        return len(ENCODING.encode(text))
+    return len(text) // 4 + 1
+
+
+class Histogram:
+    """
+    Prometheus histogram with one label (one series per label value).
+    """
+
+    def __init__(self, name, documentation, buckets, label):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        self.label = label
+
+        # label value -> [bucket counts (last one is +Inf), sum]
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, label_value, value):
+        idx = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            if label_value not in self.series:
+                self.series[label_value] = [[0] * (len(self.buckets) + 1), 0.0]
+            series = self.series[label_value]
+            series[0][idx] += 1
+            series[1] += value
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} histogram",
+        ]
+        with self.lock:
+            for label_value, (counts, total) in sorted(self.series.items()):
+                label = f'{self.label}="{label_value}"'
+                cumulative = 0
+                for bound, count in zip(self.buckets + ("+Inf",), counts):
+                    cumulative += count
+                    lines.append(
+                        f'{self.name}_bucket{{{label},le="{bound}"}} {cumulative}'
+                    )
+                lines.append(f"{self.name}_sum{{{label}}} {total}")
+                lines.append(f"{self.name}_count{{{label}}} {cumulative}")
+        return "\n".join(lines)
+
+
+class RequestTrace:
+    """
+    Durations and token counts of one chat request.
+    """
+
+    enabled = True
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.start = time.perf_counter()
+        self.durations = {}
+        self.tokens = {}
+        self.first_token = None
+
+    def add(self, stage, seconds):
+        # a stage can run several times in a request (e.g. two retrievals)
+        self.durations[stage] = self.durations.get(stage, 0.0) + seconds
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def count_tokens(self, kind, text):
+        self.tokens[kind] = self.tokens.get(kind, 0) + count_tokens(text)
+
+    def token_received(self):
+        """
+        To call for each streamed token of the answer.
+        """
+        now = time.perf_counter()
+        if self.first_token is None:
+            self.first_token = now
+            self.durations["first_token"] = now - self.start
+        self.tokens["completion"] = self.tokens.get("completion", 0) + 1
+
+    def finish(self, **fields):
+        """
+        Record the trace (fields are only written in the trace log).
+        """
+        end = time.perf_counter()
+        if self.first_token is not None:
+            self.durations["streaming"] = end - self.first_token
+        self.durations["total"] = end - self.start
+        self.metrics.record(self, fields)
+
+
+class NullTrace:
+    """
+    Trace used when the metrics are disabled.
+    """
+
+    enabled = False
+
+    def add(self, stage, seconds):
+        pass
+
+    def stage(self, name):
+        return NULL_CONTEXT
+
+    def count_tokens(self, kind, text):
+        pass
+
+    def token_received(self):
+        pass
+
+    def finish(self, **fields):
+        pass
+
+
+NULL_CONTEXT = nullcontext()
+NULL_TRACE = NullTrace()
+
+
+class ChatMetrics:
+    """
+    params:
+        enabled: bool
+        trace_log: str (path of the json lines trace log, None for no log)
+    """
+
+    def __init__(self, enabled=False, trace_log=None):
+        self.enabled = enabled
+        self.trace_log = trace_log
+        self.log_lock = threading.Lock()
+
+        self.latency = Histogram(
+            "loilibre_chat_stage_seconds",
+            "Duration of the stages of a chat request.",
+            LATENCY_BUCKETS,
+            "stage",
+        )
+        self.tokens = Histogram(
+            "loilibre_chat_tokens",
+            "Number of tokens of the prompt and of the answer.",
+            TOKEN_BUCKETS,
+            "kind",
+        )
+
+    def start_request(self):
+        if not self.enabled:
+            return NULL_TRACE
+        return RequestTrace(self)
+
+    def record(self, trace, fields):
+        for stage, seconds in trace.durations.items():
+            self.latency.observe(stage, seconds)
+        for kind, nb_tokens in trace.tokens.items():
+            self.tokens.observe(kind, nb_tokens)
+
+        if self.trace_log is not None:
+            line = json.dumps(
+                {
+                    "time": time.time(),
+                    **fields,
+                    "durations": trace.durations,
+                    "tokens": trace.tokens,
+                },
+                ensure_ascii=False,
+            )
+            with self.log_lock, open(self.trace_log, "a") as handle:
+                handle.write(line + "\n")
+
+    def render(self):
+        return self.latency.render() + "\n" + self.tokens.render() + "\n"
+
+    def serve(self, port=9100, host="127.0.0.1"):
+        """
+        Serve /metrics in a daemon thread.
+        """
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+def metrics_from_env():
+    """
+    ChatMetrics configured with CHAT_METRICS, METRICS_PORT and CHAT_TRACE_LOG.
+    """
+    metrics = ChatMetrics(
+        enabled=os.environ.get("CHAT_METRICS", "0") == "1",
+        trace_log=os.environ.get("CHAT_TRACE_LOG"),
+    )
+    if metrics.enabled:
+        metrics.serve(int(os.environ.get("METRICS_PORT", 9100)))
+    return metrics
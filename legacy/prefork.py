@@ -0,0 +1,223 @@
+"""
+Preforked embedding workers for the sentence transformers app.
+
+The gradio app is one python process : the query embedding (tokenizer + model) of
+all the users runs under the same GIL. With PREFORK_WORKERS=N, N worker processes
+compute the query embeddings. The app process keeps the gradio server (one port), the
+openai calls, the document store and the faiss search (faiss releases the GIL).
+
+RetrievalPool has the same methods as the retriever (embed_queries, retrieve,
+document_store, scale_score), so the chat code does not change.
+
+The workers are forked when the pool is created, which must happen before the app
+process starts a thread or a thread pool : the torch / onnxruntime / openmp thread
+pools and the threads of the app (LAZY_STARTUP loading, readiness probe) do not
+survive a fork. The spawn and forkserver start methods are not an option : their
+workers import the __main__ module again, that is the whole app.
+
+With preload=True (pytorch encoder), the pool loads the encoder in the app process
+before forking, with torch limited to one thread during the load (so no thread pool
+exists at the fork), and the workers inherit it : the weights are in tensor buffers
+that the inference only reads, so their pages stay shared (copy on write) and the RAM
+of the model is not multiplied by N. The app process waits for this load before
+binding its server.
+
+With preload=False (onnx encoder : an onnxruntime session starts its thread pools
+when it is created), each worker creates its own encoder after the fork, at the
+warm-up : the RAM of the model is multiplied by N (the int8 export is about 4 times
+smaller than the pytorch model).
+
+Only the query embedding runs in the workers : the document store, the faiss search
+and the BM25 fusion stay in the app process.
+
+benchmark (queries / second with 16 threads sending queries):
+    python prefork.py --index faiss_index.index --config faiss_config.json --workers 0,2,4
+"""
+
+import os
+import time
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+# query encoder of a worker (see _embed_queries), inherited from the app process with
+# preload
+_encoder = None
+_load_encoder = None
+_warmup_barrier = None
+
+
+def _set_torch_threads(nb_threads):
+    """
+    Set the number of torch threads and return the previous one (None without torch).
+    """
+    try:
+        import torch
+    except ImportError:
+        return None
+
+    previous = torch.get_num_threads()
+    torch.set_num_threads(nb_threads)
+    return previous
+
+
+def _init_worker(load_encoder, threads_per_worker, warmup_barrier):
+    global _load_encoder, _warmup_barrier
+    _load_encoder = load_encoder
+    _warmup_barrier = warmup_barrier
+
+    # N workers x all the cores would oversubscribe the cpu
+    _set_torch_threads(threads_per_worker)
+
+
+def _embed_queries(queries):
+    global _encoder
+    if _encoder is None:
+        _encoder = _load_encoder()
+    return _encoder.embed_queries(queries)
+
+
+def _warmup(query):
+    _embed_queries([query])
+    # a worker that has run its warm-up waits for the others, so each of the N
+    # warm-up tasks runs in a different worker
+    _warmup_barrier.wait()
+    return os.getpid()
+
+
+class RetrievalPool:
+    """
+    params:
+        load_encoder: function without parameter that loads the query encoder
+            (EmbeddingRetriever, onnx_encoder.OnnxRetriever, only its embed_queries is
+            used)
+        nb_workers: int (number of forked workers)
+        threads_per_worker: int (torch threads of each worker)
+        scale_score: bool (as the scale_score of the retriever)
+        preload: bool (load the encoder once in the app process, shared by the
+            workers, else each worker loads its own)
+
+    The document store is given once loaded, with set_document_store.
+    """
+
+    def __init__(
+        self,
+        load_encoder,
+        nb_workers,
+        threads_per_worker=1,
+        scale_score=True,
+        preload=True,
+    ):
+        global _encoder
+        self.document_store = None
+        self.scale_score = scale_score
+        self.nb_workers = nb_workers
+
+        if preload:
+            previous_threads = _set_torch_threads(1)
+            _encoder = load_encoder()
+
+        context = multiprocessing.get_context("fork")
+        self.executor = ProcessPoolExecutor(
+            nb_workers,
+            mp_context=context,
+            initializer=_init_worker,
+            initargs=(load_encoder, threads_per_worker, context.Barrier(nb_workers)),
+        )
+        # with the fork start method, the first submit forks all the workers (without
+        # waiting for them)
+        self.executor.submit(os.getpid)
+
+        if preload:
+            # the workers are forked, the app process no longer needs the encoder
+            _encoder = None
+            if previous_threads is not None:
+                _set_torch_threads(previous_threads)
+
+    def set_document_store(self, document_store):
+        self.document_store = document_store
+
+    def embed_queries(self, queries):
+        return self.executor.submit(_embed_queries, list(queries)).result()
+
+    def retrieve(self, query, top_k=10):
+        query_emb = self.embed_queries([query])[0]
+        return self.document_store.query_by_embedding(
+            query_emb, top_k=top_k, scale_score=self.scale_score
+        )
+
+    def warmup(self, query):
+        """
+        Load the encoder (without preload) and embed the query in each worker.
+
+        return:
+            pids: list of int (the pid of each worker)
+        """
+        futures = [self.executor.submit(_warmup, query) for _ in range(self.nb_workers)]
+        return [future.result() for future in futures]
+
+    def shutdown(self):
+        self.executor.shutdown()
+
+
+def throughput(retriever, queries, nb_threads=16):
+    """
+    Queries / second of retriever.retrieve with nb_threads concurrent callers.
+    """
+    start = time.perf_counter()
+    with ThreadPoolExecutor(nb_threads) as executor:
+        list(executor.map(lambda query: retriever.retrieve(query, top_k=100), queries))
+    return len(queries) / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--index", default="faiss_index.index")
+    parser.add_argument("--config", default="faiss_config.json")
+    parser.add_argument("--workers", default=f"0,2,{os.cpu_count()}")
+    parser.add_argument("--nb-queries", type=int, default=512)
+    parser.add_argument("--threads", type=int, default=16)
+    args = parser.parse_args()
+
+    def load_encoder(document_store=None):
+        from haystack.nodes import EmbeddingRetriever
+
+        return EmbeddingRetriever(
+            document_store=document_store,
+            embedding_model="sentence-transformers/multi-qa-mpnet-base-dot-v1",
+            model_format="sentence_transformers",
+            progress_bar=False,
+        )
+
+    # all the pools are forked first, before any model, index or thread
+    pools = {
+        nb_workers: RetrievalPool(load_encoder, nb_workers)
+        for nb_workers in [int(n) for n in args.workers.split(",")]
+        if nb_workers > 0
+    }
+
+    from haystack.document_stores import FAISSDocumentStore
+
+    document_store = FAISSDocumentStore.load(
+        index_path=args.index, config_path=args.config
+    )
+
+    queries = [
+        f"Question {i} : durée du préavis de licenciement d'un salarié"
+        for i in range(args.nb_queries)
+    ]
+
+    for nb_workers, pool in pools.items():
+        pool.set_document_store(document_store)
+        pool.warmup(queries[0])
+        print(
+            f"{nb_workers} workers: {throughput(pool, queries, args.threads):.1f} queries / s"
+        )
+        pool.shutdown()
+
+    if 0 in [int(n) for n in args.workers.split(",")]:
+        retriever = load_encoder(document_store)
+        retriever.retrieve(queries[0])
+        print(
+            f"no worker: {throughput(retriever, queries, args.threads):.1f} queries / s"
+        )
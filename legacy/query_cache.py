@@ -0,0 +1,225 @@
+"""
+Cache of the query reformulation and of the retrieved passages (shared by the two apps).
+
+Two levels :
+- exact match : LRU on the normalized text of the query
+- semantic : if the embedding of a new query is close enough (cosine) to the embedding
+  of a cached query, the cached result is used
+A cache hit skips the reformulation call and the retrieval. The embedding of the
+query computed for the semantic level is given back, so that the retrieval of a miss
+can reuse it.
+
+The entries expire after ttl seconds (checked when an entry is looked up, an expired
+entry is removed then, or evicted as any other entry) and the least recently used
+entry is evicted when the cache is full. The hits and misses are counted (see stats).
+
+The results of a search restricted to a code are cached in the namespace of the code :
+a query only hits the entries of its namespace.
+"""
+
+import re
+import time
+import threading
+import unicodedata
+from collections import OrderedDict
+
+import numpy as np
+
+
+def normalize_query(query):
+    """
+    Lower case, no accents, no punctuation and single spaces.
+    """
+    query = unicodedata.normalize("NFKD", query.lower())
+    query = "".join(c for c in query if not unicodedata.combining(c))
+    query = re.sub(r"[^\w\s-]", " ", query)
+    return " ".join(query.split())
+
+
+class QueryCache:
+    """
+    params:
+        max_size: int (maximum number of entries)
+        ttl: float (time to live of an entry in seconds)
+        semantic_threshold: float (minimum cosine for a semantic hit, None to disable
+            the semantic level)
+        embed: function str -> np.array (embedding of a query, for the semantic level,
+            None to skip the semantic level for this query)
+    """
+
+    def __init__(
+        self, max_size=1024, ttl=24 * 3600, semantic_threshold=0.95, embed=None
+    ):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.semantic_threshold = semantic_threshold
+        self.embed = embed if semantic_threshold is not None else None
+
+        # key -> (value, expiration time, slot in the embedding matrix)
+        self.entries = OrderedDict()
+
+        # normalized embeddings of the entries, one row (slot) per entry
+        self.embeddings = None
+        self.slot_keys = [None] * max_size
+        self.slot_namespaces = np.full(max_size, None, dtype=object)
+        self.slot_used = np.zeros(max_size, dtype=bool)
+        self.slot_expirations = np.zeros(max_size)
+        self.free_slots = list(range(max_size - 1, -1, -1))
+
+        self.lock = threading.Lock()
+        self.counters = {"exact_hits": 0, "semantic_hits": 0, "misses": 0}
+
+    def _remove(self, key):
+        _, _, slot = self.entries.pop(key)
+        if slot is not None:
+            self.slot_keys[slot] = None
+            self.slot_used[slot] = False
+            self.free_slots.append(slot)
+
+    def _live_entry(self, key, now):
+        """
+        Entry of key, None if there is none or if it has expired (then it is removed).
+        """
+        entry = self.entries.get(key)
+        if entry is not None and entry[1] <= now:
+            self._remove(key)
+            return None
+        return entry
+
+    def _semantic_lookup(self, embedding, namespace, now):
+        if self.embeddings is None or len(self.entries) == 0:
+            return None
+
+        similarities = self.embeddings @ embedding
+        similarities[
+            ~self.slot_used
+            | (self.slot_namespaces != namespace)
+            | (self.slot_expirations <= now)
+        ] = -np.inf
+
+        slot = int(np.argmax(similarities))
+        if similarities[slot] >= self.semantic_threshold:
+            return self.slot_keys[slot]
+
+        return None
+
+    def get_exact(self, query, namespace=None):
+        """
+        Exact level only (no embedding).
+
+        return:
+            value: the cached value or None
+        """
+        key = (namespace, normalize_query(query))
+        now = time.monotonic()
+
+        with self.lock:
+            entry = self._live_entry(key, now)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.counters["exact_hits"] += 1
+                return entry[0]
+
+        return None
+
+    def get_similar(self, query, namespace=None, embedding=None):
+        """
+        Semantic level, after a miss of get_exact.
+
+        params:
+            query: str
+            namespace: str
+            embedding: np.array (embedding of the query), None to compute it with embed
+
+        return:
+            value: the cached value or None
+            embedding: the embedding of the query (None if not computed), to give
+                back to put after a miss, or to reuse for the retrieval of the query
+        """
+        if embedding is None and self.embed is not None:
+            embedding = self.embed(query)
+
+        if embedding is None or self.semantic_threshold is None:
+            # no embedding for this query, only the exact level
+            with self.lock:
+                self.counters["misses"] += 1
+            return None, embedding
+
+        normalized = np.asarray(embedding, dtype=np.float32)
+        normalized = normalized / (np.linalg.norm(normalized) + 1e-12)
+
+        now = time.monotonic()
+
+        with self.lock:
+            similar_key = self._semantic_lookup(normalized, namespace, now)
+
+            if similar_key is not None and similar_key in self.entries:
+                self.entries.move_to_end(similar_key)
+                self.counters["semantic_hits"] += 1
+                return self.entries[similar_key][0], embedding
+
+            self.counters["misses"] += 1
+
+        return None, embedding
+
+    def get(self, query, namespace=None):
+        """
+        Look up a query (get_exact, then get_similar).
+
+        params:
+            query: str
+            namespace: str (ex the code of a filtered search), None for the default one
+
+        return:
+            value: the cached value or None
+            embedding: the embedding of the query (None if not computed), to give
+                back to put after a miss
+        """
+        value = self.get_exact(query, namespace)
+        if value is not None:
+            return value, None
+        return self.get_similar(query, namespace)
+
+    def put(self, query, value, embedding=None, namespace=None):
+        """
+        Add the result of a query (embedding as returned by get).
+        """
+        if embedding is not None:
+            embedding = np.asarray(embedding, dtype=np.float32)
+            embedding = embedding / (np.linalg.norm(embedding) + 1e-12)
+
+        key = (namespace, normalize_query(query))
+        now = time.monotonic()
+
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+
+            while len(self.entries) >= self.max_size:
+                # least recently used entry
+                self._remove(next(iter(self.entries)))
+
+            slot = None
+            if embedding is not None:
+                if self.embeddings is None:
+                    self.embeddings = np.zeros(
+                        (self.max_size, len(embedding)), dtype=np.float32
+                    )
+                slot = self.free_slots.pop()
+                self.embeddings[slot] = embedding
+                self.slot_keys[slot] = key
+                self.slot_namespaces[slot] = namespace
+                self.slot_used[slot] = True
+                self.slot_expirations[slot] = now + self.ttl
+
+            self.entries[key] = (value, now + self.ttl, slot)
+
+    def stats(self):
+        with self.lock:
+            lookups = sum(self.counters.values())
+            hits = self.counters["exact_hits"] + self.counters["semantic_hits"]
+            return {
+                **self.counters,
+                "size": len(self.entries),
+                "hit_rate": hits / lookups if lookups else 0.0,
+            }
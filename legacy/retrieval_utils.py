@@ -0,0 +1,365 @@
+"""
+Post processing of the retrieved documents (shared by the two apps).
+
+The documents returned by the retriever are kept as they are (the document table)
+next to a numpy array of their scores : the threshold filtering and the top k
+selection are done on the score array, without building any DataFrame.
+
+retrieve_with_summaries retrieves the passages of one query (chat of the two apps),
+retrieve_batch the passages of many queries at once (offline evaluation, bulk jobs) :
+one embedding call and one faiss search for a batch of queries.
+
+The searches can be restricted to some codes (meta "code" of the documents, see
+scripts/preprocess_code.py) with filters={"code": [...]} : the serving store searches
+only the vectors of these codes, FAISSDocumentStore ignores the filters so its hits
+are filtered after a larger search.
+"""
+
+import os
+import copy
+import json
+
+import numpy as np
+
+from metrics import NULL_TRACE
+
+# choice of the ui for no code filter
+ALL_CODES = "Tous les codes"
+
+# FAISSDocumentStore with filters : number of hits searched per returned document
+FILTER_OVERSAMPLING = 10
+
+
+class RetrievalResult:
+    """
+    Documents returned by the retriever and their scores.
+
+    params:
+        documents: list of haystack Document (in the retriever order)
+    """
+
+    def __init__(self, documents):
+        self.documents = documents
+        self.scores = np.fromiter(
+            (document.score for document in documents),
+            dtype=np.float64,
+            count=len(documents),
+        )
+
+    def __len__(self):
+        return len(self.documents)
+
+    def top_k(self, k, threshold):
+        """
+        Indices of the k best documents with a score above threshold, best first.
+        """
+        idx = np.flatnonzero(self.scores > threshold)
+
+        if len(idx) > k:
+            idx = idx[np.argpartition(-self.scores[idx], k - 1)[:k]]
+
+        # best score first, the retriever order breaks the ties
+        return idx[np.lexsort((idx, -self.scores[idx]))]
+
+    def passage(self, i):
+        document = self.documents[i]
+        return {
+            "content": document.content,
+            "meta": {**document.meta, "score": document.score},
+        }
+
+
+def select_passages(documents, k_summary=3, k_total=10, threshold=0.49, as_dict=True):
+    """
+    Select the passages sent to the model from the retrieved documents.
+
+    As before, the k_summary best passages come first, followed by the
+    k_total - k_summary best passages (the best ones are given twice).
+
+    params:
+        documents: list of haystack Document (or RetrievalResult)
+        k_summary: int
+        k_total: int
+        threshold: float (minimum score of a passage)
+        as_dict: bool (return a list of dict, else a DataFrame)
+
+    return:
+        passages: list of {"content": str, "meta": dict} (meta includes the score)
+    """
+    if not isinstance(documents, RetrievalResult):
+        documents = RetrievalResult(documents)
+
+    best = documents.top_k(k_total, threshold)
+    if len(best) == 0:
+        return []
+
+    summaries = best[:k_summary]
+    selected = np.concatenate([summaries, best[: k_total - len(summaries)]])
+
+    passages = [documents.passage(i) for i in selected]
+
+    if as_dict:
+        return passages
+
+    import pandas as pd
+
+    return pd.DataFrame([{**p["meta"], "content": p["content"]} for p in passages])
+
+
+# meta of the passages that depend on the query (the rest is read from the stores)
+SCORE_KEYS = ("score", "dense_score", "bm25_score")
+
+
+def passage_keys(passages):
+    """
+    Compact form of passages for the query cache : the vector id (or the bm25 row,
+    see bm25.HybridRetriever) and the scores of each passage, without the content.
+
+    return:
+        keys: list of (vector_id, bm25_row, scores) (-1 for no vector id / bm25 row)
+    """
+    keys = []
+    for passage in passages:
+        meta = passage["meta"]
+        if "vector_id" in meta:
+            vector_id, bm25_row = int(meta["vector_id"]), -1
+        else:
+            vector_id, bm25_row = -1, int(meta["bm25_row"])
+        keys.append(
+            (vector_id, bm25_row, {key: meta[key] for key in SCORE_KEYS if key in meta})
+        )
+    return keys
+
+
+def passages_from_keys(retriever, keys):
+    """
+    Passages of passage_keys, with the content and the meta of the stores.
+    """
+    vector_ids = sorted({vector_id for vector_id, _, _ in keys if vector_id >= 0})
+    documents = {}
+    if len(vector_ids) > 0:
+        for document in retriever.document_store.get_documents_by_vector_ids(
+            [str(vector_id) for vector_id in vector_ids]
+        ):
+            documents[int(document.meta["vector_id"])] = document
+
+    passages = []
+    for vector_id, bm25_row, scores in keys:
+        if vector_id >= 0:
+            document = documents[vector_id]
+        else:
+            document = retriever.bm25_document(bm25_row, scores.get("bm25_score"))
+        passages.append(
+            {"content": document.content, "meta": {**document.meta, **scores}}
+        )
+    return passages
+
+
+def embed_query(retriever, query):
+    """
+    Embedding of one query, None when the retriever does not need it (exact
+    reference with bm25.HybridRetriever).
+    """
+    if hasattr(retriever, "embed_query"):
+        return retriever.embed_query(query)
+    return retriever.embed_queries([query])[0]
+
+
+def code_filters(source):
+    """
+    Filters of a search restricted to the code source, None for all the codes.
+    """
+    if not source or source == ALL_CODES:
+        return None
+    return {"code": [source]}
+
+
+def store_codes(path):
+    """
+    Codes of a serving store (codes/codes.json, see serving_store.py), read without
+    loading the store. [] when there is no serving store or no code index.
+    """
+    if not path or not os.path.exists(os.path.join(path, "codes", "codes.json")):
+        return []
+    with open(os.path.join(path, "codes", "codes.json"), "r") as handle:
+        return sorted(json.load(handle))
+
+
+def query_by_embedding(
+    document_store, query_emb, top_k=100, scale_score=True, filters=None
+):
+    """
+    Search of one query (see query_by_embedding_batch).
+    """
+    if filters is None:
+        return document_store.query_by_embedding(
+            query_emb, top_k=top_k, scale_score=scale_score
+        )
+    return query_by_embedding_batch(
+        document_store, [query_emb], top_k, scale_score, filters
+    )[0]
+
+
+def query_by_embedding_batch(
+    document_store, query_embs, top_k=100, scale_score=True, filters=None
+):
+    """
+    Search the documents of many queries with one faiss search.
+
+    The haystack document stores loop over query_by_embedding, here the query matrix
+    is searched at once and the documents are fetched once for all the queries.
+
+    params:
+        document_store: FAISSDocumentStore or serving_store.MmapDocumentStore
+        query_embs: np.array (nb_queries, dim)
+        top_k: int
+        scale_score: bool (same scaling as query_by_embedding)
+        filters: dict ({"code": [...]}, see code_filters), None for no filter
+
+    return:
+        documents: list (one per query) of list of Document (best first)
+    """
+    if not hasattr(document_store, "faiss_indexes"):
+        # the serving store has its own batched (and filtered) search
+        return document_store.query_by_embedding_batch(
+            query_embs, filters=filters, top_k=top_k, scale_score=scale_score
+        )
+
+    codes = None
+    if filters is not None:
+        # no filtered search in FAISSDocumentStore
+        codes = set(filters["code"])
+        top_k, max_k = top_k * FILTER_OVERSAMPLING, top_k
+
+    query_embs = np.array(query_embs, dtype=np.float32, ndmin=2)
+    if document_store.similarity == "cosine":
+        document_store.normalize_embedding(query_embs)
+
+    scores, vector_ids = document_store.faiss_indexes[document_store.index].search(
+        query_embs, top_k
+    )
+
+    # one sql query per chunk of vector ids instead of one per query
+    # (get_documents_by_vector_ids sorts its output with list.index, so the chunks
+    # stay small)
+    unique_ids = [
+        str(vector_id) for vector_id in np.unique(vector_ids[vector_ids != -1])
+    ]
+    documents = {}
+    for start in range(0, len(unique_ids), 1000):
+        for document in document_store.get_documents_by_vector_ids(
+            unique_ids[start : start + 1000]
+        ):
+            documents[document.meta["vector_id"]] = document
+
+    results = []
+    for query_scores, query_vector_ids in zip(scores, vector_ids):
+        query_documents = []
+        for score, vector_id in zip(query_scores, query_vector_ids):
+            if str(vector_id) not in documents:
+                continue
+            document = documents[str(vector_id)]
+            if codes is not None and document.meta.get("code") not in codes:
+                continue
+            # the same document can be retrieved by several queries
+            document = copy.copy(document)
+            document.score = (
+                document_store.scale_to_unit_interval(
+                    float(score), document_store.similarity
+                )
+                if scale_score
+                else float(score)
+            )
+            query_documents.append(document)
+        results.append(query_documents if codes is None else query_documents[:max_k])
+
+    return results
+
+
+def retrieve_with_summaries(
+    query,
+    retriever,
+    k_summary=3,
+    k_total=10,
+    source=ALL_CODES,
+    max_k=100,
+    threshold=0.49,
+    as_dict=True,
+    trace=NULL_TRACE,
+    query_emb=None,
+):
+    """
+    Retrieve max_k documents then select the passages (see select_passages).
+    source restricts the search to the documents of one code, query_emb is the
+    embedding of the query when it is already computed (see retrieve_batch for many
+    queries).
+    """
+    assert max_k > k_total
+    filters = code_filters(source)
+    if hasattr(retriever, "bm25"):
+        # hybrid retrieval : the dense threshold is applied before the fusion
+        docs = retriever.retrieve(
+            query, top_k=max_k, trace=trace, filters=filters, query_emb=query_emb
+        )
+        return select_passages(docs, k_summary, k_total, 0.0, as_dict)
+
+    # same as retriever.retrieve, in two steps for the metrics
+    if query_emb is None:
+        with trace.stage("embedding"):
+            query_emb = retriever.embed_queries([query])[0]
+    with trace.stage("search"):
+        docs = query_by_embedding(
+            retriever.document_store,
+            query_emb,
+            max_k,
+            retriever.scale_score,
+            filters,
+        )
+    return select_passages(docs, k_summary, k_total, threshold, as_dict)
+
+
+def retrieve_batch(
+    queries,
+    retriever,
+    top_k=100,
+    threshold=0.49,
+    k_summary=3,
+    k_total=10,
+    batch_size=256,
+    as_dict=True,
+):
+    """
+    Batched version of retrieve_with_summaries (same passages, no code filter, no
+    hybrid retriever) : the queries are embedded batch_size
+    at a time (one forward pass or one embedding api call) and each batch is searched
+    with one faiss search.
+
+    params:
+        queries: list of str
+        retriever: retriever with an embed_queries method (EmbeddingRetriever,
+            onnx_encoder.OnnxRetriever)
+        top_k: int (number of documents retrieved per query, max_k of
+            retrieve_with_summaries)
+        threshold: float (minimum score of a passage)
+        k_summary: int
+        k_total: int
+        batch_size: int (number of queries embedded and searched at once)
+        as_dict: bool (see select_passages)
+
+    return:
+        passages: list (one per query) of passages, as retrieve_with_summaries
+    """
+    assert top_k > k_total
+    scale_score = getattr(retriever, "scale_score", True)
+
+    results = []
+    for start in range(0, len(queries), batch_size):
+        query_embs = retriever.embed_queries(list(queries[start : start + batch_size]))
+        for documents in query_by_embedding_batch(
+            retriever.document_store, query_embs, top_k, scale_score
+        ):
+            results.append(
+                select_passages(documents, k_summary, k_total, threshold, as_dict)
+            )
+
+    return results
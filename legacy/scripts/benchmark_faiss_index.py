@@ -0,0 +1,251 @@
+"""
+Benchmark of the faiss index types : recall@10 against the flat (exact) index and
+query latency (p50 / p99, one query at a time as in the apps).
+
+usage:
+    python benchmark_faiss_index.py --embeddings ../embeddings_checkpoint/embeddings.npy
+    python benchmark_faiss_index.py --embeddings ../embeddings.pickle \
+        --config "IVF1024,Flat|nprobe=16" --config "HNSW32|efSearch=128"
+
+Without --queries, the queries are corpus vectors with some gaussian noise.
+
+A config can start with a reduction of the dimension ("pca256:Flat",
+"opq384:IVF1024,PQ64|nprobe=32", see faiss_index.py), and --reduction pca
+--reduced-dim 256 --reduced-dim 512 adds the reduced version of every config. The
+results end with a size / latency / recall table (pareto optimal configs marked *):
+    python benchmark_faiss_index.py --embeddings ../corpus/embeddings/openai.npy \
+        --reduction pca --reduced-dim 256 --reduced-dim 384 --reduced-dim 512
+"""
+
+import re
+import time
+import json
+import pickle
+import argparse
+
+import numpy as np
+
+import faiss
+
+from faiss_index import create_faiss_index, REDUCTIONS
+
+DEFAULT_CONFIGS = [
+    "Flat",
+    "IVF1024,Flat|nprobe=8",
+    "IVF1024,Flat|nprobe=32",
+    "HNSW32|efSearch=64",
+    "HNSW32|efSearch=128",
+    "IVF1024,PQ64|nprobe=32",
+]
+
+
+def load_embedding_matrix(path):
+    """
+    Load an embedding matrix from a .npy (memory mapped) or a .pickle file.
+    """
+    if path.endswith(".npy"):
+        return np.load(path, mmap_mode="r")
+
+    with open(path, "rb") as handle:
+        return np.asarray(pickle.load(handle), dtype=np.float32)
+
+
+def make_queries(embeddings, nb_queries=1000, noise=0.1, seed=0):
+    """
+    Queries close to corpus vectors (when no real query embeddings are available).
+    """
+    rng = np.random.default_rng(seed)
+    idx = rng.choice(
+        len(embeddings), size=min(nb_queries, len(embeddings)), replace=False
+    )
+    queries = np.asarray(embeddings[np.sort(idx)], dtype=np.float32)
+    scale = (
+        noise
+        * np.linalg.norm(queries, axis=1, keepdims=True)
+        / np.sqrt(queries.shape[1])
+    )
+    return np.ascontiguousarray(
+        queries + scale * rng.standard_normal(queries.shape).astype(np.float32)
+    )
+
+
+def recall_at_k(ids, ground_truth, k=10):
+    """
+    Mean fraction of the exact top k found in the top k of the index.
+    """
+    hits = [len(set(ids[i, :k]) & set(ground_truth[i, :k])) for i in range(len(ids))]
+    return float(np.mean(hits)) / k
+
+
+def latency_stats(durations):
+    """
+    p50 / p99 of a list of durations in seconds, returned in milliseconds.
+    """
+    durations = np.asarray(durations) * 1000
+    return {
+        "p50_ms": float(np.percentile(durations, 50)),
+        "p99_ms": float(np.percentile(durations, 99)),
+    }
+
+
+def search_one_by_one(index, queries, k):
+    """
+    Search the queries one at a time, return the ids and the durations.
+    """
+    ids = np.empty((len(queries), k), dtype=np.int64)
+    durations = []
+    for i in range(len(queries)):
+        start = time.perf_counter()
+        _, ids[i] = index.search(queries[i : i + 1], k)
+        durations.append(time.perf_counter() - start)
+
+    return ids, durations
+
+
+REDUCTION_REGEX = re.compile(r"^(" + "|".join(REDUCTIONS) + r")(\d+):")
+
+
+def parse_config(config):
+    """
+    "pca256:IVF1024,Flat|nprobe=16" -> ("pca", 256, "IVF1024,Flat", "nprobe=16")
+    """
+    reduction, reduced_dim = None, None
+    match = REDUCTION_REGEX.match(config)
+    if match:
+        reduction, reduced_dim = match.group(1), int(match.group(2))
+        config = config[match.end() :]
+
+    index_factory, _, search_params = config.partition("|")
+    return reduction, reduced_dim, index_factory, search_params or None
+
+
+def reduced_configs(configs, reduction, reduced_dims):
+    """
+    The configs and their reduced versions for each dimension.
+    """
+    if reduction is None:
+        return configs
+    return configs + [
+        f"{reduction}{dim}:{config}"
+        for dim in reduced_dims
+        for config in configs
+        if not REDUCTION_REGEX.match(config)
+    ]
+
+
+def benchmark_index(embeddings, queries, ground_truth, config, k=10, train_size=50000):
+    """
+    Build the index of a config ("reduction:factory|search_params") and measure it.
+    """
+    reduction, reduced_dim, index_factory, search_params = parse_config(config)
+
+    start = time.perf_counter()
+    index = create_faiss_index(
+        embeddings,
+        index_factory,
+        search_params,
+        train_size=train_size,
+        reduction=reduction,
+        reduced_dim=reduced_dim,
+    )
+    build_time = time.perf_counter() - start
+
+    ids, durations = search_one_by_one(index, queries, k)
+
+    return {
+        "config": config,
+        f"recall@{k}": recall_at_k(ids, ground_truth, k),
+        **latency_stats(durations),
+        "build_s": build_time,
+        "index_mb": faiss.serialize_index(index).nbytes / 1e6,
+    }
+
+
+def run_benchmark(embeddings, queries, configs=DEFAULT_CONFIGS, k=10, train_size=50000):
+    """
+    Benchmark all the configs, the ground truth is the flat index.
+    """
+    flat = create_faiss_index(embeddings, "Flat")
+    _, ground_truth = flat.search(queries, k)
+
+    results = []
+    for config in configs:
+        result = benchmark_index(
+            embeddings, queries, ground_truth, config, k, train_size
+        )
+        print(
+            f"{result['config']:<30} recall@{k} {result[f'recall@{k}']:.3f} "
+            f"p50 {result['p50_ms']:.2f} ms p99 {result['p99_ms']:.2f} ms "
+            f"size {result['index_mb']:.0f} MB"
+        )
+        results.append(result)
+
+    print_tradeoff(results, k)
+
+    return results
+
+
+def print_tradeoff(results, k=10):
+    """
+    Table of the configs by index size, * for the pareto optimal ones (no other
+    config is smaller, faster and with a better recall).
+    """
+    recall = f"recall@{k}"
+
+    def dominates(a, b):
+        better_or_equal = (
+            a["index_mb"] <= b["index_mb"]
+            and a["p50_ms"] <= b["p50_ms"]
+            and a[recall] >= b[recall]
+        )
+        return better_or_equal and (
+            a["index_mb"] < b["index_mb"]
+            or a["p50_ms"] < b["p50_ms"]
+            or a[recall] > b[recall]
+        )
+
+    print(f"\n{'':2}{'config':<34}{'size MB':>10}{'p50 ms':>10}{recall:>12}")
+    for result in sorted(results, key=lambda result: result["index_mb"]):
+        optimal = not any(dominates(other, result) for other in results)
+        print(
+            f"{'*' if optimal else '':2}{result['config']:<34}"
+            f"{result['index_mb']:>10.1f}{result['p50_ms']:>10.2f}{result[recall]:>12.3f}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--embeddings", required=True)
+    parser.add_argument(
+        "--queries", default=None, help="npy / pickle of query embeddings"
+    )
+    parser.add_argument("--nb-queries", type=int, default=1000)
+    parser.add_argument("--config", action="append", default=None)
+    parser.add_argument("--reduction", default=None, choices=REDUCTIONS)
+    parser.add_argument(
+        "--reduced-dim", type=int, action="append", default=None, help="ex 256"
+    )
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--train-size", type=int, default=50000)
+    parser.add_argument("--output", default=None, help="json file for the results")
+    args = parser.parse_args()
+
+    embeddings = np.ascontiguousarray(
+        load_embedding_matrix(args.embeddings), dtype=np.float32
+    )
+
+    if args.queries is not None:
+        queries = np.ascontiguousarray(
+            load_embedding_matrix(args.queries), dtype=np.float32
+        )
+    else:
+        queries = make_queries(embeddings, args.nb_queries)
+
+    configs = reduced_configs(
+        args.config or DEFAULT_CONFIGS, args.reduction, args.reduced_dim or [256]
+    )
+    results = run_benchmark(embeddings, queries, configs, args.k, args.train_size)
+
+    if args.output is not None:
+        with open(args.output, "w") as handle:
+            json.dump(results, handle, indent=2)
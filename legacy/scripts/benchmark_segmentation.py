@@ -0,0 +1,192 @@
+"""
+Benchmark of the article segmentation of preprocess_code.py : the single pass
+segmenter (segment_text) against the reference one (split_sections + parse_sections),
+in MB / s on a synthetic text that looks like the text of a code.
+
+Before the benchmark, the output of segment_text (articles and metadata) is checked :
+- on the sample text ../benchmark_data/segmentation_sample.txt against its golden
+  output ../benchmark_data/segmentation_golden.json
+- on the synthetic text against the reference segmenter
+The script exits with an error if one of them differs. The same checks (and the
+streaming segmentation against the whole text) are run by test_preprocess_code.py.
+
+usage:
+    python benchmark_segmentation.py --size 100
+    python benchmark_segmentation.py --update-golden (after an intended change of the
+        output, the golden output is written with the reference segmenter)
+"""
+
+import sys
+import json
+import time
+import random
+import argparse
+
+from preprocess_code import split_sections, parse_sections, segment_text
+
+STAMP = "\n\n Legif.\n\n Plan\n\n Jp.C.Cass.\n\n Jp.Appel\n\n Jp.Admin.\n\n Juricaf\n\n"
+
+WORDS = """
+    le la les un une des du de et ou à au aux en dans par pour sur avec sans sous
+    contrat bail salarié employeur juge tribunal délai mois jours propriétaire
+    locataire obligation responsabilité dommage préjudice réparation paiement
+    prescription action créancier débiteur mariage divorce enfant parent
+    succession héritier donation testament bien immeuble meuble servitude usufruit
+    peut doit est sont être fixé prévu applicable conformément dispositions présent
+    code décret conseil état ministre préfet autorité administrative sanction
+    """.split()
+
+# keywords in the text of the articles (they cut the article, as in the pdfs)
+REFERENCES = [
+    "l'Article {n}",
+    "la Section {n} du présent chapitre",
+    "au Titre {n}",
+    "du Livre {n}",
+    "le Paragraphe {n}",
+]
+
+HEADINGS = ["Partie", "Livre", "Titre", "Chapitre", "Section", "Sous-section"]
+
+
+def sentence(rng, nb_words):
+    words = [rng.choice(WORDS) for _ in range(nb_words)]
+    return words[0].capitalize() + " " + " ".join(words[1:]) + "."
+
+
+def synthetic_code(size, seed=0):
+    """
+    Text that looks like the text extracted from a code (headings, article titles,
+    stamps, page breaks, references to other articles), of about size characters.
+    """
+    rng = random.Random(seed)
+    parts = ["Code synthétique\nVersion en vigueur\n"]
+    length = len(parts[0])
+    number = 0
+
+    while length < size:
+        part = []
+
+        # headings
+        if rng.random() < 0.15:
+            level = rng.randrange(len(HEADINGS))
+            for heading in HEADINGS[level : level + rng.randint(1, 3)]:
+                part.append(f"{heading} {rng.randint(1, 30)} : {sentence(rng, 5)}\n")
+
+        # title of the article and stamp
+        number += 1
+        prefix = rng.choice(["", "", "L. ", "R. ", "D. ", "L", "R*"])
+        suffix = rng.choice(["", "", "", "-1", "-2", " bis"])
+        part.append(f"Article {prefix}{number}{suffix}{STAMP}")
+
+        # text of the article
+        for _ in range(rng.randint(1, 4)):
+            text = sentence(rng, rng.randint(8, 60))
+            if rng.random() < 0.1:
+                reference = rng.choice(REFERENCES).format(n=rng.randint(1, 500))
+                text = text[:-1] + f", en application de {reference}."
+            part.append(text + "\n")
+            if rng.random() < 0.2:
+                part.append("\n  \n")
+
+        # page break
+        if rng.random() < 0.1:
+            part.append(f"\fCode synthétique - Page {number // 10 + 1}\n")
+
+        part = "".join(part)
+        parts.append(part)
+        length += len(part)
+
+    return "".join(parts)
+
+
+def reference_segmentation(text):
+    return parse_sections(split_sections(text))
+
+
+def check(text, expected):
+    """
+    Compare the output of segment_text with the expected one.
+
+    return:
+        nb_differences: int
+    """
+    articles, metadata = segment_text(text)
+    expected_articles, expected_metadata = expected
+
+    if len(articles) != len(expected_articles):
+        print(f"  {len(articles)} articles instead of {len(expected_articles)}")
+        return abs(len(articles) - len(expected_articles))
+
+    differences = 0
+    for i in range(len(articles)):
+        if articles[i] != expected_articles[i] or metadata[i] != expected_metadata[i]:
+            if differences < 5:
+                print(f"  article {i}: {articles[i]!r} {metadata[i]}")
+                print(f"     expected {expected_articles[i]!r} {expected_metadata[i]}")
+            differences += 1
+    return differences
+
+
+def throughput(function, text, repeat):
+    """
+    MB / s of function on text (best of repeat runs).
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(text)
+        best = min(best, time.perf_counter() - start)
+    return len(text.encode("utf-8")) / 1e6 / best
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sample", default="../benchmark_data/segmentation_sample.txt")
+    parser.add_argument(
+        "--golden", default="../benchmark_data/segmentation_golden.json"
+    )
+    parser.add_argument("--update-golden", action="store_true")
+    parser.add_argument("--size", type=float, default=100, help="synthetic text, MB")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", default=None)
+    args = parser.parse_args()
+
+    with open(args.sample, "r", encoding="utf-8") as handle:
+        sample = handle.read()
+
+    if args.update_golden:
+        articles, metadata = reference_segmentation(sample)
+        with open(args.golden, "w", encoding="utf-8") as handle:
+            json.dump(
+                {"articles": articles, "metadata": metadata},
+                handle,
+                ensure_ascii=False,
+                indent=1,
+            )
+
+    with open(args.golden, "r", encoding="utf-8") as handle:
+        golden = json.load(handle)
+
+    print("golden sample")
+    errors = check(sample, (golden["articles"], golden["metadata"]))
+
+    text = synthetic_code(int(args.size * 1e6))
+    print(f"synthetic text ({len(text.encode('utf-8')) / 1e6:.1f} MB)")
+    errors += check(text, reference_segmentation(text))
+
+    if errors > 0:
+        print(f"{errors} differences")
+        sys.exit(1)
+    print("same output")
+
+    report = {
+        "size_mb": len(text.encode("utf-8")) / 1e6,
+        "reference_mb_s": throughput(reference_segmentation, text, args.repeat),
+        "single_pass_mb_s": throughput(segment_text, text, args.repeat),
+    }
+    print(f"reference   : {report['reference_mb_s']:.1f} MB/s")
+    print(f"single pass : {report['single_pass_mb_s']:.1f} MB/s")
+
+    if args.output is not None:
+        with open(args.output, "w") as handle:
+            json.dump(report, handle, indent=2)
@@ -0,0 +1,307 @@
+"""
+Columnar on-disk format of the corpus of articles.
+
+Before, every step of the pipeline went through pickles (lists of articles, then a
+list of haystack Document with their embeddings). The corpus is one folder :
+- texts.bin / texts_offsets.npy : the articles, utf-8 blob + int64 offsets (same
+  layout as serving_store.StringColumn, so the serving code can read it)
+- numbers.bin / numbers_offsets.npy : the article number ("L1234-5", "" if unknown)
+- paths.bin / paths_offsets.npy : the headings of the article (Livre, Titre,
+  Chapitre ...), a json list (a heading can contain any separator)
+- code_ids.npy (int16) + codes.json : the code of each article
+- lengths.npy (int32) : the number of characters of each article
+- embeddings/<name>.npy (float32) + embeddings/<name>_rows.npy (int64) : the
+  embeddings of a model and the corpus row of each embedding
+- manifest.json : number of articles, codes, embeddings
+Everything is memory mapped when the corpus is opened and an article is decoded only
+when it is read.
+
+    corpus = Corpus("../corpus/")
+    rows = corpus.select(max_length=MAX_SHORT_ARTICLE_LENGTH)
+    texts = corpus.texts(rows)
+"""
+
+import os
+import json
+import shutil
+import hashlib
+
+import numpy as np
+
+# separator of the headings in the "path" meta of the documents (displayed by the apps)
+PATH_SEPARATOR = " > "
+
+# articles longer than this are not embedded (they were not kept in the _short pickles)
+MAX_SHORT_ARTICLE_LENGTH = 1500
+
+
+def article_id(article, meta=None):
+    """
+    Stable id of an article : the sha256 of its code, its path and its content.
+    The same article always gets the same id, whatever its position in the corpus,
+    and the same text in two codes (or two chapters) gives two documents.
+
+    params:
+        article: str
+        meta: dict (code and path of the article, see Corpus.meta), None to
+            hash the content only
+    """
+    if meta is not None:
+        article = "\n".join([meta["code"], meta["path"], article])
+    return hashlib.sha256(article.encode("utf-8")).hexdigest()
+
+
+class CorpusWriter:
+    """
+    Write a corpus, code by code.
+
+        writer = CorpusWriter(path)
+        writer.add("code_civil", articles)
+        writer.close()
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+        self.texts = open(os.path.join(path, "texts.bin"), "wb")
+        self.numbers = open(os.path.join(path, "numbers.bin"), "wb")
+        self.paths = open(os.path.join(path, "paths.bin"), "wb")
+        self.text_offsets = [0]
+        self.number_offsets = [0]
+        self.path_offsets = [0]
+        self.lengths = []
+        self.code_ids = []
+        self.codes = []
+
+    def add(self, code, articles, numbers=None, paths=None):
+        """
+        params:
+            code: str (name of the code)
+            articles: list of str
+            numbers: list of str (article numbers), None if unknown
+            paths: list of list of str (headings of the articles), None if unknown
+        """
+        if numbers is None:
+            numbers = [""] * len(articles)
+        if paths is None:
+            paths = [[]] * len(articles)
+
+        self.add_rows(code, zip(articles, numbers, paths))
+
+    def add_rows(self, code, rows):
+        """
+        Same as add, for an iterable of (article, number, path) written one by one
+        (ex the articles of a code as they are segmented).
+
+        return:
+            nb_rows: int
+        """
+        if code not in self.codes:
+            self.codes.append(code)
+        code_id = self.codes.index(code)
+
+        nb_rows = 0
+        for article, number, path in rows:
+            data = article.encode("utf-8")
+            self.texts.write(data)
+            self.text_offsets.append(self.text_offsets[-1] + len(data))
+
+            data = number.encode("utf-8")
+            self.numbers.write(data)
+            self.number_offsets.append(self.number_offsets[-1] + len(data))
+
+            data = json.dumps(path, ensure_ascii=False).encode("utf-8")
+            self.paths.write(data)
+            self.path_offsets.append(self.path_offsets[-1] + len(data))
+
+            self.lengths.append(len(article))
+            self.code_ids.append(code_id)
+            nb_rows += 1
+
+        return nb_rows
+
+    def add_corpus(self, path):
+        """
+        Append the articles of the corpus written in path (its blobs are copied by
+        chunks, its articles are not decoded).
+        """
+        with open(os.path.join(path, "codes.json"), "r") as handle:
+            codes = json.load(handle)
+        for code in codes:
+            if code not in self.codes:
+                self.codes.append(code)
+        code_ids = np.array([self.codes.index(code) for code in codes], dtype=np.int64)
+
+        for name, blob, offsets in [
+            ("texts", self.texts, self.text_offsets),
+            ("numbers", self.numbers, self.number_offsets),
+            ("paths", self.paths, self.path_offsets),
+        ]:
+            with open(os.path.join(path, f"{name}.bin"), "rb") as handle:
+                shutil.copyfileobj(handle, blob)
+            part_offsets = np.load(os.path.join(path, f"{name}_offsets.npy"))
+            offsets.extend((part_offsets[1:] + offsets[-1]).tolist())
+
+        self.lengths.extend(np.load(os.path.join(path, "lengths.npy")).tolist())
+        part_code_ids = np.load(os.path.join(path, "code_ids.npy")).astype(np.int64)
+        self.code_ids.extend(code_ids[part_code_ids].tolist())
+
+    def close(self):
+        self.texts.close()
+        self.numbers.close()
+        self.paths.close()
+
+        np.save(
+            os.path.join(self.path, "texts_offsets.npy"),
+            np.array(self.text_offsets, dtype=np.int64),
+        )
+        np.save(
+            os.path.join(self.path, "numbers_offsets.npy"),
+            np.array(self.number_offsets, dtype=np.int64),
+        )
+        np.save(
+            os.path.join(self.path, "paths_offsets.npy"),
+            np.array(self.path_offsets, dtype=np.int64),
+        )
+        np.save(
+            os.path.join(self.path, "lengths.npy"),
+            np.array(self.lengths, dtype=np.int32),
+        )
+        np.save(
+            os.path.join(self.path, "code_ids.npy"),
+            np.array(self.code_ids, dtype=np.int16),
+        )
+
+        with open(os.path.join(self.path, "codes.json"), "w") as handle:
+            json.dump(self.codes, handle, ensure_ascii=False)
+
+        with open(os.path.join(self.path, "manifest.json"), "w") as handle:
+            json.dump(
+                {
+                    "nb_articles": len(self.lengths),
+                    "codes": self.codes,
+                    "embeddings": {},
+                },
+                handle,
+                ensure_ascii=False,
+            )
+
+
+def load_blob(path):
+    # np.memmap does not accept empty files
+    if os.path.getsize(path) == 0:
+        return np.zeros(0, dtype=np.uint8)
+    return np.memmap(path, dtype=np.uint8, mode="r")
+
+
+class Corpus:
+    """
+    Read only access to a corpus written by CorpusWriter.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+        with open(os.path.join(path, "manifest.json"), "r") as handle:
+            self.manifest = json.load(handle)
+        with open(os.path.join(path, "codes.json"), "r") as handle:
+            self.codes = json.load(handle)
+
+        self.text_blob = load_blob(os.path.join(path, "texts.bin"))
+        self.text_offsets = np.load(
+            os.path.join(path, "texts_offsets.npy"), mmap_mode="r"
+        )
+        self.number_blob = load_blob(os.path.join(path, "numbers.bin"))
+        self.number_offsets = np.load(
+            os.path.join(path, "numbers_offsets.npy"), mmap_mode="r"
+        )
+        self.path_blob = load_blob(os.path.join(path, "paths.bin"))
+        self.path_offsets = np.load(
+            os.path.join(path, "paths_offsets.npy"), mmap_mode="r"
+        )
+        self.lengths = np.load(os.path.join(path, "lengths.npy"), mmap_mode="r")
+        self.code_ids = np.load(os.path.join(path, "code_ids.npy"), mmap_mode="r")
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def text(self, row):
+        start, end = self.text_offsets[row], self.text_offsets[row + 1]
+        return self.text_blob[start:end].tobytes().decode("utf-8")
+
+    def number(self, row):
+        start, end = self.number_offsets[row], self.number_offsets[row + 1]
+        return self.number_blob[start:end].tobytes().decode("utf-8")
+
+    def headings(self, row):
+        start, end = self.path_offsets[row], self.path_offsets[row + 1]
+        return json.loads(self.path_blob[start:end].tobytes().decode("utf-8"))
+
+    def code(self, row):
+        return self.codes[self.code_ids[row]]
+
+    def meta(self, row):
+        """
+        Meta of the document of an article in the document stores (the path is one
+        str for display : haystack reads a list meta value as a list of alternative
+        values, use Corpus.headings for the list).
+        """
+        return {
+            "code": self.code(row),
+            "article": self.number(row),
+            "path": PATH_SEPARATOR.join(self.headings(row)),
+        }
+
+    def texts(self, rows):
+        return [self.text(row) for row in rows]
+
+    def iter_texts(self, rows=None):
+        for row in range(len(self)) if rows is None else rows:
+            yield self.text(row)
+
+    def select(self, max_length=None, min_length=1, codes=None):
+        """
+        Rows of the articles with min_length <= length < max_length and in codes.
+        """
+        mask = np.asarray(self.lengths) >= min_length
+        if max_length is not None:
+            mask &= np.asarray(self.lengths) < max_length
+        if codes is not None:
+            code_ids = [self.codes.index(code) for code in codes if code in self.codes]
+            mask &= np.isin(self.code_ids, code_ids)
+        return np.flatnonzero(mask)
+
+    def write_embeddings(self, name, rows, embeddings):
+        """
+        Save the embeddings of a model (one row per element of rows).
+        """
+        folder = os.path.join(self.path, "embeddings")
+        os.makedirs(folder, exist_ok=True)
+
+        np.save(
+            os.path.join(folder, name + ".npy"),
+            np.asarray(embeddings, dtype=np.float32),
+        )
+        np.save(
+            os.path.join(folder, name + "_rows.npy"), np.asarray(rows, dtype=np.int64)
+        )
+
+        self.manifest["embeddings"][name] = {
+            "nb_embeddings": len(rows),
+            "dim": int(np.shape(embeddings)[1]),
+        }
+        with open(os.path.join(self.path, "manifest.json"), "w") as handle:
+            json.dump(self.manifest, handle, ensure_ascii=False)
+
+    def embeddings(self, name):
+        """
+        return:
+            rows: np.array of int64 (corpus row of each embedding)
+            embeddings: np.memmap float32 (nb_embeddings, dim)
+        """
+        folder = os.path.join(self.path, "embeddings")
+        return (
+            np.load(os.path.join(folder, name + "_rows.npy"), mmap_mode="r"),
+            np.load(os.path.join(folder, name + ".npy"), mmap_mode="r"),
+        )
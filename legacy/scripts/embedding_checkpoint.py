@@ -0,0 +1,141 @@
+"""
+Resumable checkpoint of the embeddings computation.
+
+The embeddings are written in a float32 .npy file (memory mapped) allocated for the
+whole corpus: each batch writes only its own rows, at its position in the corpus.
+A small append-only manifest (one json line per completed batch) tells which batches
+are done, so a restarted run can skip them.
+
+The final matrix is loaded with np.load(..., mmap_mode="r"), without any copy.
+"""
+
+import os
+import json
+import hashlib
+
+import numpy as np
+
+EMBEDDINGS_FILENAME = "embeddings.npy"
+MANIFEST_FILENAME = "manifest.jsonl"
+
+
+def texts_fingerprint(texts, *params):
+    """
+    Hash of the texts (and of the batching parameters), used to check that a
+    checkpoint belongs to the same corpus.
+    """
+    sha = hashlib.sha256()
+    sha.update(json.dumps(params).encode("utf-8"))
+    for text in texts:
+        sha.update(text.encode("utf-8"))
+        sha.update(b"\0")
+    return sha.hexdigest()
+
+
+class EmbeddingCheckpoint:
+    """
+    Checkpoint of the embeddings of nb_texts texts in a folder.
+
+    params:
+        path: str (folder of the checkpoint)
+        nb_texts: int
+        dim: int (dimension of the embeddings)
+        fingerprint: str (see texts_fingerprint), if it does not match the saved
+            one the checkpoint is started from scratch
+    """
+
+    def __init__(self, path, nb_texts, dim, fingerprint):
+        self.path = path
+        self.nb_texts = nb_texts
+        self.dim = dim
+        self.fingerprint = fingerprint
+
+        self.embeddings_path = os.path.join(path, EMBEDDINGS_FILENAME)
+        self.manifest_path = os.path.join(path, MANIFEST_FILENAME)
+
+        os.makedirs(path, exist_ok=True)
+
+        self.completed = self._read_manifest()
+        if self.completed is None:
+            self._reset()
+
+        self.embeddings = np.load(self.embeddings_path, mmap_mode="r+")
+
+    def _header(self):
+        return {
+            "fingerprint": self.fingerprint,
+            "nb_texts": self.nb_texts,
+            "dim": self.dim,
+        }
+
+    def _read_manifest(self):
+        """
+        Return the set of completed batch ids, None if there is no valid checkpoint.
+        """
+        if not os.path.exists(self.manifest_path) or not os.path.exists(
+            self.embeddings_path
+        ):
+            return None
+
+        with open(self.manifest_path, "r") as handle:
+            lines = handle.read().splitlines()
+
+        if len(lines) == 0 or json.loads(lines[0]) != self._header():
+            return None
+
+        completed = set()
+        for line in lines[1:]:
+            # the last line may be truncated by a crash
+            try:
+                completed.add(json.loads(line)["batch"])
+            except ValueError:
+                pass
+
+        return completed
+
+    def _reset(self):
+        embeddings = np.lib.format.open_memmap(
+            self.embeddings_path,
+            mode="w+",
+            dtype=np.float32,
+            shape=(self.nb_texts, self.dim),
+        )
+        embeddings.flush()
+        del embeddings
+
+        with open(self.manifest_path, "w") as handle:
+            handle.write(json.dumps(self._header()) + "\n")
+
+        self.completed = set()
+
+    def write_batch(self, batch_idx, start, embeddings):
+        """
+        Write the embeddings of a batch at their position then mark the batch as done.
+        """
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        self.embeddings[start : start + len(embeddings)] = embeddings
+        self.embeddings.flush()
+
+        # the batch is marked as done only once its rows are on disk
+        with open(self.manifest_path, "a") as handle:
+            handle.write(
+                json.dumps({"batch": batch_idx, "start": start, "size": len(embeddings)})
+                + "\n"
+            )
+            handle.flush()
+            os.fsync(handle.fileno())
+
+        self.completed.add(batch_idx)
+
+    def load(self):
+        """
+        Read only memory map of the embedding matrix.
+        """
+        return load_embeddings(self.path)
+
+
+def load_embeddings(path):
+    """
+    Load the embedding matrix of a checkpoint folder (zero copy, read only).
+    """
+    return np.load(os.path.join(path, EMBEDDINGS_FILENAME), mmap_mode="r")
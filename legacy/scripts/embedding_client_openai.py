@@ -0,0 +1,266 @@
+"""
+Asynchronous client to compute the openai embeddings of a large list of texts.
+
+The texts are grouped in batches by token count, several batches are sent at the
+same time (max_in_flight) and two token buckets keep us under the requests per minute
+and tokens per minute limits of the account.
+Rate limit errors, timeouts and server errors are retried with an exponential
+backoff (with jitter).
+
+The api_base parameter can point to a local mock server for testing.
+"""
+
+import asyncio
+import random
+import time
+
+import numpy as np
+
+import openai
+
+try:
+    import tiktoken
+
+    ENCODING = tiktoken.get_encoding("cl100k_base")
+except:
+    ENCODING = None
+
+# errors that are worth retrying
+RETRY_ERRORS = (
+    openai.error.RateLimitError,
+    openai.error.Timeout,
+    openai.error.APIConnectionError,
+    openai.error.ServiceUnavailableError,
+    openai.error.APIError,
+)
+
+
+def count_tokens(text):
+    """
+    Number of tokens of a text for the embedding model.
+    Without tiktoken we use the usual estimation of 4 characters per token.
+    """
+    if ENCODING is not None:
+        return len(ENCODING.encode(text))
+
+    return len(text) // 4 + 1
+
+
+def make_batches(texts, max_tokens_per_batch=50000, max_texts_per_batch=2048):
+    """
+    Group the texts in batches so that each batch stays under max_tokens_per_batch
+    tokens and max_texts_per_batch texts.
+
+    params:
+        texts: list of str
+
+    return:
+        batches: list of (start, texts, nb_tokens), start is the index of the first
+            text of the batch in texts
+    """
+    batches = []
+
+    start = 0
+    current = []
+    current_tokens = 0
+
+    for idx, text in enumerate(texts):
+        nb_tokens = count_tokens(text)
+
+        if current and (
+            current_tokens + nb_tokens > max_tokens_per_batch
+            or len(current) >= max_texts_per_batch
+        ):
+            batches.append((start, current, current_tokens))
+            start = idx
+            current = []
+            current_tokens = 0
+
+        current.append(text)
+        current_tokens += nb_tokens
+
+    if current:
+        batches.append((start, current, current_tokens))
+
+    return batches
+
+
+class TokenBucket:
+    """
+    Token bucket refilled continuously at rate_per_minute.
+    acquire(amount) waits until amount tokens are available.
+    """
+
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity if capacity is not None else rate_per_minute
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.updated_at) * self.rate
+        )
+        self.updated_at = now
+
+    async def acquire(self, amount=1):
+        # a request bigger than the bucket would wait forever
+        amount = min(amount, self.capacity)
+
+        async with self.lock:
+            self._refill()
+            while self.tokens < amount:
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= amount
+
+
+class AsyncEmbeddingClient:
+    """
+    Compute the embeddings of a list of texts with concurrent requests.
+
+    params:
+        model: str (openai embedding model)
+        max_in_flight: int (number of requests sent at the same time)
+        requests_per_minute: int (rate limit of the account)
+        tokens_per_minute: int (rate limit of the account)
+        max_tokens_per_batch: int
+        max_texts_per_batch: int
+        max_retries: int (number of retries of a batch before giving up)
+        base_delay: float (first backoff delay in seconds)
+        max_delay: float (maximum backoff delay in seconds)
+        request_timeout: float (timeout of one request in seconds)
+        api_key: str (default to openai.api_key)
+        api_base: str (default to openai.api_base, set it to use a mock server)
+    """
+
+    def __init__(
+        self,
+        model="text-embedding-ada-002",
+        max_in_flight=8,
+        requests_per_minute=3000,
+        tokens_per_minute=1000000,
+        max_tokens_per_batch=50000,
+        max_texts_per_batch=2048,
+        max_retries=8,
+        base_delay=1.0,
+        max_delay=60.0,
+        request_timeout=60.0,
+        api_key=None,
+        api_base=None,
+    ):
+        self.model = model
+        self.max_in_flight = max_in_flight
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_tokens_per_batch = max_tokens_per_batch
+        self.max_texts_per_batch = max_texts_per_batch
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.request_timeout = request_timeout
+        self.api_key = api_key
+        self.api_base = api_base
+
+    def backoff_delay(self, attempt):
+        """
+        Exponential backoff with full jitter.
+        """
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+
+    async def embed_batch(self, texts, nb_tokens, request_bucket, token_bucket):
+        """
+        Embed one batch of texts, retry on rate limit / server errors.
+        """
+        for attempt in range(self.max_retries + 1):
+            await request_bucket.acquire(1)
+            await token_bucket.acquire(nb_tokens)
+
+            try:
+                response = await openai.Embedding.acreate(
+                    input=texts,
+                    model=self.model,
+                    api_key=self.api_key,
+                    api_base=self.api_base,
+                    request_timeout=self.request_timeout,
+                )
+            except RETRY_ERRORS as error:
+                if attempt == self.max_retries:
+                    raise
+                delay = self.backoff_delay(attempt)
+                print(f"embedding error ({error}), retry in {delay:.1f}s")
+                await asyncio.sleep(delay)
+                continue
+
+            # the api does not guarantee the order of the data
+            data = sorted(response["data"], key=lambda x: x["index"])
+            return np.array([x["embedding"] for x in data], dtype=np.float32)
+
+    async def aembed(self, texts, on_batch=None, skip_batches=()):
+        """
+        Embed all the texts.
+
+        params:
+            texts: list of str
+            on_batch: function called with (batch_idx, start, embeddings) when a batch
+                is done (used to save the embeddings in case of crash), the embeddings
+                are then not kept in memory
+            skip_batches: ids of the batches that are already done
+
+        return:
+            embeddings: np.array (nb_texts, dim) float32 (same order as texts, nan for
+                the texts of the skipped batches), or the number of embedded texts
+                when on_batch is given
+        """
+        batches = make_batches(
+            texts, self.max_tokens_per_batch, self.max_texts_per_batch
+        )
+
+        request_bucket = TokenBucket(self.requests_per_minute)
+        token_bucket = TokenBucket(self.tokens_per_minute)
+        semaphore = asyncio.Semaphore(self.max_in_flight)
+
+        # allocated with the dimension of the first batch (without on_batch only)
+        embeddings = None
+        nb_embedded = 0
+
+        async def run(batch_idx, start, batch, nb_tokens):
+            nonlocal embeddings, nb_embedded
+
+            async with semaphore:
+                result = await self.embed_batch(
+                    batch, nb_tokens, request_bucket, token_bucket
+                )
+            nb_embedded += len(result)
+
+            if on_batch is not None:
+                on_batch(batch_idx, start, result)
+                return
+
+            if embeddings is None:
+                embeddings = np.full(
+                    (len(texts), result.shape[1]), np.nan, dtype=np.float32
+                )
+            embeddings[start : start + len(batch)] = result
+
+        tasks = [
+            run(batch_idx, start, batch, nb_tokens)
+            for batch_idx, (start, batch, nb_tokens) in enumerate(batches)
+            if batch_idx not in skip_batches
+        ]
+        await asyncio.gather(*tasks)
+
+        if on_batch is not None:
+            return nb_embedded
+        if embeddings is None:
+            # nothing embedded (no texts or all the batches skipped)
+            return np.zeros((len(texts), 0), dtype=np.float32)
+        return embeddings
+
+    def embed(self, texts, on_batch=None, skip_batches=()):
+        """
+        Synchronous version of aembed.
+        """
+        return asyncio.run(self.aembed(texts, on_batch, skip_batches))
@@ -4,8 +4,8 @@ We use faiss to create the database and to add the embeddings to the database.
 We use sentence-transformers to create the embeddings.
 """
 
-import pickle
 import os
+import argparse
 from tqdm import tqdm
 
 import numpy as np
@@ -17,6 +17,12 @@ from haystack.document_stores import FAISSDocumentStore
 from haystack.nodes import EmbeddingRetriever
 from haystack.schema import Document, FilterType
 
+from faiss_index import training_sample, set_search_params
+from corpus import Corpus, MAX_SHORT_ARTICLE_LENGTH, article_id
+
+# name of the model, and of its embeddings in the corpus
+EMBEDDINGS_NAME = "multi-qa-mpnet-base-dot-v1"
+
 
 def create_embeddings(sentence, model):
     """
@@ -36,54 +42,96 @@ def create_embeddings(sentence, model):
     return embedding
 
 
-def compute_embedding_full_text(texts, model):
+def compute_embedding_full_text(
+    texts, model, batch_size=64, nb_processes=None, threads_per_process=1
+):
     """
     Compute the full text embedding for a list of texts.
+
+    The texts are sorted by length before being cut in batches, so the texts of a
+    batch have about the same length and there is almost no padding. The batches are
+    encoded on all the cores with the sentence-transformers multi process pool.
+
+    params:
+        texts: list of str
+        model: sentence-transformers model
+        batch_size: int (number of texts per forward pass)
+        nb_processes: int (number of encoding processes, default to cpu_count / threads_per_process)
+        threads_per_process: int (torch threads of each process)
+
+    return:
+        embeddings: np.array (nb_texts, dim) float32, same order as texts
     """
-    embeddings_full_text = []
-    for text in tqdm(texts):
-        embedding = create_embeddings(text, model)
-        embeddings_full_text.append(embedding)
+    if nb_processes is None:
+        nb_processes = max(1, (os.cpu_count() or 1) // threads_per_process)
+
+    # length sorted order (the original order is restored at the end)
+    order = np.argsort([len(text) for text in texts], kind="stable")
+    sorted_texts = [texts[idx] for idx in order]
+
+    if nb_processes == 1:
+        sorted_embeddings = model.encode(
+            sorted_texts,
+            batch_size=batch_size,
+            show_progress_bar=True,
+            convert_to_numpy=True,
+        )
+    else:
+        # the worker processes read the number of threads when they import torch
+        omp_num_threads = os.environ.get("OMP_NUM_THREADS")
+        os.environ["OMP_NUM_THREADS"] = str(threads_per_process)
+        pool = model.start_multi_process_pool(target_devices=["cpu"] * nb_processes)
+        if omp_num_threads is None:
+            del os.environ["OMP_NUM_THREADS"]
+        else:
+            os.environ["OMP_NUM_THREADS"] = omp_num_threads
+
+        try:
+            # chunks are contiguous in the sorted order so they stay length homogeneous
+            sorted_embeddings = model.encode_multi_process(
+                sorted_texts, pool, batch_size=batch_size
+            )
+        finally:
+            model.stop_multi_process_pool(pool)
+
+    embeddings = np.empty(
+        (len(texts), sorted_embeddings.shape[1]), dtype=np.float32
+    )
+    embeddings[order] = sorted_embeddings
 
-    return embeddings_full_text
+    return embeddings
 
 
 def get_model():
-    model = SentenceTransformer("sentence-transformers/multi-qa-mpnet-base-dot-v1")
+    model = SentenceTransformer("sentence-transformers/" + EMBEDDINGS_NAME)
     return model
 
 
 def read_data(path):
     """
-    Read the data from the pickle files.
-    We read all the file that have the .pickle extension in the path folder.
-    Also they have to have "short" in the name of the file.
-    """
-    data = []
-
-    files = os.listdir(path)
-
-    # filter the files that have the .pickle extension
-    files = [file for file in files if ".pickle" in file]
+    Read the articles to embed from the corpus (see corpus.py) : the non empty
+    articles shorter than MAX_SHORT_ARTICLE_LENGTH characters.
 
-    # filter the files that have "short" in the name
-    files = [file for file in files if "short" in file]
-
-    # now we loop over the files and we read the data
-    for file in files:
-        with open(path + file, "rb") as handle:
-            data += pickle.load(handle)
+    return:
+        corpus: Corpus
+        rows: np.array (corpus row of each article)
+        data: list of str (list of article)
+    """
+    corpus = Corpus(path)
+    rows = corpus.select(max_length=MAX_SHORT_ARTICLE_LENGTH)
 
-    return data
+    return corpus, rows, corpus.texts(rows)
 
 
-def create_documents_list(data, embeddings):
+def create_documents_list(data, embeddings, metas=None):
     """
     Function to create the list of documents (for the document store)
 
     params:
         data: list of str (list of article)
         embeddings: np.array (array of embeddings) corresponding to the data
+        metas: list of dict (code, article number and path of each article, see
+            corpus.Corpus.meta), None for no meta
 
     return:
         documents: list of Document (haystack schema)
@@ -93,54 +141,115 @@ def create_documents_list(data, embeddings):
     # we create the document
     documents = []
     for idx, article in enumerate(data):
-        document = Document(content=article, embedding=embeddings[idx, :], id=idx)
+        document = Document(
+            content=article,
+            embedding=embeddings[idx, :],
+            id=article_id(article, metas[idx] if metas is not None else None),
+            meta=metas[idx] if metas is not None else None,
+        )
         documents.append(document)
 
     return documents
 
 
-def create_faiss_document_store(documents, path_index, path_config):
+def create_faiss_document_store(
+    documents,
+    path_index,
+    path_config,
+    index_factory="Flat",
+    search_params=None,
+    train_size=50000,
+):
     """
     Create and save faiss document store
+
+    params:
+        documents: list of Document (with their embeddings)
+        path_index: str
+        path_config: str
+        index_factory: str (faiss index factory string, ex "Flat", "IVF1024,Flat",
+            "HNSW32", "IVF1024,PQ64", see faiss_index.py)
+        search_params: str (faiss search parameters, ex "nprobe=16")
+        train_size: int (number of embeddings used to train the index)
     """
-    document_store = FAISSDocumentStore(duplicate_documents="overwrite", return_embedding=True)
+    document_store = FAISSDocumentStore(
+        duplicate_documents="overwrite",
+        # the apps do not use the embeddings of the retrieved documents, faiss would
+        # reconstruct them at each query
+        return_embedding=False,
+        faiss_index_factory_str=index_factory,
+    )
+
+    # IVF / PQ indexes have to be trained before adding the documents
+    if not document_store.faiss_indexes[document_store.index].is_trained:
+        embeddings = np.stack([document.embedding for document in documents])
+        document_store.train_index(embeddings=training_sample(embeddings, train_size))
+
     document_store.write_documents(documents, duplicate_documents="overwrite")
+    set_search_params(
+        document_store.faiss_indexes[document_store.index], search_params
+    )
     document_store.save(index_path=path_index, config_path=path_config)
 
     return document_store
 
 
 if __name__ == "__main__":
-    # Load the model
-    print("Loading the model")
-    model = get_model()
-
-    # # Read the data
-    # print("Reading the data")
-    # data = read_data("../data_preprocess/")
-
-    # # for testing
-    # # data = data[:100]
-
-    # # # Create embeddings
-    # print("Creating the embeddings")
-    # embeddings = compute_embedding_full_text(data, model)
-
-    # embeddings = np.array(embeddings)
-
-    # # # save raw embeddings somewhere (pickle file)
-    # print("Saving the embeddings")
-    # with open("../embeddings.pickle", "wb") as handle:
-    #     pickle.dump(embeddings, handle)
-
-    # load pickle file
-    with open("../documents.pickle", "rb") as handle:
-        documents = pickle.load(handle)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--corpus", default="../corpus/")
+    parser.add_argument(
+        "--reuse",
+        action="store_true",
+        help="use the embeddings already saved in the corpus",
+    )
+    parser.add_argument(
+        "--index-factory",
+        default="Flat",
+        help='faiss index factory string, ex "IVF1024,Flat", "HNSW32", "IVF1024,PQ64" (see faiss_index.py)',
+    )
+    parser.add_argument(
+        "--search-params",
+        default=None,
+        help='faiss search parameters saved with the index, ex "nprobe=16", "efSearch=128"',
+    )
+    args = parser.parse_args()
+
+    # Read the data
+    print("Reading the data")
+    corpus, rows, data = read_data(args.corpus)
+
+    if args.reuse and EMBEDDINGS_NAME in corpus.manifest["embeddings"]:
+        print("Loading the embeddings")
+        rows, embeddings = corpus.embeddings(EMBEDDINGS_NAME)
+        data = corpus.texts(rows)
+
+    else:
+        # Load the model
+        print("Loading the model")
+        model = get_model()
+
+        # # Create embeddings
+        print("Creating the embeddings")
+        embeddings = compute_embedding_full_text(data, model)
+
+        # the embedding matrix is kept in the corpus (embeddings/<model>.npy)
+        corpus.write_embeddings(EMBEDDINGS_NAME, rows, embeddings)
+        rows, embeddings = corpus.embeddings(EMBEDDINGS_NAME)
+
+    # # Create the documents
+    print("Creating the documents")
+    documents = create_documents_list(
+        data, embeddings, [corpus.meta(row) for row in rows]
+    )
 
     # Create the faiss database
     print("Creating the faiss database")
     index = create_faiss_document_store(
-        documents, "../faiss_index.index", "../faiss_config.json"
+        documents,
+        "../faiss_index.index",
+        "../faiss_config.json",
+        index_factory=args.index_factory,
+        search_params=args.search_params,
     )
 
-    print(index.get_documents_by_id(["0"]))
+    print(index.get_documents_by_id([article_id(data[0], corpus.meta(rows[0]))]))
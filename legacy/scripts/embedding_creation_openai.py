@@ -4,8 +4,8 @@ We use faiss to create the database and to add the embeddings to the database.
 We use sentence-transformers to create the embeddings.
 """
 
-import pickle
 import os
+import argparse
 from tqdm import tqdm
 
 import numpy as np
@@ -13,12 +13,23 @@ import numpy as np
 import faiss
 from sentence_transformers import SentenceTransformer, util
 
-from haystack.document_stores import FAISSDocumentStore
+from haystack.document_stores import FAISSDocumentStore, SQLDocumentStore
 from haystack.nodes import EmbeddingRetriever
 from haystack.schema import Document, FilterType
 
+from faiss_index import (
+    training_sample,
+    set_search_params,
+    new_faiss_index,
+    REDUCTIONS,
+)
+from corpus import Corpus, MAX_SHORT_ARTICLE_LENGTH, article_id
+
 import openai
 
+from embedding_client_openai import AsyncEmbeddingClient, ENCODING
+from embedding_checkpoint import EmbeddingCheckpoint, texts_fingerprint
+
 # read key.key file and set openai api key
 with open("../key.key", "r") as f:
     key = f.read()
@@ -54,59 +65,77 @@ def create_embeddings(sentences, model="text-embedding-ada-002"):
     return list_embedding
 
 
-def compute_embedding_full_text(texts, batch_size=1000):
+def compute_embedding_full_text(
+    texts,
+    batch_size=1000,
+    max_in_flight=8,
+    checkpoint_path="../embeddings_checkpoint/",
+    embedding_dim=1536,
+):
     """
     Compute the full text embedding for a list of texts.
+    The batches are sent concurrently (see embedding_client_openai.py) and saved in a
+    checkpoint (see embedding_checkpoint.py): if the script is restarted on the same
+    texts the batches already done are skipped.
+
+    return:
+        embeddings: np.memmap (nb_texts, embedding_dim) float32, read only
     """
-    embeddings_full_text = []
+    client = AsyncEmbeddingClient(
+        max_in_flight=max_in_flight, max_texts_per_batch=batch_size
+    )
 
-    # we divide the texts in batch of batch_size
-    texts_batched = [
-        texts[i : i + batch_size] for i in range(0, len(texts), batch_size)
-    ]
+    fingerprint = texts_fingerprint(
+        texts,
+        client.model,
+        client.max_tokens_per_batch,
+        client.max_texts_per_batch,
+        ENCODING is not None,
+    )
+    checkpoint = EmbeddingCheckpoint(
+        checkpoint_path, len(texts), embedding_dim, fingerprint
+    )
+    print(f"{len(checkpoint.completed)} batches already done")
 
-    for idx, texts in enumerate(tqdm(texts_batched)):
-        embedding = create_embeddings(texts)
-        embeddings_full_text += embedding
+    progress_bar = tqdm(total=len(texts))
 
-        # save the embeddings in case of crash
-        with open(f"embeddings_full_text_tmp_{idx}.pickle", "wb") as handle:
-            pickle.dump(embeddings_full_text, handle)
+    def on_batch(idx, start, embedding):
+        progress_bar.update(len(embedding))
 
-    return embeddings_full_text
+        # save the embeddings of the batch in case of crash
+        checkpoint.write_batch(idx, start, embedding)
 
+    client.embed(texts, on_batch=on_batch, skip_batches=checkpoint.completed)
+    progress_bar.close()
 
-def read_data(path):
-    """
-    Read the data from the pickle files.
-    We read all the file that have the .pickle extension in the path folder.
-    Also they have to have "short" in the name of the file.
-    """
-    data = []
-
-    files = os.listdir(path)
+    return checkpoint.load()
 
-    # filter the files that have the .pickle extension
-    files = [file for file in files if ".pickle" in file]
 
-    # filter the files that have "short" in the name
-    files = [file for file in files if "short" in file]
+def read_data(path):
+    """
+    Read the articles to embed from the corpus (see corpus.py) : the non empty
+    articles shorter than MAX_SHORT_ARTICLE_LENGTH characters.
 
-    # now we loop over the files and we read the data
-    for file in files:
-        with open(path + file, "rb") as handle:
-            data += pickle.load(handle)
+    return:
+        corpus: Corpus
+        rows: np.array (corpus row of each article)
+        data: list of str (list of article)
+    """
+    corpus = Corpus(path)
+    rows = corpus.select(max_length=MAX_SHORT_ARTICLE_LENGTH)
 
-    return data
+    return corpus, rows, corpus.texts(rows)
 
 
-def create_documents_list(data, embeddings):
+def create_documents_list(data, embeddings, metas=None):
     """
     Function to create the list of documents (for the document store)
 
     params:
         data: list of str (list of article)
         embeddings: np.array (array of embeddings) corresponding to the data
+        metas: list of dict (code, article number and path of each article, see
+            corpus.Corpus.meta), None for no meta
 
     return:
         documents: list of Document (haystack schema)
@@ -116,64 +145,337 @@ def create_documents_list(data, embeddings):
     # we create the document
     documents = []
     for idx, article in enumerate(data):
-        document = Document(content=article, embedding=embeddings[idx, :], id=idx)
+        document = Document(
+            content=article,
+            embedding=embeddings[idx, :],
+            id=article_id(article, metas[idx] if metas is not None else None),
+            meta=metas[idx] if metas is not None else None,
+        )
         documents.append(document)
 
     return documents
 
 
-def create_faiss_document_store(documents, path_index, path_config):
+def create_faiss_document_store(
+    documents,
+    path_index,
+    path_config,
+    index_factory="Flat",
+    search_params=None,
+    train_size=50000,
+    reduction=None,
+    reduced_dim=None,
+):
     """
     Create and save faiss document store
+
+    params:
+        documents: list of Document (with their embeddings)
+        path_index: str
+        path_config: str
+        index_factory: str (faiss index factory string, ex "Flat", "IVF1024,Flat",
+            "HNSW32", "IVF1024,PQ64", see faiss_index.py)
+        search_params: str (faiss search parameters, ex "nprobe=16")
+        train_size: int (number of embeddings used to train the index)
+        reduction: str ("pca" or "opq", None to keep the 1536 dimensions, see
+            faiss_index.py)
+        reduced_dim: int (dimension of the index after the reduction, ex 256, 384,
+            512)
     """
+    # the reduction is fitted on the embeddings and saved in the faiss index, the
+    # queries are projected by faiss
+    faiss_index = None
+    if reduction is not None:
+        faiss_index = new_faiss_index(
+            np.stack([document.embedding for document in documents]),
+            index_factory,
+            train_size,
+            reduction=reduction,
+            reduced_dim=reduced_dim,
+        )
+
     document_store = FAISSDocumentStore(
-        duplicate_documents="overwrite", return_embedding=True, embedding_dim=1536
+        duplicate_documents="overwrite",
+        # the apps do not use the embeddings of the retrieved documents, faiss would
+        # reconstruct them at each query
+        return_embedding=False,
+        embedding_dim=1536,
+        faiss_index_factory_str=index_factory,
+        faiss_index=faiss_index,
     )
+
+    # IVF / PQ indexes have to be trained before adding the documents
+    if not document_store.faiss_indexes[document_store.index].is_trained:
+        embeddings = np.stack([document.embedding for document in documents])
+        document_store.train_index(embeddings=training_sample(embeddings, train_size))
+
     document_store.write_documents(documents, duplicate_documents="overwrite")
+    set_search_params(
+        document_store.faiss_indexes[document_store.index], search_params
+    )
+    document_store.save(index_path=path_index, config_path=path_config)
+
+    return document_store
+
+
+def diff_articles(data, existing_ids, metas=None):
+    """
+    Compare the articles with the ids already in the document store.
+
+    params:
+        data: list of str (list of article)
+        existing_ids: set of str (ids of the documents in the store)
+        metas: list of dict (meta of each article, see corpus.Corpus.meta), None for
+            no meta
+
+    return:
+        new_articles: dict id -> position in data (articles to add)
+        kept_articles: dict id -> position in data (articles already in the store)
+        removed_ids: list of str (ids to delete from the store)
+    """
+    articles = {
+        article_id(article, metas[idx] if metas is not None else None): idx
+        for idx, article in enumerate(data)
+    }
+
+    new_articles = {}
+    kept_articles = {}
+    for doc_id, idx in articles.items():
+        if doc_id in existing_ids:
+            kept_articles[doc_id] = idx
+        else:
+            new_articles[doc_id] = idx
+    removed_ids = [doc_id for doc_id in existing_ids if doc_id not in articles]
+
+    return new_articles, kept_articles, removed_ids
+
+
+def reconstruct_vectors(faiss_index, vector_ids, batch_size=10000):
+    """
+    Vectors of the index (in the input space of the index : the reduction of an
+    IndexPreTransform is reversed) for a list of vector ids.
+    Exact for the flat storages (Flat, HNSW, IVF Flat), the quantized indexes (PQ)
+    give back their decoded vectors, which are encoded to the same codes.
+    """
+    try:
+        faiss.extract_index_ivf(faiss_index).make_direct_map()
+    except RuntimeError:
+        # not an IVF index
+        pass
+
+    vector_ids = np.asarray(vector_ids, dtype=np.int64)
+    vectors = np.empty((len(vector_ids), faiss_index.d), dtype=np.float32)
+    for start in range(0, faiss_index.ntotal, batch_size):
+        n = min(batch_size, faiss_index.ntotal - start)
+        mask = (vector_ids >= start) & (vector_ids < start + n)
+        if mask.any():
+            vectors[mask] = faiss_index.reconstruct_n(start, n)[vector_ids[mask] - start]
+
+    return vectors
+
+
+def rebuild_faiss_index(document_store, removed_ids):
+    """
+    Remove documents from a faiss document store.
+
+    FAISSDocumentStore.delete_documents calls remove_ids on the faiss index : a flat
+    index renumbers the vectors after the removed ones but the vector_ids of the SQL
+    documents are not updated (the next added documents get the vector ids of
+    existing ones), and HNSW indexes do not support remove_ids.
+    Instead the faiss index is rebuilt with the vectors of the kept documents (same
+    index type and training) and the vector_ids of the documents are renumbered.
+    """
+    faiss_index = document_store.faiss_indexes[document_store.index]
+    removed_ids = set(removed_ids)
+
+    # (vector id, document id) of the kept documents, in the order of the index
+    kept = sorted(
+        (int(document.meta["vector_id"]), document.id)
+        for document in document_store.get_all_documents_generator(
+            return_embedding=False
+        )
+        if document.id not in removed_ids
+    )
+    vectors = reconstruct_vectors(faiss_index, [vector_id for vector_id, _ in kept])
+
+    new_index = faiss.clone_index(faiss_index)
+    new_index.reset()
+    if len(vectors) > 0:
+        new_index.add(vectors)
+
+    # the SQL rows only, the old faiss index is replaced
+    SQLDocumentStore.delete_documents(document_store, ids=list(removed_ids))
+    document_store.update_vector_ids(
+        {doc_id: str(vector_id) for vector_id, (_, doc_id) in enumerate(kept)}
+    )
+    document_store.faiss_indexes[document_store.index] = new_index
+
+
+def update_faiss_document_store(
+    data, path_index, path_config, metas=None, search_params=None
+):
+    """
+    Incremental update of a saved faiss document store.
+    Only the new (or changed) articles are embedded and added, and the articles
+    that are not in data anymore are removed from the store.
+    The faiss index keeps its type (index factory) and its search parameters, unless
+    new search_params are given (ex "nprobe=32").
+    The id of a document depends on the code and the path of the article (see
+    article_id) : an article moved to another chapter is removed and added again
+    (its embedding is taken from the index, not computed again), and the meta of the
+    kept documents is updated when it changed (ex the article number).
+    """
+    document_store = FAISSDocumentStore.load(
+        index_path=path_index, config_path=path_config
+    )
+
+    existing = {
+        document.id: document
+        for document in document_store.get_all_documents_generator(
+            return_embedding=False
+        )
+    }
+
+    new_articles, kept_articles, removed_ids = diff_articles(
+        data, set(existing), metas
+    )
+    print(f"{len(new_articles)} articles to add, {len(removed_ids)} articles to remove")
+
+    if metas is not None:
+        updated = 0
+        for doc_id, idx in kept_articles.items():
+            meta = {
+                key: value
+                for key, value in existing[doc_id].meta.items()
+                if key != "vector_id"
+            }
+            if meta != metas[idx]:
+                document_store.update_document_meta(doc_id, metas[idx])
+                updated += 1
+        print(f"{updated} metas updated")
+
+    if len(new_articles) > 0:
+        ids = list(new_articles.keys())
+        texts = [data[new_articles[doc_id]] for doc_id in ids]
+
+        # the embeddings of the articles whose content is already in the store (ex
+        # moved to another chapter) are taken from the faiss index
+        vector_ids = {
+            document.content: int(document.meta["vector_id"])
+            for document in existing.values()
+        }
+        known = [i for i, text in enumerate(texts) if text in vector_ids]
+        unknown = [i for i, text in enumerate(texts) if text not in vector_ids]
+
+        embeddings = np.empty((len(texts), 1536), dtype=np.float32)
+        if len(known) > 0:
+            embeddings[known] = reconstruct_vectors(
+                document_store.faiss_indexes[document_store.index],
+                [vector_ids[texts[i]] for i in known],
+            )
+        if len(unknown) > 0:
+            embeddings[unknown] = compute_embedding_full_text(
+                [texts[i] for i in unknown],
+                checkpoint_path="../embeddings_checkpoint_update/",
+            )
+
+        documents = [
+            Document(
+                content=text,
+                embedding=embeddings[i, :],
+                id=ids[i],
+                meta=metas[new_articles[ids[i]]] if metas is not None else None,
+            )
+            for i, text in enumerate(texts)
+        ]
+    else:
+        documents = []
+
+    # the removed documents are deleted before the new ones are added (the new
+    # documents get the vector ids after the kept ones)
+    if len(removed_ids) > 0:
+        rebuild_faiss_index(document_store, removed_ids)
+
+    if len(documents) > 0:
+        document_store.write_documents(documents, duplicate_documents="skip")
+
+    set_search_params(
+        document_store.faiss_indexes[document_store.index], search_params
+    )
     document_store.save(index_path=path_index, config_path=path_config)
 
     return document_store
 
 
 if __name__ == "__main__":
-    # Read the data
-    print("Reading the data")
-    data = read_data("../data_preprocess/")
-
-    # filter the data where there is nothing ''
-    data = [article for article in data if article != ""]
-
-    # # Create embeddings
-    print("Creating the embeddings")
-    embeddings = compute_embedding_full_text(data)
-
-    embeddings = np.array(embeddings)
-
-    # # save raw embeddings somewhere (pickle file)
-    print("Saving the embeddings")
-    with open("../embeddings.pickle", "wb") as handle:
-        pickle.dump(embeddings, handle)
-
-    # load pickle file
-    with open("../embeddings.pickle", "rb") as handle:
-        embeddings = pickle.load(handle)
-
-    # # Create the documents
-    print("Creating the documents")
-    documents = create_documents_list(data, embeddings)
-    
-    # # save documents somewhere (pickle file)
-    with open("../documents.pickle", "wb") as handle:
-        pickle.dump(documents, handle)
-
-    # load pickle file
-    with open("../documents.pickle", "rb") as handle:
-        documents = pickle.load(handle)
-
-    # Create the faiss database
-    print("Creating the faiss database")
-    index = create_faiss_document_store(
-        documents, "../faiss_index.index", "../faiss_config.json"
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="only embed the new or changed articles of an existing faiss index",
+    )
+    parser.add_argument("--corpus", default="../corpus/")
+    parser.add_argument(
+        "--reduction",
+        default=None,
+        choices=REDUCTIONS,
+        help="reduce the dimension of the index (pca or opq)",
     )
+    parser.add_argument("--reduced-dim", type=int, default=256)
+    parser.add_argument(
+        "--index-factory",
+        default="Flat",
+        help='faiss index factory string, ex "IVF1024,Flat", "HNSW32", "IVF1024,PQ64" (see faiss_index.py), a new index only',
+    )
+    parser.add_argument(
+        "--search-params",
+        default=None,
+        help='faiss search parameters saved with the index, ex "nprobe=16", "efSearch=128"',
+    )
+    args = parser.parse_args()
 
-    print(index.get_documents_by_id(["0"]))
+    # Read the data
+    print("Reading the data")
+    corpus, rows, data = read_data(args.corpus)
+
+    if args.incremental:
+        print("Updating the faiss database")
+        index = update_faiss_document_store(
+            data,
+            "../faiss_index.index",
+            "../faiss_config.json",
+            metas=[corpus.meta(row) for row in rows],
+            search_params=args.search_params,
+        )
+        print(index.get_document_count())
+
+    else:
+        # # Create embeddings
+        print("Creating the embeddings")
+        # the embeddings are saved in ../embeddings_checkpoint/embeddings.npy
+        embeddings = compute_embedding_full_text(data)
+
+        # the embedding matrix is kept in the corpus (embeddings/openai.npy)
+        corpus.write_embeddings("openai", rows, embeddings)
+        rows, embeddings = corpus.embeddings("openai")
+
+        # # Create the documents
+        # (their embeddings are views of the memory mapped matrix, not copies)
+        print("Creating the documents")
+        documents = create_documents_list(
+            data, embeddings, [corpus.meta(row) for row in rows]
+        )
+
+        # Create the faiss database
+        print("Creating the faiss database")
+        index = create_faiss_document_store(
+            documents,
+            "../faiss_index.index",
+            "../faiss_config.json",
+            index_factory=args.index_factory,
+            search_params=args.search_params,
+            reduction=args.reduction,
+            reduced_dim=args.reduced_dim,
+        )
+
+        print(index.get_documents_by_id([article_id(data[0], corpus.meta(rows[0]))]))
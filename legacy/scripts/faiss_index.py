@@ -0,0 +1,163 @@
+"""
+Helpers to build faiss indexes other than the flat (exact) one.
+
+The index type is given as a faiss index factory string, for example :
+- "Flat" : exact search (default of haystack)
+- "IVF1024,Flat" : inverted file with 1024 lists, needs a training
+- "HNSW32" : graph index with 32 links per node
+- "IVF1024,PQ64" : inverted file with product quantization (64 bytes per vector)
+
+and the search parameters as a faiss ParameterSpace string, for example
+"nprobe=16" (IVF) or "efSearch=128" (HNSW).
+
+The dimension of the vectors can be reduced before the index (reduction, reduced_dim,
+ex 1536 -> 256 for ada-002) :
+- "pca" : projection on the first principal axes of the embeddings, not centered
+  (the faiss PCAMatrix subtracts the mean, which changes the inner products and so
+  the score thresholds of the apps)
+- "opq" : the same projection followed by an OPQ rotation (balances the variance of
+  the sub-vectors of a PQ index)
+The projection is a faiss IndexPreTransform around the index : it is saved with the
+index and applied by faiss to the vectors added and to each query.
+"""
+
+import numpy as np
+
+import faiss
+
+
+def training_sample(embeddings, train_size=50000, seed=0):
+    """
+    Random sample of the embeddings to train the index (IVF centroids, PQ codebooks).
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+
+    if len(embeddings) <= train_size:
+        return np.ascontiguousarray(embeddings)
+
+    rng = np.random.default_rng(seed)
+    idx = np.sort(rng.choice(len(embeddings), size=train_size, replace=False))
+
+    return np.ascontiguousarray(embeddings[idx])
+
+
+REDUCTIONS = ["pca", "opq"]
+# number of sub-vectors of the OPQ rotation (the reduced dimension must be a multiple)
+OPQ_M = 16
+
+
+def pca_projection(embeddings, dim):
+    """
+    Projection on the first dim principal axes of the (not centered) embeddings.
+
+    return:
+        transform: faiss LinearTransform (d -> dim, orthonormal rows)
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float64)
+    # eigenvectors of the second moment matrix, by decreasing eigenvalue
+    _, eigenvectors = np.linalg.eigh(embeddings.T @ embeddings)
+    matrix = np.ascontiguousarray(eigenvectors[:, ::-1][:, :dim].T, dtype=np.float32)
+
+    transform = faiss.LinearTransform(embeddings.shape[1], dim, False)
+    faiss.copy_array_to_vector(matrix.ravel(), transform.A)
+    transform.is_trained = True
+    # the reverse transform (reconstruct) needs the orthonormal flag
+    transform.set_is_orthonormal()
+
+    return transform
+
+
+def fit_reduction(embeddings, dim, reduction="pca", train_size=50000):
+    """
+    Fit the reduction of the dimension of the embeddings.
+
+    params:
+        embeddings: np.array (nb_vectors, d)
+        dim: int (reduced dimension, ex 256, 384, 512)
+        reduction: str ("pca" or "opq", see REDUCTIONS)
+        train_size: int (number of vectors used for the fit)
+
+    return:
+        transforms: list of faiss VectorTransform (applied in this order)
+    """
+    if reduction not in REDUCTIONS:
+        raise ValueError(f"unknown reduction {reduction}, not in {REDUCTIONS}")
+
+    sample = training_sample(embeddings, train_size)
+    transforms = [pca_projection(sample, dim)]
+
+    if reduction == "opq":
+        opq = faiss.OPQMatrix(dim, OPQ_M)
+        opq.train(transforms[0].apply_py(sample))
+        transforms.append(opq)
+
+    return transforms
+
+
+def new_faiss_index(
+    embeddings,
+    index_factory="Flat",
+    train_size=50000,
+    metric=faiss.METRIC_INNER_PRODUCT,
+    reduction=None,
+    reduced_dim=None,
+):
+    """
+    Empty (trained) faiss index for the embeddings, with the reduction of the
+    dimension if reduction is set.
+    """
+    if reduction is None:
+        index = faiss.index_factory(embeddings.shape[1], index_factory, metric)
+    else:
+        transforms = fit_reduction(embeddings, reduced_dim, reduction, train_size)
+        index = faiss.index_factory(reduced_dim, index_factory, metric)
+        for transform in reversed(transforms):
+            index = faiss.IndexPreTransform(transform, index)
+
+    if not index.is_trained:
+        index.train(training_sample(embeddings, train_size))
+
+    return index
+
+
+def set_search_params(index, search_params):
+    """
+    Set the search parameters of an index, ex "nprobe=16" or "efSearch=128".
+    """
+    if search_params:
+        faiss.ParameterSpace().set_index_parameters(index, search_params)
+
+
+def create_faiss_index(
+    embeddings,
+    index_factory="Flat",
+    search_params=None,
+    train_size=50000,
+    metric=faiss.METRIC_INNER_PRODUCT,
+    reduction=None,
+    reduced_dim=None,
+):
+    """
+    Build a faiss index from an embedding matrix.
+
+    params:
+        embeddings: np.array (nb_vectors, dim)
+        index_factory: str (faiss index factory string)
+        search_params: str (faiss ParameterSpace string)
+        train_size: int (number of vectors used for the training)
+        metric: faiss metric (inner product as the haystack dot_product similarity)
+        reduction: str ("pca" or "opq", None to keep the dimension)
+        reduced_dim: int (dimension after the reduction)
+
+    return:
+        index: faiss index
+    """
+    embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+
+    index = new_faiss_index(
+        embeddings, index_factory, train_size, metric, reduction, reduced_dim
+    )
+    index.add(embeddings)
+    set_search_params(index, search_params)
+
+    return index
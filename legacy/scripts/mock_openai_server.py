@@ -0,0 +1,105 @@
+"""
+Minimal mock of the openai embedding api, to test the embedding client locally.
+
+The embeddings are random (seeded by the text), the data of a response is shuffled
+(the api does not guarantee its order) and a fraction of the requests answer with a
+429 error to exercise the retries. The server counts the requests it answered by
+status (status_counts), see test_embedding_client_openai.py.
+
+usage:
+    python mock_openai_server.py --port 8000 --error-rate 0.1
+    then use api_base="http://localhost:8000/v1"
+"""
+
+import argparse
+import hashlib
+import json
+import random
+import time
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+
+def fake_embedding(text, dim):
+    """
+    Deterministic random unit vector for a text.
+    """
+    seed = int(hashlib.sha256(text.encode("utf-8")).hexdigest()[:8], 16)
+    vector = np.random.default_rng(seed).standard_normal(dim).astype(np.float32)
+    return (vector / np.linalg.norm(vector)).tolist()
+
+
+def make_handler(dim, error_rate, latency):
+    class MockHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            length = int(self.headers["Content-Length"])
+            payload = json.loads(self.rfile.read(length))
+
+            time.sleep(latency)
+
+            if random.random() < error_rate:
+                body = {"error": {"message": "Rate limit reached", "type": "requests"}}
+                self.send_json(429, body)
+                return
+
+            texts = payload["input"]
+            if isinstance(texts, str):
+                texts = [texts]
+
+            body = {
+                "object": "list",
+                "model": payload["model"],
+                "data": [
+                    {"object": "embedding", "index": i, "embedding": fake_embedding(t, dim)}
+                    for i, t in enumerate(texts)
+                ],
+                "usage": {"prompt_tokens": 0, "total_tokens": 0},
+            }
+            random.shuffle(body["data"])
+            self.send_json(200, body)
+
+        def send_json(self, status, body):
+            with self.server.lock:
+                self.server.status_counts[status] += 1
+
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    return MockHandler
+
+
+def make_server(port=8000, dim=1536, error_rate=0.0, latency=0.2):
+    """
+    The server, not started (port=0 to use a free port, see server.server_port).
+    """
+    server = ThreadingHTTPServer(
+        ("localhost", port), make_handler(dim, error_rate, latency)
+    )
+    server.lock = threading.Lock()
+    server.status_counts = Counter()
+    return server
+
+
+def run_server(port=8000, dim=1536, error_rate=0.0, latency=0.2):
+    make_server(port, dim, error_rate, latency).serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--latency", type=float, default=0.2)
+    args = parser.parse_args()
+
+    run_server(args.port, args.dim, args.error_rate, args.latency)
@@ -1,27 +1,92 @@
 """
 In this file, we will preprocess the data for the model.
 We preprocess the data using unstructure IO.
+
+Two modes are available :
+- the batch mode (preprocess_code) extracts the whole pdf text at once
+- the streaming mode (preprocess_code_streaming) extracts the pdf page by page and
+  split the articles as soon as they are complete, so the memory stays bounded.
+The __main__ runs one worker per pdf in a process pool and writes the articles of all
+the codes in the columnar corpus (see corpus.py), read by the embedding scripts and by
+the BM25 index. The pickle files are only written with --pickles.
 """
+
 import re
+import heapq
 import pickle
 import os
-from pdfminer.high_level import extract_text
+import shutil
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
+from pdfminer.high_level import extract_text, extract_pages
+from pdfminer.layout import LTContainer, LTText, LTTextBox
 
-def preprocess_code(path_pdf, path_preprocess):
-    """
-    Function that preprocess the data for the model and then save it in a pickle file.
-    """
+from corpus import CorpusWriter, MAX_SHORT_ARTICLE_LENGTH
 
-    text = extract_text(path_pdf)
+# navigation stamp that legifrance adds before every article
+STAMP_PATTERN = r"\n\n Legif\.\s*\n\n Plan\s*\n\n Jp\.C\.Cass\.\s*\n\n Jp\.Appel\s*\n\n Jp\.Admin\.\s*\n\n Juricaf\s*\n\n"
+STAMP_REGEX = re.compile(STAMP_PATTERN)
+# non whitespace characters of a stamp : a stamp that is not complete at the end of a
+# page starts before the last STAMP_CHARS non whitespace characters of the text
+STAMP_CHARS = len("Legif.PlanJp.C.Cass.Jp.AppelJp.Admin.Juricaf")
 
-    pattern = r"\n\n Legif\.\s*\n\n Plan\s*\n\n Jp\.C\.Cass\.\s*\n\n Jp\.Appel\s*\n\n Jp\.Admin\.\s*\n\n Juricaf\s*\n\n"
-    regex = re.compile(pattern)
+ARTICLES_STAMP = " ARTICLES_STAMP "
+
+# for all the articles we cut the text after one of the keywork :
+# Livre, Titre, Chapitre, Section, Paragraphe, Sous-section, Article
+CUT_KEYWORDS = [
+    "Livre",
+    "Titre",
+    "Chapitre",
+    "Section",
+    "Paragraphe",
+    "Sous-section",
+    "Article",
+]
+
+# levels of the hierarchy of a code, from the top, a heading starts a line
+# ("Livre Ier : Des personnes", "Chapitre II : De la filiation")
+HEADING_LEVELS = [
+    "Partie",
+    "Livre",
+    "Titre",
+    "Chapitre",
+    "Section",
+    "Sous-section",
+    "Paragraphe",
+]
+HEADING_REGEX = re.compile(r"^\s*(" + "|".join(HEADING_LEVELS) + r")\s+\S")
+
+# "Article 1240", "Article L. 1234-5", "Article R*123-4", "Article 2 bis" : the title
+# of the article is the end of the line merged with the stamp (or the beginning of
+# the text after the stamp). WS is a whitespace of a line : the regexes also run on
+# the raw text (see ArticleMetadata.parse_span)
+WS = r"[^\S\n]"
+ARTICLE_NUMBER = (
+    rf"Article{WS}+((?:[LRDA]\*?\.?{WS}?)?\d\S*"
+    rf"(?:{WS}+(?:bis|ter|quater|quinquies|sexies))?)"
+)
+ARTICLE_HEADER_REGEX = re.compile(r"\b" + ARTICLE_NUMBER + rf"{WS}*$")
+ARTICLE_FIRST_LINE_REGEX = re.compile(rf"^{WS}*" + ARTICLE_NUMBER, re.MULTILINE)
+NUMBER_DOT_REGEX = re.compile(r"\.\s?")
 
-    replacement = " ARTICLES_STAMP "
-    new_text = regex.sub(replacement, text)
+# headings in the raw text (see ArticleMetadata.parse_span) : at the position where
+# the search starts, and after a newline (the regex starts with a literal, so the re
+# module looks for the newlines before trying the rest of the pattern)
+HEADING_AT_REGEX = re.compile(rf"{WS}*(" + "|".join(HEADING_LEVELS) + rf"){WS}+\S.*")
+HEADING_LINE_REGEX = re.compile(
+    rf"\n({WS}*(" + "|".join(HEADING_LEVELS) + rf"){WS}+\S.*)"
+)
+# line with at least one non whitespace character (the lines kept in the articles)
+NON_BLANK_LINE_REGEX = re.compile(r"[^\n]*\S[^\n]*")
 
-    split_keyword = replacement
+
+def section_lines(text):
+    """
+    Replace the article stamps and return the non empty lines of the text.
+    """
+    new_text = STAMP_REGEX.sub(ARTICLES_STAMP, text)
 
     # Define the regex pattern to match each line
     pattern = r".*"
@@ -32,7 +97,24 @@ def preprocess_code(path_pdf, path_preprocess):
     # Split the text into individual lines using the compiled regex pattern
     lines = regex.findall(new_text)
 
-    lines = [line for line in lines if line.strip() != ""]
+    return [line for line in lines if line.strip() != ""]
+
+
+def split_sections(text):
+    """
+    Split the raw text of a code into sections (one section per article stamp).
+    The first section is the text before the first stamp, the text after the last
+    stamp is not returned.
+
+    params:
+        text: str (raw text extracted from the pdf)
+
+    return:
+        sections: list of list of str (the non empty lines of each section)
+    """
+    split_keyword = ARTICLES_STAMP
+
+    lines = section_lines(text)
 
     # Group the lines into sections based on the split keyword
     sections = []
@@ -44,32 +126,381 @@ def preprocess_code(path_pdf, path_preprocess):
         else:
             current_section.append(line)
 
+    return sections
+
+
+def cut_article(article):
+    """
+    Cut the article text at the first heading keyword (Livre, Titre ...)
+    """
+    for keyword in CUT_KEYWORDS:
+        if keyword in article:
+            article = article.split(keyword)[0]
+
+    return article
+
+
+class ArticleMetadata:
+    """
+    Number and hierarchy (Livre, Titre, Chapitre ...) of the articles.
+
+    The sections must be parsed in order : a heading applies to all the articles
+    after it, until the next heading of the same or of an upper level.
+    """
+
+    def __init__(self):
+        # level -> heading
+        self.path = {}
+        # headings of the current article, from the top (rebuilt by add_heading)
+        self.headings = []
+
+    def parse(self, lines):
+        """
+        params:
+            lines: list of str (the non empty lines of a section, see split_sections)
+
+        return:
+            metadata: {"number": str ("" if not found), "path": list of str} of the
+                article of the section
+        """
+        number = ""
+        if len(lines) > 0 and ARTICLES_STAMP in lines[0]:
+            header, first_line = lines[0].split(ARTICLES_STAMP, 1)
+            match = ARTICLE_HEADER_REGEX.search(header) or (
+                ARTICLE_FIRST_LINE_REGEX.match(first_line)
+            )
+            number = article_number(match)
+            lines = [first_line] + lines[1:]
+
+        metadata = self.current(number)
+
+        # the headings are after the text of the article, they apply to the next ones
+        for line in lines:
+            match = HEADING_REGEX.match(line)
+            if match:
+                self.add_heading(match.group(1), line)
+
+        return metadata
+
+    def parse_span(self, text, span):
+        """
+        Same as parse, on a span of iter_page_spans (the regexes run on the raw
+        text, between the offsets of the span).
+        """
+        start, _, end, stamps = span
+
+        number = ""
+        if len(stamps) > 0:
+            stamp_start, stamp_end = stamps[0]
+            match = ARTICLE_HEADER_REGEX.search(text, start, stamp_start) or (
+                ARTICLE_FIRST_LINE_REGEX.match(text, stamp_end, end)
+            )
+            number = article_number(match)
+            # the header of the line that holds the stamp is not a heading
+            start = stamp_end
+
+        metadata = self.current(number)
+
+        match = HEADING_AT_REGEX.match(text, start, end)
+        if match:
+            self.add_heading(match.group(1), match.group(0))
+        for match in HEADING_LINE_REGEX.finditer(text, start, end):
+            self.add_heading(match.group(2), match.group(1))
+
+        return metadata
+
+    def current(self, number):
+        return {
+            "number": number,
+            "path": list(self.headings),
+        }
+
+    def add_heading(self, level, line):
+        for lower_level in HEADING_LEVELS[HEADING_LEVELS.index(level) :]:
+            self.path.pop(lower_level, None)
+        self.path[level] = " ".join(line.split())
+        self.headings = [
+            self.path[level] for level in HEADING_LEVELS if level in self.path
+        ]
+
+
+def article_number(match):
+    if match is None:
+        return ""
+    # "L. 1234-5" -> "L1234-5"
+    number = NUMBER_DOT_REGEX.sub("", match.group(1), count=1)
+    return " ".join(number.split())
+
+
+def parse_sections(sections):
+    """
+    Articles and metadata of an iterable of sections (one pass).
+
+    return:
+        articles: list of str
+        metadata: list of {"number": str, "path": list of str}
+    """
+    parser = ArticleMetadata()
     articles = []
-    # preprocess of the section
-    for subsection in sections:
-        articles.append(" ".join(subsection))
-
-    # for all the articles we cut the text after one of the keywork :
-    # Livre, Titre, Chapitre, Section, Paragraphe, Sous-section, Article
-    cut_keyword = [
-        "Livre",
-        "Titre",
-        "Chapitre",
-        "Section",
-        "Paragraphe",
-        "Sous-section",
-        "Article",
-    ]
+    metadata = []
+    for lines in sections:
+        articles.append(cut_article(" ".join(lines)))
+        metadata.append(parser.parse(lines))
+
+    return articles, metadata
+
+
+class KeywordScanner:
+    """
+    Position of the first cut keyword of the sections, in one forward pass over the
+    text : the next occurrence of each keyword is kept in a heap, and a keyword is
+    only searched again (str.find from the start of the section) when the section
+    starts after its last occurrence.
+    Same cut as cut_article, without copying the article for each keyword.
+    """
+
+    def __init__(self, text):
+        self.text = text
+        self.heap = [(-1, keyword) for keyword in CUT_KEYWORDS]
+
+    def first(self, start, end):
+        """
+        return:
+            cut: int (offset of the first keyword in text[start:end]), None if there is
+                none
+        """
+        # the sections start at the beginning of a line, a keyword can not overlap it
+        while self.heap[0][0] < start:
+            keyword = self.heap[0][1]
+            position = self.text.find(keyword, start)
+            heapq.heapreplace(
+                self.heap, (len(self.text) if position < 0 else position, keyword)
+            )
+
+        cut = self.heap[0][0]
+        return cut if cut < end else None
+
+
+def text_from(pieces, length, position):
+    """
+    The pieces joined, from position (only the pieces after position are copied).
+    """
+    if position >= length:
+        return ""
+    i = len(pieces)
+    offset = length
+    while offset > position:
+        i -= 1
+        offset -= len(pieces[i])
+    return pieces[i][position - offset :] + "".join(pieces[i + 1 :])
+
+
+def stamp_lookback(text):
+    """
+    Offset in text before which no stamp can start when there is no stamp in text (the
+    text after it holds STAMP_CHARS non whitespace characters).
+    """
+    count = 0
+    position = len(text)
+    while position > 0:
+        position -= 1
+        if not text[position].isspace():
+            count += 1
+            if count > STAMP_CHARS:
+                return position + 1
+    return 0
+
+
+def iter_page_spans(page_texts):
+    """
+    Single pass segmentation of the raw text of a code, given in pieces (the pages of
+    a pdf, or the whole text) : same sections and articles as split_sections and
+    cut_article, but with one finditer over the stamps of the original text and a
+    KeywordScanner for the cut keywords (no substitution, no list of lines, no copy
+    of the articles for each keyword).
+
+    A section starts at the beginning of the line that holds its stamp (the newlines
+    inside the previous stamp do not count, the stamps are replaced by a space in
+    split_sections), its article stops at the first cut keyword of the section.
+    The first section is the text before the first stamp, the text after the last
+    stamp is not returned.
+
+    We keep only the text of the current (unfinished) section, as a list of pages : a
+    section is complete when the stamp of the next article is found, so an article
+    that spans several pages is split exactly as in the whole text. The pages are
+    joined when a stamp is found, and a page without stamp is only searched from
+    where a stamp can still start, so a section that spans many pages is not copied
+    nor searched again at each page.
+
+    params:
+        page_texts: iterable of str (raw text extracted from the pdf)
+
+    return:
+        generator of (buffer, span) : span = (start, cut, end, stamps), offsets in
+        buffer of the section [start, end), of the end of its article (None if the
+        section has no keyword, the article goes to end) and the (start, end) of the
+        stamps of the section (its own stamp first, then the stamps on the same line,
+        empty for the first section)
+    """
+    # text of the current section (from its start) and its length
+    pieces = []
+    length = 0
+    start = 0
+    stamps = []
+    scan_from = 0
+    # last newline before scan_from skipped by a page without stamp, -1 if none
+    skipped_newline = -1
+    # end of the text without its trailing whitespaces
+    tail = 0
+    in_section = False
+
+    for page_text in page_texts:
+        page_start = length
+        pieces.append(page_text)
+        length += len(page_text)
+        stripped = len(page_text.rstrip())
+        if stripped > 0:
+            tail = page_start + stripped
+
+        window = text_from(pieces, length, scan_from)
+        first = STAMP_REGEX.search(window)
+        if first is None:
+            skip = stamp_lookback(window)
+            newline = window.rfind("\n", 0, skip)
+            if newline >= 0:
+                skipped_newline = scan_from + newline
+            scan_from += skip
+            continue
+
+        buffer = "".join(pieces)
+        keywords = KeywordScanner(buffer)
+
+        # a stamp that ends in the trailing whitespaces may still grow with the next
+        # page : it is matched again from its start
+        for match in STAMP_REGEX.finditer(buffer, scan_from + first.start()):
+            newline = buffer.rfind("\n", scan_from, match.start())
+            if newline < 0:
+                newline = skipped_newline
+            skipped_newline = -1
 
-    for idx, article in enumerate(articles):
-        current_article = article
+            if newline >= 0 or not in_section:
+                boundary = newline + 1 if newline >= 0 else start
+                yield buffer, (start, keywords.first(start, boundary), boundary, stamps)
 
-        for keyword in cut_keyword:
-            if keyword in current_article:
-                current_article = current_article.split(keyword)[0]
+                start = boundary
+                stamps = [match.span()]
+                in_section = True
+            elif stamps[-1][0] == match.start():
+                # the same stamp, grown with the whitespaces of this page
+                stamps[-1] = match.span()
+            else:
+                # a stamp on the same line as the previous one stays in its section
+                stamps.append(match.span())
 
-        articles[idx] = current_article
+            scan_from = match.start() if match.end() >= tail else match.end()
 
+        # the text of the sections already returned is dropped
+        buffer = buffer[start:]
+        pieces = [buffer]
+        length = len(buffer)
+        scan_from -= start
+        tail = max(tail - start, 0)
+        stamps = [
+            (stamp_start - start, stamp_end - start)
+            for stamp_start, stamp_end in stamps
+        ]
+        start = 0
+
+
+def iter_article_spans(text):
+    """
+    Spans of the sections of the whole text of a code (see iter_page_spans).
+    """
+    for _, span in iter_page_spans([text]):
+        yield span
+
+
+def span_article(text, span):
+    """
+    Text of the article of a span (same as cut_article(" ".join(lines))), built from
+    the slices of text between the stamps of the section.
+    """
+    start, cut, end, stamps = span
+    stop = end if cut is None else cut
+
+    # the non blank lines of the article, the line that holds a stamp is the end of
+    # the line before it, ARTICLES_STAMP and the beginning of the line after it
+    lines = []
+    line = ""
+    position = start
+    for stamp_start, stamp_end in stamps + [(stop, stop)]:
+        if stamp_start >= stop:
+            stamp_start, stamp_end = stop, None
+        first = text.find("\n", position, stamp_start)
+        if first < 0:
+            line += text[position:stamp_start]
+        else:
+            last = text.rfind("\n", first, stamp_start)
+            line += text[position:first]
+            if line.strip() != "":
+                lines.append(line)
+            lines.extend(NON_BLANK_LINE_REGEX.findall(text, first + 1, last))
+            line = text[last + 1 : stamp_start]
+        if stamp_end is None:
+            break
+        line += ARTICLES_STAMP
+        position = stamp_end
+
+    # the article stops inside a line : the beginning of this line is kept even if it
+    # is blank (the whole line is not)
+    if cut is not None or line.strip() != "":
+        lines.append(line)
+
+    return " ".join(lines)
+
+
+def iter_segments(page_texts):
+    """
+    Articles of the raw text of a code, given in pieces (the pages of a pdf or the
+    whole text), with the single pass segmenter, as soon as they are complete.
+
+    return:
+        generator of (article, metadata) : str, {"number": str, "path": list of str}
+    """
+    parser = ArticleMetadata()
+    for buffer, span in iter_page_spans(page_texts):
+        yield span_article(buffer, span), parser.parse_span(buffer, span)
+
+
+def segment_pages(page_texts):
+    """
+    Articles and metadata of the raw text of a code (see iter_segments).
+
+    return:
+        articles: list of str
+        metadata: list of {"number": str, "path": list of str}
+    """
+    articles = []
+    metadata = []
+    for article, meta in iter_segments(page_texts):
+        articles.append(article)
+        metadata.append(meta)
+
+    return articles, metadata
+
+
+def segment_text(text):
+    """
+    Articles and metadata of the whole raw text of a code (same output as
+    parse_sections(split_sections(text)), see segment_pages).
+    """
+    return segment_pages([text])
+
+
+def save_articles(articles, path_pdf, path_preprocess):
+    """
+    Save the articles in a pickle file and the short articles in a _short pickle file.
+    """
     # we save all the article in a pickle file
     pickle_filename = path_pdf.split("/")[-1].split(".")[0] + ".pickle"
 
@@ -77,8 +508,10 @@ def preprocess_code(path_pdf, path_preprocess):
         pickle.dump(articles, handle)
 
     # save the articles in a pickle file (but we keep only the short articles)
-    # we filter the articles that are too long (>2000 characters)
-    articles = [article for article in articles if len(article) < 1500]
+    # we filter the articles that are too long (>1500 characters)
+    articles = [
+        article for article in articles if len(article) < MAX_SHORT_ARTICLE_LENGTH
+    ]
 
     pickle_filename = path_pdf.split("/")[-1].split(".")[0] + "_short.pickle"
 
@@ -86,11 +519,171 @@ def preprocess_code(path_pdf, path_preprocess):
     with open(path_preprocess + pickle_filename, "wb") as handle:
         pickle.dump(articles, handle)
 
+
+def preprocess_code(path_pdf, path_preprocess):
+    """
+    Function that preprocess the data for the model and then save it in a pickle file
+    (if path_preprocess is not None).
+
+    return:
+        articles: list of str
+        metadata: list of {"number": str, "path": list of str} (see ArticleMetadata)
+    """
+
+    text = extract_text(path_pdf)
+
+    # preprocess of the section (single pass, see iter_page_spans)
+    articles, metadata = segment_text(text)
+
+    if path_preprocess is not None:
+        save_articles(articles, path_pdf, path_preprocess)
+
+    return articles, metadata
+
+
+def render_layout(item, chunks):
+    """
+    Text of a layout item, as TextConverter writes it (the text of the containers
+    and a newline after every text box, the stamps rely on these newlines).
+    """
+    if isinstance(item, LTContainer):
+        for child in item:
+            render_layout(child, chunks)
+    elif isinstance(item, LTText):
+        chunks.append(item.get_text())
+    if isinstance(item, LTTextBox):
+        chunks.append("\n")
+
+
+def iter_page_texts(path_pdf):
+    """
+    Yield the text of the pdf page by page (same text as extract_text gives for the page).
+    """
+    for page_layout in extract_pages(path_pdf):
+        chunks = []
+        render_layout(page_layout, chunks)
+        # extract_text ends every page with a form feed
+        yield "".join(chunks) + "\f"
+
+
+def preprocess_code_streaming(path_pdf, path_preprocess):
+    """
+    Same as preprocess_code but the pdf is read page by page with extract_pages, the
+    articles are split as soon as they are complete (see iter_page_spans).
+    """
+    articles, metadata = segment_pages(iter_page_texts(path_pdf))
+
+    if path_preprocess is not None:
+        save_articles(articles, path_pdf, path_preprocess)
+
+    return articles, metadata
+
+
+def preprocess_file(path_pdf, path_part, path_preprocess=None, streaming=True):
+    """
+    Preprocess one pdf (used by the worker processes) and write its articles in a
+    corpus of its own (path_part, merged by preprocess_all) : in streaming mode an
+    article is written as soon as it is complete, the articles of the code are not
+    kept in memory (except for the pickle files of path_preprocess).
+
+    return:
+        nb_articles: int
+    """
+    if path_preprocess is not None:
+        # the pickle files are written from the list of the articles
+        preprocess = preprocess_code_streaming if streaming else preprocess_code
+        articles, metadata = preprocess(path_pdf, path_preprocess)
+        segments = zip(articles, metadata)
+    elif streaming:
+        segments = iter_segments(iter_page_texts(path_pdf))
+    else:
+        segments = iter_segments([extract_text(path_pdf)])
+
+    writer = CorpusWriter(path_part)
+    nb_articles = writer.add_rows(
+        code_name(path_pdf),
+        ((article, meta["number"], meta["path"]) for article, meta in segments),
+    )
+    writer.close()
+
+    return nb_articles
+
+
+def code_name(filename):
+    return filename.split("/")[-1].split(".")[0]
+
+
+def preprocess_all(
+    path_pdf, path_corpus, path_preprocess=None, workers=None, streaming=True
+):
+    """
+    Preprocess all the pdf in the folder path_pdf, one worker per pdf, and write the
+    corpus.
+
+    params:
+        path_pdf: str (folder with the pdf files)
+        path_corpus: str (folder of the corpus, see corpus.py)
+        path_preprocess: str (folder where the pickle files are saved, None to not
+            write them)
+        workers: int (number of processes, default to the number of cores)
+        streaming: bool (use the page by page extraction)
+    """
+    filenames = sorted(
+        filename for filename in os.listdir(path_pdf) if filename.endswith(".pdf")
+    )
+
+    # each worker writes the corpus of its code in path_corpus/parts/, the parent only
+    # gets the number of articles
+    path_parts = os.path.join(path_corpus, "parts")
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(
+                preprocess_file,
+                path_pdf + "/" + filename,
+                os.path.join(path_parts, code_name(filename)),
+                path_preprocess,
+                streaming,
+            ): filename
+            for filename in filenames
+        }
+
+        for future in as_completed(futures):
+            print(futures[future], future.result())
+
+    # the codes are merged in the order of the filenames, whatever the order in which
+    # the workers finish, so the rows of the corpus are stable
+    writer = CorpusWriter(path_corpus)
+    for filename in filenames:
+        writer.add_corpus(os.path.join(path_parts, code_name(filename)))
+    writer.close()
+    shutil.rmtree(path_parts)
+
+
 if __name__ == "__main__":
     PATH_PDF = "../data_pdf"
     PATH_PREPROCESS = "../data_preprocess/"
+    PATH_CORPUS = "../corpus/"
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument(
+        "--batch",
+        action="store_true",
+        help="extract the whole pdf at once instead of page by page",
+    )
+    parser.add_argument(
+        "--pickles",
+        action="store_true",
+        help="also write the article pickle files in data_preprocess",
+    )
+    args = parser.parse_args()
+
     # we preprocess all the pdf in the folder data_pdf
-    for filename in os.listdir(PATH_PDF):
-        if filename.endswith(".pdf"):
-            print(filename)
-            preprocess_code(PATH_PDF + "/" + filename, PATH_PREPROCESS)
+    preprocess_all(
+        PATH_PDF,
+        PATH_CORPUS,
+        path_preprocess=PATH_PREPROCESS if args.pickles else None,
+        workers=args.workers,
+        streaming=not args.batch,
+    )
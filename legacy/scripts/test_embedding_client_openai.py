@@ -0,0 +1,85 @@
+import threading
+
+import numpy as np
+import pytest
+
+from embedding_checkpoint import EmbeddingCheckpoint
+from embedding_client_openai import AsyncEmbeddingClient, make_batches
+from mock_openai_server import make_server, fake_embedding
+
+DIM = 8
+
+TEXTS = [
+    f"Article {i} : texte de l'article numero {i}." * (1 + i % 5) for i in range(300)
+]
+
+
+@pytest.fixture
+def mock_server():
+    # one request in three is rate limited
+    server = make_server(port=0, dim=DIM, error_rate=0.3, latency=0.01)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def make_client(server):
+    return AsyncEmbeddingClient(
+        max_in_flight=8,
+        max_texts_per_batch=10,
+        max_retries=30,
+        base_delay=0.001,
+        max_delay=0.01,
+        api_key="sk-test",
+        api_base=f"http://localhost:{server.server_port}/v1",
+    )
+
+
+class Crash(Exception):
+    pass
+
+
+def expected_embeddings(texts):
+    return np.array([fake_embedding(text, DIM) for text in texts], dtype=np.float32)
+
+
+def test_embeddings_in_order_with_retries(mock_server):
+    embeddings = make_client(mock_server).embed(TEXTS)
+
+    # the batches finish in any order and the data of each response is shuffled
+    np.testing.assert_array_equal(embeddings, expected_embeddings(TEXTS))
+    assert mock_server.status_counts[429] > 0
+    assert mock_server.status_counts[200] == len(make_batches(TEXTS, 50000, 10))
+
+
+def test_resume_from_checkpoint(mock_server, tmp_path):
+    client = make_client(mock_server)
+    nb_batches = len(make_batches(TEXTS, 50000, 10))
+    checkpoint = EmbeddingCheckpoint(str(tmp_path), len(TEXTS), DIM, "fingerprint")
+
+    def on_batch_then_crash(idx, start, embeddings):
+        checkpoint.write_batch(idx, start, embeddings)
+        if len(checkpoint.completed) == 10:
+            raise Crash
+
+    with pytest.raises(Crash):
+        client.embed(TEXTS, on_batch=on_batch_then_crash)
+
+    # the restarted run only sends the batches that are not in the checkpoint
+    checkpoint = EmbeddingCheckpoint(str(tmp_path), len(TEXTS), DIM, "fingerprint")
+    done = set(checkpoint.completed)
+    # (the batches in flight at the crash may still finish)
+    assert 10 <= len(done) < nb_batches
+
+    resumed = []
+
+    def on_batch(idx, start, embeddings):
+        resumed.append(idx)
+        checkpoint.write_batch(idx, start, embeddings)
+
+    client.embed(TEXTS, on_batch=on_batch, skip_batches=checkpoint.completed)
+
+    assert sorted(resumed) == sorted(set(range(nb_batches)) - done)
+    np.testing.assert_array_equal(checkpoint.load(), expected_embeddings(TEXTS))
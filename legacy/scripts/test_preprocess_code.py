@@ -0,0 +1,201 @@
+import os
+import json
+import random
+
+import pytest
+
+from preprocess_code import (
+    preprocess_code,
+    preprocess_code_streaming,
+    iter_page_texts,
+    preprocess_all,
+    segment_text,
+    segment_pages,
+)
+from corpus import Corpus
+from benchmark_segmentation import synthetic_code, reference_segmentation
+
+from pdfminer.high_level import extract_text
+
+DATA_PDF = os.path.join(os.path.dirname(__file__), "..", "data_pdf")
+BENCHMARK_DATA = os.path.join(os.path.dirname(__file__), "..", "benchmark_data")
+
+STAMP = [" Legif.", " Plan", " Jp.C.Cass.", " Jp.Appel", " Jp.Admin.", " Juricaf"]
+
+PAGES = [
+    [
+        "Code de test",
+        "Partie legislative",
+        "Livre Ier : Des personnes",
+        "Titre Ier : Des droits civils",
+        "Article 1",
+        *STAMP,
+        "Les lois sont executoires sur tout le territoire.",
+        "Article 2",
+        *STAMP,
+        "La loi ne dispose que pour l'avenir, voir l'Article 1.",
+    ],
+    [
+        "Elle n'a point d'effet retroactif.",
+        "Chapitre Ier : De la nationalite",
+        "Article 3",
+        *STAMP,
+        "Les lois de police obligent tous ceux qui habitent le territoire.",
+    ],
+    [
+        "Article L. 4-1",
+        *STAMP,
+        "Le juge qui refusera de juger pourra etre poursuivi.",
+        "Section 2 : Des actes",
+        "Article 5",
+        *STAMP,
+        "Il est defendu aux juges de prononcer par voie de disposition generale.",
+    ],
+]
+
+
+def escape(line):
+    return line.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def write_pdf(path, pages):
+    """
+    Minimal pdf with one line of text every 30 points (so every line is a text box
+    of its own, as the links of the stamps in the pdfs of legifrance).
+    """
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>", None]
+    objects.append(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+    kids = []
+    for lines in pages:
+        content = "BT /F1 10 Tf\n" + "".join(
+            f"1 0 0 1 50 {800 - 30 * i} Tm ({escape(line)}) Tj\n"
+            for i, line in enumerate(lines)
+        )
+        content = (content + "ET").encode("latin-1")
+        objects.append(
+            b"<< /Length %d >>\nstream\n%s\nendstream" % (len(content), content)
+        )
+        objects.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+            b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % len(objects)
+        )
+        kids.append(b"%d 0 R" % len(objects))
+    objects[1] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (
+        b" ".join(kids),
+        len(kids),
+    )
+
+    data = b"%PDF-1.4\n"
+    offsets = []
+    for number, obj in enumerate(objects, start=1):
+        offsets.append(len(data))
+        data += b"%d 0 obj\n%s\nendobj\n" % (number, obj)
+    xref = len(data)
+    data += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    data += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    data += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (
+        len(objects) + 1,
+        xref,
+    )
+
+    with open(path, "wb") as handle:
+        handle.write(data)
+
+
+@pytest.fixture(scope="module")
+def code_pdf(tmp_path_factory):
+    path = tmp_path_factory.mktemp("pdf") / "code_de_test.pdf"
+    write_pdf(path, PAGES)
+    return str(path)
+
+
+def real_pdfs():
+    if not os.path.isdir(DATA_PDF):
+        return []
+    return sorted(
+        os.path.join(DATA_PDF, filename)
+        for filename in os.listdir(DATA_PDF)
+        if filename.endswith(".pdf")
+    )
+
+
+def test_preprocess_all_writes_the_corpus(code_pdf, tmp_path):
+    path_pdf = tmp_path / "pdf"
+    path_pdf.mkdir()
+    for filename in ["code_b.pdf", "code_a.pdf"]:
+        write_pdf(path_pdf / filename, PAGES)
+
+    preprocess_all(str(path_pdf), str(tmp_path / "corpus"), workers=2)
+
+    articles, metadata = preprocess_code(code_pdf, None)
+    corpus = Corpus(str(tmp_path / "corpus"))
+    assert len(corpus) == 2 * len(articles)
+    assert [corpus.code(row) for row in range(len(corpus))] == ["code_a"] * len(
+        articles
+    ) + ["code_b"] * len(articles)
+    assert [corpus.text(row) for row in range(len(corpus))] == 2 * articles
+    assert [corpus.number(row) for row in range(len(corpus))] == 2 * [
+        meta["number"] for meta in metadata
+    ]
+    assert not os.path.exists(tmp_path / "corpus" / "parts")
+
+
+def test_page_texts_match_extract_text(code_pdf):
+    assert "".join(iter_page_texts(code_pdf)) == extract_text(code_pdf)
+
+
+def test_streaming_matches_batch(code_pdf):
+    articles, metadata = preprocess_code_streaming(code_pdf, None)
+
+    # the text before the first stamp is a section, the text after the last one is not
+    assert [meta["number"] for meta in metadata] == ["", "1", "2", "3", "L4-1"]
+    assert (articles, metadata) == preprocess_code(code_pdf, None)
+
+
+@pytest.mark.parametrize("path_pdf", real_pdfs())
+def test_streaming_matches_batch_on_codes(path_pdf):
+    assert preprocess_code_streaming(path_pdf, None) == preprocess_code(path_pdf, None)
+
+
+def test_golden_sample():
+    with open(
+        os.path.join(BENCHMARK_DATA, "segmentation_sample.txt"), "r", encoding="utf-8"
+    ) as handle:
+        sample = handle.read()
+    with open(
+        os.path.join(BENCHMARK_DATA, "segmentation_golden.json"), "r", encoding="utf-8"
+    ) as handle:
+        golden = json.load(handle)
+
+    assert segment_text(sample) == (golden["articles"], golden["metadata"])
+
+
+def test_segment_text_matches_reference():
+    text = synthetic_code(300000)
+
+    assert segment_text(text) == reference_segmentation(text)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_segment_pages_matches_segment_text(seed):
+    text = synthetic_code(100000, seed=seed)
+
+    # pages cut anywhere (inside the stamps, the lines, the keywords)
+    rng = random.Random(seed)
+    cuts = sorted(rng.sample(range(1, len(text)), 300))
+    pages = [text[start:end] for start, end in zip([0] + cuts, cuts + [len(text)])]
+
+    assert segment_pages(pages) == segment_text(text)
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_segment_pages_matches_segment_text_on_tiny_pages(seed):
+    # pages of a few characters : the stamps span many pages, and most of the pages
+    # have no stamp at all
+    text = synthetic_code(20000, seed=seed)
+
+    rng = random.Random(seed)
+    cuts = sorted(rng.sample(range(1, len(text)), len(text) // 4))
+    pages = [text[start:end] for start, end in zip([0] + cuts, cuts + [len(text)])]
+
+    assert segment_pages(pages) == segment_text(text)
@@ -0,0 +1,732 @@
+"""
+Read only, memory mapped document store for the gradio apps.
+
+FAISSDocumentStore.load reads the whole faiss index and the sql table of the documents
+in the memory of each process. Here the serving store is a folder with :
+- index.faiss : the faiss index, opened with the faiss mmap io flags, or flat.npy :
+  the vectors of a flat index ("none" and "float16" compressions, see MmapFlatIndex)
+- texts.bin / texts_offsets.npy : the content of the documents (utf-8 blob + offsets)
+- ids.bin / ids_offsets.npy : the haystack ids of the documents
+- meta.bin / meta_offsets.npy : the meta of the documents (one json per document)
+- codes/ : one flat index per code (meta "code" of the documents) with the global
+  vector ids (or one .npy of vectors and one _ids.npy), and codes.json (code -> index
+  file)
+the row i of each column is the document of the faiss vector i.
+
+A search restricted to some codes (filters={"code": [...]}) scans only the vectors
+of these codes in their sub-indexes, instead of filtering the hits of the global
+index (faiss 1.7 has no id selector to restrict a search). The sub-index of a code is
+read at its first search.
+
+Compressed search (--compression) : the float32 vectors take 4 bytes per dimension
+(3 KB per article for mpnet, 6 KB for ada-002). The index can be written as :
+- "float16" : the vectors in float16 (2x smaller, no rescoring)
+- "int8" : faiss scalar quantizer in 8 bits (4x smaller)
+- "binary" : sign of each dimension of the centered vectors, hamming distance (32x
+  smaller)
+with "int8" and "binary", the first pass returns rescore_k candidates, which are
+rescored exactly with the float16 vectors (vectors_f16.npy, memory mapped, only the
+pages of the candidates are read). See benchmark_compression.py for the recall and the
+memory of each mode.
+
+Reduction of the dimension (scripts/faiss_index.py, reduction="pca" / "opq") : the
+index of the document store is a faiss IndexPreTransform. The export writes the index
+on the reduced vectors and the projection (projection.npz), which the store applies
+to the queries, so the code sub-indexes and the compressed modes are also reduced.
+After a pca the variance is in the first axes, which the sign bits of "binary" do not
+weight : use "int8", or "opq" (its rotation balances the axes) with "binary".
+
+The workers of one host share the pages of the memory mapped files through the os
+page cache and the startup does not deserialize them. What is memory mapped :
+- the columns of the documents, the float16 vectors of the rescoring
+- the flat indexes of the "none" and "float16" compressions (global and per code) :
+  faiss 1.7 reads a flat index in the private memory of each process, so they are
+  written as .npy files and searched with numpy (MmapFlatIndex)
+- the inverted lists of the IVF indexes (faiss IO_FLAG_MMAP, see faiss_index.py)
+The other indexes (HNSW graphs, "int8" and "binary" codes) are read in the memory of
+each process, unless the faiss version has IO_FLAG_MMAP_IFC (memory map of the codes
+of the flat indexes, not in faiss 1.7).
+
+The export is done once from a saved FAISSDocumentStore :
+    python serving_store.py --index faiss_index.index --config faiss_config.json \
+        --output serving_store/ --compression int8
+and the apps use it with SERVING_STORE=serving_store/.
+"""
+
+import os
+import json
+import math
+import argparse
+
+import numpy as np
+
+import faiss
+from haystack.schema import Document
+
+INDEX_FILENAME = "index.faiss"
+VECTORS_FILENAME = "vectors_f16.npy"
+CENTER_FILENAME = "center.npy"
+PROJECTION_FILENAME = "projection.npz"
+FLAT_FILENAME = "flat.npy"
+
+COMPRESSIONS = ["none", "float16", "int8", "binary"]
+# modes with a rescoring of the candidates of the first pass with the float16 vectors
+RESCORED_COMPRESSIONS = ["int8", "binary"]
+RESCORE_K = 200
+# compressions searched on a .npy of the vectors (dtype of the vectors)
+FLAT_COMPRESSIONS = {"none": np.float32, "float16": np.float16}
+
+# faiss io flags : IO_FLAG_MMAP_IFC (recent faiss only) memory maps the codes of the
+# flat indexes, IO_FLAG_MMAP (faiss 1.7) only the inverted lists
+if hasattr(faiss, "IO_FLAG_MMAP_IFC"):
+    MMAP_IO_FLAGS = faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY
+else:
+    MMAP_IO_FLAGS = faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY
+
+
+def write_string_column(path, name, strings):
+    """
+    Write a list of str as an utf-8 blob (name.bin) and an offsets array (name_offsets.npy).
+    """
+    offsets = np.zeros(len(strings) + 1, dtype=np.int64)
+
+    with open(os.path.join(path, name + ".bin"), "wb") as handle:
+        for idx, string in enumerate(strings):
+            data = string.encode("utf-8")
+            handle.write(data)
+            offsets[idx + 1] = offsets[idx] + len(data)
+
+    np.save(os.path.join(path, name + "_offsets.npy"), offsets)
+
+
+class StringColumn:
+    """
+    Memory mapped column of str written by write_string_column.
+    The strings are decoded only when they are accessed.
+    """
+
+    def __init__(self, path, name):
+        self.offsets = np.load(os.path.join(path, name + "_offsets.npy"), mmap_mode="r")
+
+        blob_path = os.path.join(path, name + ".bin")
+        if os.path.getsize(blob_path) > 0:
+            self.blob = np.memmap(blob_path, dtype=np.uint8, mode="r")
+        else:
+            self.blob = np.zeros(0, dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        start, end = self.offsets[idx], self.offsets[idx + 1]
+        return self.blob[start:end].tobytes().decode("utf-8")
+
+
+def export_serving_store(document_store, path, compression="none", rescore_k=RESCORE_K):
+    """
+    Export a haystack FAISSDocumentStore in the serving store format.
+
+    params:
+        document_store: FAISSDocumentStore
+        path: str (serving store folder)
+        compression: str (one of COMPRESSIONS, "none" keeps the index of the store)
+        rescore_k: int (number of candidates rescored, int8 and binary)
+    """
+    if compression not in COMPRESSIONS:
+        raise ValueError(f"unknown compression {compression}, not in {COMPRESSIONS}")
+
+    os.makedirs(path, exist_ok=True)
+
+    documents = list(document_store.get_all_documents_generator(return_embedding=False))
+    documents = sorted(documents, key=lambda document: int(document.meta["vector_id"]))
+
+    assert [int(document.meta["vector_id"]) for document in documents] == list(
+        range(len(documents))
+    ), "the vector ids of the document store are not contiguous"
+
+    transforms, index = split_pretransform(
+        document_store.faiss_indexes[document_store.index]
+    )
+    if len(transforms) > 0:
+        matrix, bias = linear_projection(transforms)
+        np.savez(os.path.join(path, PROJECTION_FILENAME), matrix=matrix, bias=bias)
+
+    # "none" keeps the index of the store, it is written as a .npy if it is flat
+    flat = compression in FLAT_COMPRESSIONS and (
+        compression != "none" or isinstance(index, faiss.IndexFlat)
+    )
+
+    codes = [document.meta.get("code") for document in documents]
+    vectors = None
+    if compression != "none" or flat or any(codes):
+        vectors = reconstruct_vectors(index)
+
+    center = None
+    if flat:
+        np.save(
+            os.path.join(path, FLAT_FILENAME),
+            vectors.astype(FLAT_COMPRESSIONS[compression]),
+        )
+    elif compression == "none":
+        faiss.write_index(index, os.path.join(path, INDEX_FILENAME))
+    else:
+        if compression == "binary":
+            center = vectors.mean(axis=0)
+            np.save(os.path.join(path, CENTER_FILENAME), center)
+        write_any_index(
+            compress_index(vectors, index.metric_type, compression, center),
+            os.path.join(path, INDEX_FILENAME),
+        )
+    if compression in RESCORED_COMPRESSIONS:
+        np.save(os.path.join(path, VECTORS_FILENAME), vectors.astype(np.float16))
+
+    write_string_column(path, "texts", [document.content for document in documents])
+    write_string_column(path, "ids", [str(document.id) for document in documents])
+    write_string_column(
+        path,
+        "meta",
+        [
+            json.dumps(
+                {k: v for k, v in document.meta.items() if k != "vector_id"},
+                ensure_ascii=False,
+            )
+            for document in documents
+        ],
+    )
+
+    export_code_indexes(
+        vectors, index.metric_type, codes, path, compression, center, flat
+    )
+
+    with open(os.path.join(path, "config.json"), "w") as handle:
+        json.dump(
+            {
+                "similarity": document_store.similarity,
+                "metric": int(index.metric_type),
+                "compression": compression,
+                "rescore_k": rescore_k,
+                "flat": flat,
+            },
+            handle,
+        )
+
+
+def split_pretransform(index):
+    """
+    Transforms and sub-index of a faiss IndexPreTransform (reduction of the dimension).
+
+    return:
+        transforms: list of faiss VectorTransform (empty for other indexes)
+        index: faiss index (on the transformed vectors)
+    """
+    index = faiss.downcast_index(index)
+    if not isinstance(index, faiss.IndexPreTransform):
+        return [], index
+
+    transforms = [
+        faiss.downcast_VectorTransform(index.chain.at(i))
+        for i in range(index.chain.size())
+    ]
+    inner_transforms, index = split_pretransform(index.index)
+    return transforms + inner_transforms, index
+
+
+def linear_projection(transforms):
+    """
+    Matrix and bias of a chain of linear transforms (x -> matrix @ x + bias).
+    """
+    matrix, bias = None, None
+    for transform in transforms:
+        if not isinstance(transform, faiss.LinearTransform):
+            raise ValueError(f"{type(transform).__name__} is not a linear transform")
+        a = faiss.vector_to_array(transform.A).reshape(transform.d_out, transform.d_in)
+        b = (
+            faiss.vector_to_array(transform.b)
+            if transform.have_bias
+            else np.zeros(transform.d_out, dtype=np.float32)
+        )
+        if matrix is None:
+            matrix, bias = a, b
+        else:
+            matrix, bias = a @ matrix, a @ bias + b
+    return matrix.astype(np.float32), bias.astype(np.float32)
+
+
+def reconstruct_vectors(index):
+    """
+    All the vectors of a faiss index (approximated by the codes for PQ indexes).
+    """
+    try:
+        # the ivf indexes need a direct map to reconstruct a vector from its id
+        faiss.extract_index_ivf(index).make_direct_map()
+    except RuntimeError:
+        pass
+    return index.reconstruct_n(0, index.ntotal)
+
+
+def compress_index(vectors, metric, compression, center=None, ids=None):
+    """
+    Flat faiss index of the vectors in a compression mode.
+
+    params:
+        vectors: np.array float32 (nb_vectors, dim)
+        metric: faiss metric (METRIC_INNER_PRODUCT or METRIC_L2)
+        compression: str (one of COMPRESSIONS)
+        center: np.array (dim,) (mean of the vectors, binary only)
+        ids: np.array of int64 (ids of the vectors, None for 0 .. nb_vectors - 1)
+
+    return:
+        index: faiss Index (faiss IndexBinary for "binary")
+    """
+    d = vectors.shape[1]
+
+    if compression == "binary":
+        index = faiss.IndexBinaryFlat(binary_dim(d))
+        if ids is not None:
+            index = faiss.IndexBinaryIDMap(index)
+        vectors = binary_codes(vectors, center)
+    else:
+        if compression == "none":
+            index = faiss.IndexFlat(d, metric)
+        elif compression == "float16":
+            index = faiss.IndexScalarQuantizer(d, faiss.ScalarQuantizer.QT_fp16, metric)
+        elif compression == "int8":
+            index = faiss.IndexScalarQuantizer(d, faiss.ScalarQuantizer.QT_8bit, metric)
+            index.train(np.ascontiguousarray(vectors, dtype=np.float32))
+        else:
+            raise ValueError(f"unknown compression {compression}")
+        if ids is not None:
+            index = faiss.IndexIDMap(index)
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+
+    if ids is None:
+        index.add(vectors)
+    else:
+        index.add_with_ids(vectors, ids)
+    return index
+
+
+def binary_dim(d):
+    # faiss binary indexes take a number of bits multiple of 8
+    return (d + 7) // 8 * 8
+
+
+def binary_codes(vectors, center):
+    """
+    Sign bits of the centered vectors (uint8, dim / 8 bytes per vector) : the hamming
+    distance of two codes approximates the angle of the vectors.
+    """
+    return np.packbits(np.asarray(vectors, dtype=np.float32) > center, axis=1)
+
+
+def write_any_index(index, filename):
+    if isinstance(index, faiss.IndexBinary):
+        faiss.write_index_binary(index, filename)
+    else:
+        faiss.write_index(index, filename)
+
+
+def read_any_index(filename, compression, io_flags=0):
+    if compression == "binary":
+        return faiss.read_index_binary(filename)
+    return faiss.read_index(filename, io_flags)
+
+
+def rescore(vectors, query_embs, vector_ids, top_k, metric):
+    """
+    Exact scores of the candidates of a first pass with the float16 vectors.
+
+    params:
+        vectors: np.array float16 (nb_vectors, dim), memory mapped
+        query_embs: np.array float32 (nb_queries, dim)
+        vector_ids: np.array (nb_queries, nb_candidates), -1 for no candidate
+        top_k: int
+        metric: faiss metric
+
+    return:
+        scores: np.array (nb_queries, top_k)
+        vector_ids: np.array (nb_queries, top_k), -1 for no result
+    """
+    nb_queries = vector_ids.shape[0]
+    top_k = min(top_k, vector_ids.shape[1])
+    scores = np.empty((nb_queries, top_k), dtype=np.float32)
+    ids = np.empty((nb_queries, top_k), dtype=vector_ids.dtype)
+
+    # one query at a time : only the (nb_candidates, dim) float16 vectors of a query
+    # are read and converted, never the candidates of the whole batch
+    for i in range(nb_queries):
+        valid = vector_ids[i] >= 0
+        candidates = np.asarray(
+            vectors[np.where(valid, vector_ids[i], 0)], dtype=np.float32
+        )
+
+        if metric == faiss.METRIC_L2:
+            candidates -= query_embs[i]
+            query_scores = np.einsum("kd,kd->k", candidates, candidates)
+            order = np.argsort(np.where(valid, query_scores, np.inf))
+        else:
+            query_scores = candidates @ query_embs[i]
+            order = np.argsort(np.where(valid, -query_scores, np.inf))
+        order = order[:top_k]
+
+        scores[i] = query_scores[order]
+        ids[i] = vector_ids[i][order]
+
+    return scores, ids
+
+
+def export_code_indexes(
+    vectors, metric, codes, path, compression="none", center=None, flat=False
+):
+    """
+    Write one flat index per code in path/codes/ (same metric and compression as the
+    global index, the ids are the vector ids of the global index).
+
+    params:
+        vectors: np.array float32 (all the vectors of the global index)
+        metric: faiss metric
+        codes: list of str (code of each vector, None if unknown)
+        path: str (serving store folder)
+        compression: str (one of COMPRESSIONS)
+        center: np.array (mean of the vectors, binary only)
+        flat: bool (write the vectors and their ids as .npy files, see MmapFlatIndex)
+    """
+    names = sorted({code for code in codes if code})
+    if len(names) == 0:
+        return
+
+    os.makedirs(os.path.join(path, "codes"), exist_ok=True)
+    codes = np.array([code or "" for code in codes], dtype=object)
+
+    files = {}
+    for i, name in enumerate(names):
+        vector_ids = np.flatnonzero(codes == name).astype(np.int64)
+
+        if flat:
+            files[name] = f"{i}.npy"
+            np.save(
+                os.path.join(path, "codes", files[name]),
+                vectors[vector_ids].astype(FLAT_COMPRESSIONS[compression]),
+            )
+            np.save(os.path.join(path, "codes", f"{i}_ids.npy"), vector_ids)
+            continue
+
+        code_index = compress_index(
+            vectors[vector_ids], metric, compression, center, vector_ids
+        )
+        files[name] = f"{i}.faiss"
+        write_any_index(code_index, os.path.join(path, "codes", files[name]))
+
+    with open(os.path.join(path, "codes", "codes.json"), "w") as handle:
+        json.dump(files, handle, ensure_ascii=False)
+
+
+class MmapFlatIndex:
+    """
+    Exact search on vectors memory mapped from a .npy file (float32 or float16), with
+    the search method and the results of a faiss flat index.
+    The vectors are scanned by blocks (a float16 block is converted to float32), the
+    pages are shared by the processes that map the same file.
+
+    params:
+        filename: str (.npy of the vectors)
+        metric: faiss metric (METRIC_INNER_PRODUCT or METRIC_L2)
+        ids_filename: str (.npy of the ids of the vectors, None for 0 .. nb_vectors - 1)
+        block_size: int (number of vectors scored at once)
+    """
+
+    def __init__(self, filename, metric, ids_filename=None, block_size=65536):
+        self.vectors = np.load(filename, mmap_mode="r")
+        self.ids = None if ids_filename is None else np.load(ids_filename)
+        self.metric_type = metric
+        self.block_size = block_size
+        self.ntotal, self.d = self.vectors.shape
+
+    def search(self, queries, k):
+        """
+        return:
+            scores: np.array float32 (nb_queries, k) (squared distances for L2)
+            ids: np.array int64 (nb_queries, k), -1 when there are less than k vectors
+        """
+        queries = np.asarray(queries, dtype=np.float32)
+        l2 = self.metric_type == faiss.METRIC_L2
+
+        # best k of the blocks so far, as scores where higher is better
+        best_scores = np.empty((len(queries), 0), dtype=np.float32)
+        best_ids = np.empty((len(queries), 0), dtype=np.int64)
+        for start in range(0, self.ntotal, self.block_size):
+            block = np.asarray(
+                self.vectors[start : start + self.block_size], dtype=np.float32
+            )
+            scores = queries @ block.T
+            if l2:
+                # -|q - x|^2 without the |q|^2 of the query (added at the end)
+                scores = 2 * scores - (block * block).sum(axis=1)
+
+            block_ids = np.broadcast_to(
+                np.arange(start, start + len(block), dtype=np.int64), scores.shape
+            )
+            scores = np.concatenate([best_scores, scores], axis=1)
+            ids = np.concatenate([best_ids, block_ids], axis=1)
+            if scores.shape[1] > k:
+                top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+                scores = np.take_along_axis(scores, top, axis=1)
+                ids = np.take_along_axis(ids, top, axis=1)
+            best_scores, best_ids = scores, ids
+
+        order = np.argsort(-best_scores, axis=1)
+        scores = np.take_along_axis(best_scores, order, axis=1)
+        ids = np.take_along_axis(best_ids, order, axis=1)
+        if l2:
+            scores = (queries * queries).sum(axis=1, keepdims=True) - scores
+        if self.ids is not None:
+            ids = self.ids[ids]
+
+        # padding of faiss when there are less than k vectors
+        missing = k - ids.shape[1]
+        if missing > 0:
+            pad = np.finfo(np.float32).max if l2 else -np.finfo(np.float32).max
+            scores = np.pad(scores, ((0, 0), (0, missing)), constant_values=pad)
+            ids = np.pad(ids, ((0, 0), (0, missing)), constant_values=-1)
+
+        return scores.astype(np.float32), ids.astype(np.int64)
+
+
+def filter_codes(filters):
+    """
+    Codes of haystack filters ({"code": "code_civil"} or {"code": [...]}), None for
+    no filter.
+    """
+    if not filters:
+        return None
+    if set(filters) != {"code"}:
+        raise ValueError(f"the serving store only filters on the code, not {filters}")
+    codes = filters["code"]
+    return [codes] if isinstance(codes, str) else list(codes)
+
+
+class MmapDocumentStore:
+    """
+    Read only document store on a serving store folder.
+    It has the query_by_embedding method used by the haystack EmbeddingRetriever,
+    with the same scores as FAISSDocumentStore.
+    """
+
+    def __init__(self, path, index="document", rescore_k=None):
+        self.path = path
+        self.index = index
+
+        with open(os.path.join(path, "config.json"), "r") as handle:
+            config = json.load(handle)
+        self.similarity = config["similarity"]
+        self.compression = config.get("compression", "none")
+        self.rescore_k = rescore_k or config.get("rescore_k", RESCORE_K)
+
+        self.flat = config.get("flat", False)
+        if self.flat:
+            self.faiss_index = MmapFlatIndex(
+                os.path.join(path, FLAT_FILENAME), config["metric"]
+            )
+        else:
+            self.faiss_index = read_any_index(
+                os.path.join(path, INDEX_FILENAME), self.compression, MMAP_IO_FLAGS
+            )
+        # the binary indexes have no metric, the scores are the ones of the vectors
+        self.metric = config.get("metric", getattr(self.faiss_index, "metric_type", 0))
+
+        self.center = None
+        if self.compression == "binary":
+            self.center = np.load(os.path.join(path, CENTER_FILENAME))
+        self.vectors = None
+        if self.compression in RESCORED_COMPRESSIONS:
+            self.vectors = np.load(os.path.join(path, VECTORS_FILENAME), mmap_mode="r")
+
+        self.projection = None
+        projection_path = os.path.join(path, PROJECTION_FILENAME)
+        if os.path.exists(projection_path):
+            with np.load(projection_path) as projection:
+                self.projection = (projection["matrix"], projection["bias"])
+        self.texts = StringColumn(path, "texts")
+        self.ids = StringColumn(path, "ids")
+        self.meta = StringColumn(path, "meta")
+
+        codes_path = os.path.join(path, "codes", "codes.json")
+        self.code_files = {}
+        if os.path.exists(codes_path):
+            with open(codes_path, "r") as handle:
+                self.code_files = json.load(handle)
+        self.code_indexes = {}
+
+    def code_index(self, code):
+        """
+        Sub-index of a code (read at the first use), None for an unknown code.
+        """
+        if code not in self.code_files:
+            return None
+        if code not in self.code_indexes:
+            filename = os.path.join(self.path, "codes", self.code_files[code])
+            if self.flat:
+                self.code_indexes[code] = MmapFlatIndex(
+                    filename, self.metric, filename[: -len(".npy")] + "_ids.npy"
+                )
+            else:
+                self.code_indexes[code] = read_any_index(
+                    filename, self.compression, MMAP_IO_FLAGS
+                )
+        return self.code_indexes[code]
+
+    def search(self, query_embs, top_k, codes=None):
+        """
+        faiss search in the global index, or in the sub-indexes of codes (with the
+        rescoring of the candidates for the compressed indexes).
+
+        return:
+            scores: np.array (nb_queries, top_k)
+            vector_ids: np.array (nb_queries, top_k), -1 for no result
+        """
+        if self.projection is not None:
+            matrix, bias = self.projection
+            query_embs = np.ascontiguousarray(query_embs @ matrix.T + bias)
+
+        if self.vectors is None:
+            return self.first_pass(query_embs, top_k, codes)
+
+        _, vector_ids = self.first_pass(query_embs, max(top_k, self.rescore_k), codes)
+        return rescore(self.vectors, query_embs, vector_ids, top_k, self.metric)
+
+    def first_pass(self, query_embs, top_k, codes=None):
+        if self.compression == "binary":
+            # hamming distances of the sign codes (lower is better)
+            query_codes = binary_codes(query_embs, self.center)
+            return self.search_indexes(query_codes, top_k, codes, lower_first=True)
+        return self.search_indexes(
+            query_embs, top_k, codes, lower_first=self.metric == faiss.METRIC_L2
+        )
+
+    def search_indexes(self, queries, top_k, codes, lower_first):
+        if codes is None:
+            return self.faiss_index.search(queries, top_k)
+
+        code_indexes = [self.code_index(code) for code in codes]
+        code_indexes = [index for index in code_indexes if index is not None]
+        if len(code_indexes) == 0:
+            return (
+                np.zeros((len(queries), top_k), dtype=np.float32),
+                np.full((len(queries), top_k), -1, dtype=np.int64),
+            )
+
+        results = [index.search(queries, top_k) for index in code_indexes]
+        if len(results) == 1:
+            return results[0]
+
+        # several codes : best top_k of the results of each code
+        scores = np.concatenate([scores for scores, _ in results], axis=1)
+        vector_ids = np.concatenate([vector_ids for _, vector_ids in results], axis=1)
+        if lower_first:
+            order = np.argsort(np.where(vector_ids == -1, np.inf, scores), axis=1)
+        else:
+            order = np.argsort(np.where(vector_ids == -1, -np.inf, -scores), axis=1)
+        order = order[:, :top_k]
+        return (
+            np.take_along_axis(scores, order, axis=1),
+            np.take_along_axis(vector_ids, order, axis=1),
+        )
+
+    def get_document_count(self):
+        return len(self.texts)
+
+    def scale_to_unit_interval(self, score):
+        """
+        Same scaling as the haystack document stores.
+        """
+        if self.similarity == "cosine":
+            return (score + 1) / 2
+        return 1 / (1 + math.exp(-score / 100))
+
+    def get_document(self, vector_id, score=None):
+        meta = json.loads(self.meta[vector_id])
+        meta["vector_id"] = str(vector_id)
+        return Document(
+            content=self.texts[vector_id],
+            id=self.ids[vector_id],
+            meta=meta,
+            score=score,
+        )
+
+    def get_documents_by_vector_ids(self, vector_ids, index=None, batch_size=10000):
+        """
+        Same as the haystack SQLDocumentStore method (vector ids as str).
+        """
+        return [self.get_document(int(vector_id)) for vector_id in vector_ids]
+
+    def query_by_embedding(
+        self,
+        query_emb,
+        filters=None,
+        top_k=10,
+        index=None,
+        return_embedding=None,
+        headers=None,
+        scale_score=True,
+    ):
+        return self.query_by_embedding_batch(
+            np.asarray(query_emb).reshape(1, -1),
+            filters=filters,
+            top_k=top_k,
+            scale_score=scale_score,
+        )[0]
+
+    def query_by_embedding_batch(
+        self,
+        query_embs,
+        filters=None,
+        top_k=10,
+        index=None,
+        return_embedding=None,
+        headers=None,
+        scale_score=True,
+    ):
+        """
+        One faiss search for all the queries (one list of documents per query).
+        filters={"code": [...]} searches only the documents of these codes.
+        """
+        query_embs = np.ascontiguousarray(query_embs, dtype=np.float32)
+        if self.similarity == "cosine":
+            # as FAISSDocumentStore (the documents were normalized when written), a
+            # new array : the embeddings of the caller are not modified
+            norms = np.linalg.norm(query_embs, axis=1, keepdims=True)
+            query_embs = query_embs / np.where(norms > 0, norms, 1)
+        scores, vector_ids = self.search(query_embs, top_k, filter_codes(filters))
+
+        results = []
+        for query_scores, query_vector_ids in zip(scores, vector_ids):
+            documents = []
+            for score, vector_id in zip(query_scores, query_vector_ids):
+                if vector_id == -1:
+                    continue
+                score = float(score)
+                if scale_score:
+                    score = self.scale_to_unit_interval(score)
+                documents.append(self.get_document(int(vector_id), score))
+            results.append(documents)
+
+        return results
+
+
+if __name__ == "__main__":
+    from haystack.document_stores import FAISSDocumentStore
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--index", default="faiss_index.index")
+    parser.add_argument("--config", default="faiss_config.json")
+    parser.add_argument("--output", default="serving_store/")
+    parser.add_argument("--compression", default="none", choices=COMPRESSIONS)
+    parser.add_argument("--rescore-k", type=int, default=RESCORE_K)
+    args = parser.parse_args()
+
+    export_serving_store(
+        FAISSDocumentStore.load(index_path=args.index, config_path=args.config),
+        args.output,
+        args.compression,
+        args.rescore_k,
+    )
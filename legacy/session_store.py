@@ -0,0 +1,171 @@
+"""
+Server side store of the conversations (shared by the two apps).
+
+The conversation used to be a gr.State with the list of the messages (system prompt
+included) : gradio sent it with every request, chat copied it at each turn and the
+states were kept without bound. Here the gr.State only holds a session id, and the
+conversations are kept in the process :
+- a turn is a (query, answer) pair of str, the roles and the system prompt are not
+  stored (they are the same for all the turns)
+- when the tokens of a session exceed max_tokens, its oldest turns are dropped (the
+  prompt only keeps HISTORY_BUDGET tokens of history, see context_packing.py)
+- a session expires ttl seconds after its last use, and the least recently used
+  sessions are evicted when there are more than max_sessions sessions or when the
+  strings of all the sessions take more than max_bytes
+The size of the strings is counted when a turn is added (see stats).
+
+An expired or evicted session starts a new conversation.
+"""
+
+import sys
+import time
+import secrets
+import threading
+from collections import OrderedDict, deque
+
+from metrics import count_tokens
+
+# memory of a turn besides its strings (tuple and deque slot)
+TURN_OVERHEAD = sys.getsizeof((None, None, 0, 0)) + 8
+
+
+class Session:
+    __slots__ = ["turns", "tokens", "nbytes", "expiration"]
+
+    def __init__(self, expiration):
+        # (query, answer, nb_tokens, nb_bytes)
+        self.turns = deque()
+        self.tokens = 0
+        self.nbytes = 0
+        self.expiration = expiration
+
+
+class SessionStore:
+    """
+    params:
+        max_sessions: int (maximum number of sessions)
+        ttl: float (time to live of a session after its last use, in seconds)
+        max_tokens: int (maximum number of tokens of the turns of a session, the last
+            turn is always kept)
+        max_bytes: int (maximum size of the strings of all the sessions)
+    """
+
+    def __init__(
+        self,
+        max_sessions=10000,
+        ttl=3600,
+        max_tokens=4000,
+        max_bytes=256 * 1024 * 1024,
+    ):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.max_tokens = max_tokens
+        self.max_bytes = max_bytes
+
+        # session id -> Session, least recently used first
+        self.sessions = OrderedDict()
+        self.nbytes = 0
+
+        self.lock = threading.Lock()
+        self.counters = {"created": 0, "expired": 0, "evicted": 0, "dropped_turns": 0}
+
+    def _remove(self, session_id, counter):
+        session = self.sessions.pop(session_id)
+        self.nbytes -= session.nbytes
+        self.counters[counter] += 1
+
+    def _expire(self, now):
+        # the sessions are in the order of their last use : the expired ones are first
+        while self.sessions:
+            session_id, session = next(iter(self.sessions.items()))
+            if session.expiration > now:
+                break
+            self._remove(session_id, "expired")
+
+    def _evict(self):
+        while self.sessions and (
+            len(self.sessions) > self.max_sessions or self.nbytes > self.max_bytes
+        ):
+            self._remove(next(iter(self.sessions)), "evicted")
+
+    def session(self, session_id=None):
+        """
+        Id of a live session : session_id if it is still in the store, else a new
+        session.
+        """
+        now = time.monotonic()
+
+        with self.lock:
+            self._expire(now)
+
+            if session_id in self.sessions:
+                self.sessions.move_to_end(session_id)
+                self.sessions[session_id].expiration = now + self.ttl
+                return session_id
+
+            session_id = secrets.token_hex(16)
+            self.sessions[session_id] = Session(now + self.ttl)
+            self.counters["created"] += 1
+            self._evict()
+
+        return session_id
+
+    def pairs(self, session_id):
+        """
+        return:
+            pairs: list of (query, answer) (gr.Chatbot format)
+        """
+        with self.lock:
+            session = self.sessions.get(session_id)
+            if session is None:
+                return []
+            return [(query, answer) for query, answer, _, _ in session.turns]
+
+    def messages(self, session_id):
+        """
+        return:
+            messages: list of {"role", "content"} (user and assistant, no system
+                prompt)
+        """
+        messages = []
+        for query, answer in self.pairs(session_id):
+            messages.append({"role": "user", "content": query})
+            messages.append({"role": "assistant", "content": answer})
+        return messages
+
+    def append(self, session_id, query, answer):
+        """
+        Add a turn to a session (nothing if the session has been evicted meanwhile).
+        """
+        nb_tokens = count_tokens(query) + count_tokens(answer)
+        nb_bytes = sys.getsizeof(query) + sys.getsizeof(answer) + TURN_OVERHEAD
+
+        with self.lock:
+            session = self.sessions.get(session_id)
+            if session is None:
+                return
+
+            session.turns.append((query, answer, nb_tokens, nb_bytes))
+            session.tokens += nb_tokens
+            session.nbytes += nb_bytes
+            self.nbytes += nb_bytes
+
+            # oldest turns first, the last one is kept
+            while session.tokens > self.max_tokens and len(session.turns) > 1:
+                _, _, old_tokens, old_bytes = session.turns.popleft()
+                session.tokens -= old_tokens
+                session.nbytes -= old_bytes
+                self.nbytes -= old_bytes
+                self.counters["dropped_turns"] += 1
+
+            self.sessions.move_to_end(session_id)
+            self._evict()
+
+    def stats(self):
+        with self.lock:
+            return {
+                **self.counters,
+                "sessions": len(self.sessions),
+                "turns": sum(len(session.turns) for session in self.sessions.values()),
+                "bytes": self.nbytes,
+            }
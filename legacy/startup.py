@@ -0,0 +1,147 @@
+"""
+Startup of the gradio apps (shared by the two apps).
+
+Loading the document store and the embedding model takes most of the startup time.
+With LAZY_STARTUP=1 the app binds the gradio server first and loads them in a
+background thread : the requests received before the end of the loading wait for it,
+and a readiness probe answers 503 until the loading and a warm-up query are done.
+
+The probe is served on READINESS_PORT (when set, or 7861 with LAZY_STARTUP=1) :
+- /ready : 200 when the app can answer, else 503
+- /startup : duration of each startup phase (json)
+
+This module is imported first by the apps, so the "imports" phase measures the
+imports of the app (gradio, haystack ...).
+"""
+
+import os
+import json
+import time
+import threading
+import traceback
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+IMPORT_START = time.time()
+
+WARMUP_QUERY = "Syndicaliste et entreprises"
+
+
+class Startup:
+    """
+    params:
+        lazy: bool (load in a background thread)
+    """
+
+    def __init__(self, lazy=False):
+        self.lazy = lazy
+        self.start_time = IMPORT_START
+
+        # name -> {"start": seconds since start_time, "duration": seconds}
+        self.phases = {}
+        self.phase_lock = threading.Lock()
+
+        self.resource = None
+        self.error = None
+        self.ready = threading.Event()
+        self.done = threading.Event()
+
+        self.record("imports", IMPORT_START, time.time())
+
+    def record(self, name, start, end):
+        with self.phase_lock:
+            self.phases[name] = {
+                "start": start - self.start_time,
+                "duration": end - start,
+            }
+
+    @contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.record(name, start, time.time())
+
+    def _load(self, load):
+        try:
+            self.resource = load()
+            self.ready.set()
+            self.record("ready", self.start_time, time.time())
+        except Exception as error:
+            traceback.print_exc()
+            self.error = error
+        finally:
+            self.done.set()
+
+    def start(self, load):
+        """
+        Run load (function () -> resource), in a background thread if lazy.
+        """
+        if self.lazy:
+            threading.Thread(target=self._load, args=(load,), daemon=True).start()
+        else:
+            self._load(load)
+            if self.error is not None:
+                raise self.error
+
+    def wait(self, timeout=None):
+        """
+        The loaded resource (waits for the end of the loading).
+        """
+        self.done.wait(timeout)
+        if self.error is not None:
+            raise RuntimeError("the app failed to start") from self.error
+        if not self.ready.is_set():
+            raise TimeoutError("the app is still starting")
+        return self.resource
+
+    def status(self):
+        with self.phase_lock:
+            phases = dict(self.phases)
+        return {
+            "ready": self.ready.is_set(),
+            "error": repr(self.error) if self.error is not None else None,
+            "uptime": time.time() - self.start_time,
+            "phases": phases,
+        }
+
+    def serve_probe(self, port=7861, host="0.0.0.0"):
+        """
+        Serve /ready and /startup in a daemon thread.
+        """
+        startup = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path not in ("/ready", "/startup"):
+                    self.send_error(404)
+                    return
+                status = startup.status()
+                code = 200 if status["ready"] or self.path == "/startup" else 503
+                body = json.dumps(status).encode("utf-8")
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+def startup_from_env():
+    """
+    Startup configured with LAZY_STARTUP and READINESS_PORT (the probe is started).
+    """
+    startup = Startup(lazy=os.environ.get("LAZY_STARTUP", "0") == "1")
+
+    port = os.environ.get("READINESS_PORT", "7861" if startup.lazy else None)
+    if port is not None:
+        startup.serve_probe(int(port))
+
+    return startup
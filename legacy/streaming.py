@@ -0,0 +1,74 @@
+"""
+Coalescing of the streamed answer (shared by the two apps and async_pipeline.py) : the
+text so far is sent to gradio at most every interval seconds or every max_chars new
+characters instead of every token.
+
+Not in utils.py : the sentence transformer app has its own utils.py, which shadows
+the one of legacy/.
+"""
+
+import time
+
+
+class TextThrottle:
+    """Accumulate streamed text chunks and tell when the text so far has to be sent:
+    at most every interval seconds or every max_chars new characters (shared by
+    stream_text and async_pipeline.stream_text_async)
+    Args:
+        interval (float): minimum time between two yields in seconds
+        max_chars (int): number of new characters that forces a yield
+    """
+
+    def __init__(self, interval=0.05, max_chars=200):
+        self.interval = interval
+        self.max_chars = max_chars
+        self.parts = []
+        self.pending = 0
+        self.last_yield = time.monotonic()
+
+    def add(self, chunk):
+        """Add a chunk
+        Returns:
+            str: the full text received so far if it has to be sent, else None
+        """
+        self.parts.append(chunk)
+        self.pending += len(chunk)
+
+        now = time.monotonic()
+        if now - self.last_yield >= self.interval or self.pending >= self.max_chars:
+            self.pending = 0
+            self.last_yield = now
+            return "".join(self.parts)
+        return None
+
+    def flush(self):
+        """
+        Returns:
+            str: the complete text if some of it has not been sent, else None
+        """
+        if self.pending > 0:
+            self.pending = 0
+            return "".join(self.parts)
+        return None
+
+
+def stream_text(chunks, interval=0.05, max_chars=200):
+    """Accumulate streamed text chunks and yield the text so far, at most every
+    interval seconds or every max_chars new characters (instead of every token)
+    Args:
+        chunks (iterable): text chunks (tokens)
+        interval (float): minimum time between two yields in seconds
+        max_chars (int): number of new characters that forces a yield
+    Yields:
+        str: the full text received so far (the last yield is the complete text)
+    """
+    throttle = TextThrottle(interval, max_chars)
+
+    for chunk in chunks:
+        text = throttle.add(chunk)
+        if text is not None:
+            yield text
+
+    text = throttle.flush()
+    if text is not None:
+        yield text
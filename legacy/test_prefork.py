@@ -0,0 +1,43 @@
+import os
+
+import numpy as np
+
+from prefork import RetrievalPool
+
+
+class PidEncoder:
+    """
+    Embeds a query as the pid of the process that loaded the encoder and the pid of
+    the process that embeds it.
+    """
+
+    def __init__(self):
+        self.loaded_in = os.getpid()
+
+    def embed_queries(self, queries):
+        return np.array([[self.loaded_in, os.getpid()] for _ in queries])
+
+
+def test_preload_shares_the_encoder_loaded_before_the_fork():
+    pool = RetrievalPool(PidEncoder, 3)
+    try:
+        pids = pool.warmup("question")
+        # the warm-up reaches each worker once
+        assert len(set(pids)) == 3 and os.getpid() not in pids
+
+        loaded_in, embedded_in = pool.embed_queries(["question"])[0]
+        assert loaded_in == os.getpid() and embedded_in in pids
+    finally:
+        pool.shutdown()
+
+
+def test_without_preload_each_worker_loads_its_encoder():
+    pool = RetrievalPool(PidEncoder, 2, preload=False)
+    try:
+        pids = pool.warmup("question")
+        assert len(set(pids)) == 2
+
+        loaded_in, embedded_in = pool.embed_queries(["question"])[0]
+        assert loaded_in == embedded_in
+    finally:
+        pool.shutdown()
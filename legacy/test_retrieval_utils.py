@@ -0,0 +1,103 @@
+import copy
+from dataclasses import dataclass, field
+
+import faiss
+import numpy as np
+import pytest
+
+from retrieval_utils import retrieve_batch, retrieve_with_summaries
+
+
+@dataclass
+class FakeDocument:
+    """
+    Same attributes as the haystack Document used by the retrieval.
+    """
+
+    content: str
+    score: float = None
+    meta: dict = field(default_factory=dict)
+
+
+class InMemoryDocumentStore:
+    """
+    The part of FAISSDocumentStore used by the retrieval, on a flat inner product
+    index.
+    """
+
+    index = "document"
+    similarity = "dot_product"
+
+    def __init__(self, embeddings):
+        self.faiss_indexes = {self.index: faiss.IndexFlatIP(embeddings.shape[1])}
+        self.faiss_indexes[self.index].add(embeddings)
+        self.documents = [
+            FakeDocument(content=f"article {i}", meta={"vector_id": str(i)})
+            for i in range(len(embeddings))
+        ]
+
+    def get_documents_by_vector_ids(self, vector_ids):
+        return [copy.copy(self.documents[int(vector_id)]) for vector_id in vector_ids]
+
+    def scale_to_unit_interval(self, score, similarity):
+        return float(1 / (1 + np.exp(-score / 100)))
+
+    def query_by_embedding(self, query_emb, top_k=10, scale_score=True):
+        scores, vector_ids = self.faiss_indexes[self.index].search(
+            np.asarray(query_emb, dtype=np.float32)[None], top_k
+        )
+        documents = self.get_documents_by_vector_ids(
+            [str(vector_id) for vector_id in vector_ids[0] if vector_id != -1]
+        )
+        for document, score in zip(documents, scores[0]):
+            document.score = (
+                self.scale_to_unit_interval(float(score), self.similarity)
+                if scale_score
+                else float(score)
+            )
+        return documents
+
+
+class FakeRetriever:
+    """
+    Embeds a query as a fixed random vector (the same query gets the same vector).
+    """
+
+    scale_score = True
+
+    def __init__(self, document_store, queries, dim):
+        rng = np.random.default_rng(1)
+        self.document_store = document_store
+        self.embeddings = {
+            query: rng.standard_normal(dim).astype(np.float32) * 10 for query in queries
+        }
+
+    def embed_queries(self, queries):
+        return np.stack([self.embeddings[query] for query in queries])
+
+
+@pytest.fixture(scope="module")
+def retriever():
+    dim = 16
+    embeddings = np.random.default_rng(0).standard_normal((500, dim)) * 10
+    queries = [f"question {i}" for i in range(20)]
+    return FakeRetriever(
+        InMemoryDocumentStore(embeddings.astype(np.float32)), queries, dim
+    )
+
+
+@pytest.mark.parametrize("batch_size", [1, 3, 64])
+def test_retrieve_batch_matches_retrieve_with_summaries(retriever, batch_size):
+    # a query can appear twice in a batch
+    queries = list(retriever.embeddings) + ["question 0", "question 5"]
+
+    passages = retrieve_batch(
+        queries, retriever, top_k=100, threshold=0.999, batch_size=batch_size
+    )
+
+    assert passages == [
+        retrieve_with_summaries(query, retriever, max_k=100, threshold=0.999)
+        for query in queries
+    ]
+    # the threshold drops some passages (all of them for some queries)
+    assert 0 < sum(len(query_passages) for query_passages in passages) < 10 * 22